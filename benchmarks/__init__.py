@@ -0,0 +1,8 @@
+# Benchmarks for the project template export and import code.
+#
+# These are not part of the test suite. Run them from the root of the
+# source tree, for example:
+#
+#   python -m benchmarks.wiki_export --pages 10000
+#   python -m benchmarks.template_roundtrip --output results.json
+#   python -m benchmarks.archive_chain
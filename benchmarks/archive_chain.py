@@ -0,0 +1,206 @@
+"""Round trips a Subversion repository through chains of file archives.
+
+Builds a throwaway repository with branches, tags and moves, dumps it the
+way export_file_archive() does with incremental_archives - a full history
+dump followed by incremental dumps - and loads chains of two and three
+archives into fresh repositories the way import_file_archive() does, one
+`svnadmin load` per archive. Branches and tags are copied from revisions
+before the base revision of the chain, and merged across it, so a chain
+which renumbered revisions would fail to load or point its copies and
+mergeinfo at the wrong revisions.
+
+Every revision of each loaded repository is compared with the original
+one (paths, copy sources and properties), and the time taken by each dump
+and load is reported. Needs svn, svnadmin and svnlook:
+
+    python -m benchmarks.archive_chain --codec pigz
+"""
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from benchmarks import standins
+standins.install()
+
+from createtemplate.archive import CODECS, codec_available, dump_archive, \
+                                   load_archive, throughput, youngest_revision
+
+
+def run(*args, **kwargs):
+    """Runs a command and returns its output, failing loudly."""
+
+    process = subprocess.Popen(args, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, **kwargs)
+    stdout, stderr = process.communicate()
+    if process.returncode:
+        raise OSError("%s failed: %s" % (' '.join(args), stderr.strip()))
+    return stdout
+
+
+class Repository(object):
+    """A Subversion repository with a working copy to commit from."""
+
+    def __init__(self, path, work_dir):
+        self.path = path
+        self.url = 'file://' + os.path.abspath(path)
+        self.wc = os.path.join(work_dir, 'wc')
+        run('svnadmin', 'create', path)
+        run('svn', 'checkout', '--quiet', self.url, self.wc)
+
+    def svn(self, *args):
+        return run('svn', *args, cwd=self.wc)
+
+    def write(self, relpath, data):
+        path = os.path.join(self.wc, relpath)
+        exists = os.path.exists(path)
+        with open(path, 'w') as fileobj:
+            fileobj.write(data)
+        if not exists:
+            self.svn('add', '--quiet', relpath)
+
+    def commit(self, message):
+        self.svn('commit', '--quiet', '-m', message)
+        self.svn('update', '--quiet')
+        return youngest_revision(self.path)
+
+
+def build_history(repos):
+    """Commits the history shared by every chain and returns the base
+    revision of the chains."""
+
+    repos.svn('mkdir', '--quiet', 'trunk', 'branches', 'tags')
+    repos.write('trunk/README', 'first\n')
+    repos.commit('layout')
+    repos.write('trunk/README', 'second\n')
+    repos.write('trunk/moved.txt', 'move me\n')
+    repos.commit('edit')
+    repos.svn('copy', '--quiet', 'trunk', 'branches/feature')
+    repos.commit('branch')
+    repos.svn('copy', '--quiet', 'trunk', 'tags/1.0')
+    repos.commit('tag')
+    repos.svn('move', '--quiet', 'trunk/moved.txt', 'trunk/renamed.txt')
+    repos.write('branches/feature/README', 'feature\n')
+    return repos.commit('move and branch work')
+
+
+def first_increment(repos, base_revision):
+    """Commits the revisions of the first incremental archive: copies from
+    revisions before the base and a merge across it."""
+
+    repos.svn('copy', '--quiet', '%s/trunk@%s' % (repos.url, base_revision - 2),
+              '%s/tags/0.9' % repos.url, '-m', 'late tag of an old revision')
+    repos.svn('update', '--quiet')
+    repos.svn('merge', '--quiet', '^/branches/feature', 'trunk')
+    return repos.commit('merge feature')
+
+
+def second_increment(repos, base_revision):
+    """Commits the revisions of the second incremental archive."""
+
+    repos.svn('copy', '--quiet', '%s/branches/feature@%s' % (repos.url, base_revision),
+              '%s/branches/feature-old' % repos.url, '-m', 'branch of an old branch')
+    repos.svn('update', '--quiet')
+    repos.svn('move', '--quiet', 'tags/1.0', 'tags/1.0-final')
+    repos.write('branches/feature/README', 'feature, again\n')
+    return repos.commit('retag and branch work')
+
+
+def describe(repo_path, revision):
+    """Returns what revision of repo_path holds, for comparisons."""
+
+    try:
+        # only trunk has anything merged into it
+        mergeinfo = run('svnlook', 'propget', '-r', str(revision), repo_path,
+                        'svn:mergeinfo', 'trunk')
+    except OSError:
+        mergeinfo = None
+    return (run('svnlook', 'tree', '--full-paths', '-r', str(revision), repo_path),
+            run('svnlook', 'changed', '--copy-info', '-r', str(revision), repo_path),
+            mergeinfo)
+
+
+def check_chain(source_path, archives, target_path):
+    """Loads archives into a new repository at target_path, one load per
+    archive, and compares every revision with source_path. Returns the
+    load statistics, and a list of the revisions which differ."""
+
+    run('svnadmin', 'create', target_path)
+    loads = list()
+    for archive_path in archives:
+        stats = load_archive(archive_path, target_path)
+        if stats['returncode']:
+            raise OSError("Loading %s failed: %s" % (archive_path, stats['stderr'].strip()))
+        loads.append(stats)
+
+    youngest = youngest_revision(target_path)
+    differences = [revision for revision in xrange(youngest + 1)
+                   if describe(source_path, revision) != describe(target_path, revision)]
+    if youngest != youngest_revision(source_path):
+        differences.append('youngest')
+    return loads, differences
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--codec', default='gzip', choices=CODECS,
+                      help='codec the archives are compressed with [%default]')
+    options, args = parser.parse_args()
+    if not codec_available(options.codec):
+        parser.error("%s is not installed" % options.codec)
+
+    work_dir = tempfile.mkdtemp(prefix='bench-archive-chain-')
+    failed = False
+    try:
+        repos = Repository(os.path.join(work_dir, 'source'), work_dir)
+        archives = list()
+
+        def dump(base_revision):
+            archive_path = os.path.join(work_dir, 'chain%s.dump.gz' % len(archives))
+            if options.codec == 'zstd':
+                archive_path = archive_path[:-3] + '.zst'
+            revision = youngest_revision(repos.path)
+            stats = dump_archive(repos.path, archive_path, options.codec,
+                                 revision=revision, base_revision=base_revision,
+                                 history=True)
+            if stats['returncode']:
+                raise OSError("Dumping %s failed: %s" % (repos.path, stats['stderr'].strip()))
+            print "dumped r%s:%s in %.2fs (%.1f MB/s)" % (
+                0 if base_revision is None else base_revision + 1, revision,
+                stats['seconds'], throughput(stats))
+            archives.append(archive_path)
+            return revision
+
+        build_history(repos)
+        base_revision = dump(None)
+        first_revision = first_increment(repos, base_revision)
+        dump(base_revision)
+        # the 2 link chain is checked against the repository as it was
+        two_link_path = os.path.join(work_dir, 'two-links')
+        snapshot_path = os.path.join(work_dir, 'source-r%s' % first_revision)
+        shutil.copytree(repos.path, snapshot_path)
+        second_increment(repos, base_revision)
+        dump(first_revision)
+
+        for name, target_path, source_path, chain in (
+                ('2 link chain', two_link_path, snapshot_path, archives[:2]),
+                ('3 link chain', os.path.join(work_dir, 'three-links'), repos.path, archives)):
+            loads, differences = check_chain(source_path, chain, target_path)
+            print "%s loaded in %s" % (name, ', '.join("%.2fs (%.1f MB/s)" % (
+                stats['seconds'], throughput(stats)) for stats in loads))
+            if differences:
+                failed = True
+                print "%s differs from the source repository at %s" % (
+                    name, ', '.join(map(str, differences)))
+            else:
+                print "%s matches the source repository" % name
+    finally:
+        shutil.rmtree(work_dir)
+    sys.exit(failed and 1 or 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Minimal stand-ins for the #define plugins the template code imports.
+
+The admin and importer modules import LogicaOrderController,
+SimplifiedPermissions, Mailinglist, RemoteTicketSystem and the XML-RPC
+plugin at module level. Benchmarks only need those imports to succeed,
+so install() registers small fake modules for any plugin which is not
+installed in the current Python environment. The names of the modules it
+replaced are kept in INSTALLED.
+"""
+
+import imp
+import sys
+
+from trac.core import Component, Interface
+
+
+class LogicaOrderController(Component):
+
+    def _serialize_ticket_type(self, ticket_type):
+        return '{"name": "%s"}' % ticket_type
+
+    def _import_ticket_type(self, data, dry_run=False):
+        pass
+
+
+class SimplifiedPermissions(Component):
+
+    groups = []
+    domains = []
+
+    def _new_group(self, sid, name, description=None):
+        pass
+
+
+class Group(object):
+
+    def __init__(self, env, sid):
+        self.sid = sid
+        self.label = sid
+        self.description = None
+        self.external_group = False
+
+    def __unicode__(self):
+        return self.sid
+
+
+class Mailinglist(object):
+
+    def __init__(self, env, **kwargs):
+        self.__dict__.update(kwargs)
+
+    @classmethod
+    def select(cls, env):
+        return []
+
+    def insert(self):
+        pass
+
+
+class RemoteTicketSystem(object):
+
+    PROJECTID_RE = r'^[a-zA-Z0-9]+(-[a-zA-Z0-9]+)*$'
+
+
+class IXMLRPCHandler(Interface):
+    pass
+
+
+STANDINS = {
+    'logicaordertracker.controller': {
+        'LogicaOrderController': LogicaOrderController},
+    'simplifiedpermissionsadminplugin.model': {'Group': Group},
+    'simplifiedpermissionsadminplugin.simplifiedpermissions': {
+        'SimplifiedPermissions': SimplifiedPermissions},
+    'mailinglistplugin.model': {'Mailinglist': Mailinglist},
+    'tracremoteticket.web_ui': {'RemoteTicketSystem': RemoteTicketSystem},
+    'tracrpc.api': {'IXMLRPCHandler': IXMLRPCHandler},
+}
+
+
+INSTALLED = set()
+
+
+def install():
+    """Registers a stand-in for every plugin module we can't import."""
+
+    for module_name, attributes in STANDINS.iteritems():
+        try:
+            __import__(module_name)
+            continue
+        except ImportError:
+            pass
+        package_name = module_name.split('.')[0]
+        if package_name not in sys.modules:
+            sys.modules[package_name] = imp.new_module(package_name)
+        module = imp.new_module(module_name)
+        module.__dict__.update(attributes)
+        sys.modules[module_name] = module
+        setattr(sys.modules[package_name], module_name.split('.')[1], module)
+        INSTALLED.add(module_name)
@@ -0,0 +1,394 @@
+"""Times every export and import step of a project template.
+
+Creates a throwaway SQLite backed environment filled with a configurable
+amount of synthetic data (wiki pages, attachments, milestones, components,
+groups and permissions), exports it into a template one
+GenerateTemplate.export_* method at a time, and then imports the template
+into fresh copies of an empty environment one ImportTemplate.import_*
+method at a time, followed by the complete template_populate() and
+import_template() runs.
+
+Each step runs in a forked child process, so its peak RSS isn't hidden by
+the steps before it. For every step we record the wall time, the peak RSS
+of the child, the growth of its RSS while the step ran, and the number of
+execute() and executemany() calls made on database cursors. Steps which
+raise are recorded with their error and the run carries on - without the
+#define fork of Trac, export_milestones() fails for example.
+
+The results are written as JSON, so runs of different releases can be
+compared:
+
+    python -m benchmarks.template_roundtrip --pages 5000 --output before.json
+"""
+
+import inspect
+import json
+import optparse
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+from benchmarks import standins
+standins.install()
+
+import trac
+from trac.db.util import IterableCursor
+from trac.env import Environment
+from trac.util.datefmt import to_utimestamp, utc
+
+from datetime import datetime
+
+TEMPLATE_NAME = 'benchmark'
+
+
+def create_environment(path, template_dir, options=None, template_format='xml'):
+    """Creates an environment at path using template_dir as its project
+    template directory, writing templates in template_format. If options
+    is given it is filled with synthetic data of the sizes given there."""
+
+    env = Environment(path, create=True,
+                      options=[('trac', 'database', 'sqlite:db/trac.db'),
+                               ('trac', 'repository_dir', ''),
+                               ('components', 'createtemplate.*', 'enabled'),
+                               ('project_templates', 'template_dir', template_dir),
+                               ('project_templates', 'background_jobs', 'false'),
+                               ('project_templates', 'template_format', template_format)])
+
+    if 'simplifiedpermissionsadminplugin.simplifiedpermissions' in standins.INSTALLED:
+        # import_groups() clears the table the real plugin keeps groups in
+        @env.with_transaction()
+        def create_groups_table(db):
+            cursor = db.cursor()
+            cursor.execute("""CREATE TABLE groups (sid text PRIMARY KEY, name text,
+                                                   description text)""")
+
+    if options is not None:
+        fill_environment(env, options)
+    return env
+
+
+def fill_environment(env, options):
+    """Inserts the synthetic data described by options into env."""
+
+    from createtemplate.files import attachment_relpath
+
+    now = to_utimestamp(datetime.now(utc))
+    text = 'x' * options.page_size
+    groups = ['group%03d' % i for i in xrange(options.groups)]
+
+    @env.with_transaction()
+    def insert_data(db):
+        cursor = db.cursor()
+        cursor.execute("DELETE FROM wiki")
+        cursor.executemany("""INSERT INTO wiki (name, version, time, author,
+                                                ipnr, text, comment, readonly)
+                              VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+                           [('BenchPage%05d' % i, version, now, 'bench',
+                             '127.0.0.1', text, '', 0)
+                            for i in xrange(options.pages) for version in (1, 2)])
+        cursor.executemany("""INSERT INTO attachment (type, id, filename, size, time,
+                                                      description, author, ipnr)
+                              VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+                           [('wiki', 'BenchPage%05d' % (i % max(options.pages, 1)),
+                             'file %05d.bin' % i, options.attachment_size, now,
+                             'Attachment %d' % i, 'bench', '127.0.0.1')
+                            for i in xrange(options.attachments)])
+        cursor.execute("DELETE FROM milestone")
+        cursor.executemany("""INSERT INTO milestone (name, due, completed, description)
+                              VALUES (%s, %s, %s, %s)""",
+                           [('milestone%04d' % i, now, 0, 'Milestone %d' % i)
+                            for i in xrange(options.milestones)])
+        cursor.execute("DELETE FROM component")
+        cursor.executemany("""INSERT INTO component (name, owner, description)
+                              VALUES (%s, %s, %s)""",
+                           [('component%04d' % i, 'bench', 'Component %d' % i)
+                            for i in xrange(options.components)])
+        cursor.execute("DELETE FROM permission")
+        cursor.executemany("""INSERT INTO permission (username, action)
+                              VALUES (%s, %s)""",
+                           [(group, 'BENCH_ACTION_%03d' % i)
+                            for group in groups for i in xrange(options.permissions)])
+
+    # the stand-in has no storage of its own, so we just tell it the groups
+    standins.SimplifiedPermissions.groups = groups
+
+    data = 'a' * options.attachment_size
+    attachment_dir = os.path.join(env.path, 'attachments', 'wiki')
+    for i in xrange(options.attachments):
+        path = os.path.join(attachment_dir,
+                            attachment_relpath('BenchPage%05d' % (i % max(options.pages, 1)),
+                                               'file %05d.bin' % i))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    workflow_dir = os.path.join(env.path, 'workflows')
+    os.mkdir(workflow_dir)
+    for i in xrange(options.workflows):
+        with open(os.path.join(workflow_dir, 'workflow%02d.xml' % i), 'w') as f:
+            f.write('<workflow name="workflow%02d"/>' % i)
+
+
+class QueryCounter(object):
+    """Counts the execute() and executemany() calls made on Trac cursors
+    while it is active."""
+
+    def __init__(self):
+        self.queries = 0
+        self.executemany = 0
+
+    def __enter__(self):
+        self._execute = IterableCursor.execute
+        self._executemany = IterableCursor.executemany
+        counter = self
+
+        def execute(cursor, sql, args=None):
+            counter.queries += 1
+            return counter._execute(cursor, sql, args)
+
+        def executemany(cursor, sql, args):
+            counter.executemany += 1
+            return counter._executemany(cursor, sql, args)
+
+        IterableCursor.execute = execute
+        IterableCursor.executemany = executemany
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        IterableCursor.execute = self._execute
+        IterableCursor.executemany = self._executemany
+
+
+def current_rss():
+    """Returns the resident set size of this process in kB."""
+
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(name, env_path, step):
+    """Runs step(env) in a forked child process on the environment at
+    env_path, and returns a dictionary with its measurements."""
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        result = {'name': name}
+        try:
+            env = Environment(env_path)
+            env.get_read_db()
+            result['rss_start_kb'] = current_rss()
+            with QueryCounter() as counter:
+                start = time.time()
+                try:
+                    step(env)
+                    result['status'] = 'ok'
+                except Exception:
+                    result['status'] = 'error'
+                    result['error'] = traceback.format_exc().strip().splitlines()[-1]
+                result['seconds'] = round(time.time() - start, 4)
+            result['queries'] = counter.queries
+            result['executemany'] = counter.executemany
+            result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            result['rss_growth_kb'] = max(current_rss() - result['rss_start_kb'], 0)
+        except Exception:
+            result['status'] = 'error'
+            result['error'] = traceback.format_exc().strip().splitlines()[-1]
+        with os.fdopen(write_fd, 'w') as f:
+            f.write(json.dumps(result))
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        output = f.read()
+    os.waitpid(pid, 0)
+    try:
+        return json.loads(output)
+    except ValueError:
+        return {'name': name, 'status': 'error', 'error': 'benchmark process died'}
+
+
+def export_steps(template_path, archive):
+    """Returns the (name, step) pairs which create the template."""
+
+    from createtemplate.admin import GenerateTemplate
+
+    def call(method, *args):
+        return lambda env: getattr(GenerateTemplate(env), method)(*args)
+
+    steps = [
+        ('export_wiki_pages', call('export_wiki_pages', template_path)),
+        ('export_wiki_attachments', call('export_wiki_attachments', None, TEMPLATE_NAME)),
+        ('export_ticket_types', call('export_ticket_types', template_path)),
+        ('export_workflows', call('export_workflows', None, template_path)),
+        ('export_priorites', call('export_priorites', template_path)),
+        ('export_versions', call('export_versions', template_path)),
+        ('export_components', call('export_components', template_path)),
+        ('export_groups_and_permissions', call('export_groups_and_permissions',
+                                               template_path)),
+        ('export_mailinglists', call('export_mailinglists', template_path)),
+        ('export_milestones', call('export_milestones', template_path)),
+        ('create_template_info_file', call('create_template_info_file', TEMPLATE_NAME,
+                                           template_path, 'bench', 'Benchmark template')),
+    ]
+    components = ['wiki', 'ticket', 'group', 'list', 'milestone']
+    if archive:
+        steps.append(('export_file_archive', call('export_file_archive', None,
+                                                  template_path)))
+        components.append('archive')
+    # and all of them again, the way the admin panel does it
+    steps.append(('export_template', call('export_template', None, TEMPLATE_NAME,
+                                          template_path, components)))
+    return steps
+
+
+def import_steps(template_path, archive):
+    """Returns the (name, step) pairs which import the template."""
+
+    from createtemplate.importer import ImportTemplate
+
+    def call(method, *args):
+        return lambda env: getattr(ImportTemplate(env), method)(*args)
+
+    def import_perms(env):
+        # import_groups() hands over the permissions it read with the groups
+        importer = ImportTemplate(env)
+        perm_data = [perm for group in importer.template_reader(template_path).groups()
+                     for perm in group.perms]
+        return importer.import_perms(perm_data)
+
+    steps = [
+        ('import_wiki_pages', call('import_wiki_pages', template_path)),
+        ('import_wiki_attachments', call('import_wiki_attachments', template_path)),
+        ('import_groups', call('import_groups', template_path)),
+        ('import_perms', import_perms),
+        ('import_milestones', call('import_milestones', template_path)),
+        ('import_versions', call('import_versions', template_path)),
+        ('import_components', call('import_components', template_path)),
+        ('import_enum', call('import_enum', template_path, ['priority', 'ticket_type'])),
+        ('import_ticket_types', call('import_ticket_types', template_path)),
+        ('import_workflows', call('import_workflows', template_path)),
+        ('import_mailinglist', call('import_mailinglist', template_path)),
+        ('import_version_data', call('import_version_data', template_path)),
+        ('plan_import', call('plan_import', template_path)),
+        ('template_populate', call('template_populate', template_path)),
+        ('import_template', call('import_template', template_path)),
+    ]
+    if archive:
+        steps.append(('import_file_archive', call('import_file_archive', template_path)))
+    return steps
+
+
+def skipped_steps(measured):
+    """Returns a result for every export_* and import_* method which the
+    benchmark didn't run, so new methods don't go unnoticed."""
+
+    from createtemplate.admin import GenerateTemplate
+    from createtemplate.importer import ImportTemplate
+
+    names = [name for cls, prefix in ((GenerateTemplate, 'export_'),
+                                      (ImportTemplate, 'import_'))
+             for name in sorted(dir(cls))
+             if name.startswith(prefix) and inspect.ismethod(getattr(cls, name))]
+    return [{'name': name, 'status': 'skipped'} for name in names
+            if name not in measured]
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--pages', type='int', default=1000,
+                      help='number of wiki pages to create [%default]')
+    parser.add_option('--page-size', type='int', default=2000,
+                      help='size of each wiki page in bytes [%default]')
+    parser.add_option('--attachments', type='int', default=200,
+                      help='number of wiki attachments to create [%default]')
+    parser.add_option('--attachment-size', type='int', default=64 * 1024,
+                      help='size of each attachment in bytes [%default]')
+    parser.add_option('--milestones', type='int', default=50,
+                      help='number of milestones to create [%default]')
+    parser.add_option('--components', type='int', default=50,
+                      help='number of components to create [%default]')
+    parser.add_option('--groups', type='int', default=20,
+                      help='number of groups to create [%default]')
+    parser.add_option('--permissions', type='int', default=20,
+                      help='number of permissions per group [%default]')
+    parser.add_option('--workflows', type='int', default=5,
+                      help='number of workflow files to create [%default]')
+    parser.add_option('--archive', action='store_true', default=False,
+                      help='also time export_file_archive and import_file_archive, '
+                           'which need svnadmin and a Subversion repository')
+    parser.add_option('--format', default='xml', choices=['xml', 'jsonl'],
+                      help='format the template tables are written in [%default]')
+    parser.add_option('--output', default='-',
+                      help='file to write the JSON results to [stdout]')
+    options, args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='bench-template-')
+    try:
+        template_dir = os.path.join(work_dir, 'templates')
+        template_path = os.path.join(template_dir, TEMPLATE_NAME)
+        os.makedirs(template_path)
+
+        source_path = os.path.join(work_dir, 'source')
+        create_environment(source_path, template_dir, options, options.format).shutdown()
+        empty_path = os.path.join(work_dir, 'empty')
+        create_environment(empty_path, template_dir).shutdown()
+
+        results = list()
+        for name, step in export_steps(template_path, options.archive):
+            results.append(measure(name, source_path, step))
+            print >> sys.stderr, "%(name)-32s %(status)s" % results[-1]
+
+        for name, step in import_steps(template_path, options.archive):
+            # every import starts from an untouched environment
+            target_path = os.path.join(work_dir, 'target')
+            shutil.copytree(empty_path, target_path)
+            try:
+                results.append(measure(name, target_path, step))
+            finally:
+                shutil.rmtree(target_path)
+            print >> sys.stderr, "%(name)-32s %(status)s" % results[-1]
+
+        results.extend(skipped_steps([result['name'] for result in results]))
+        template_size = sum(os.path.getsize(os.path.join(dirpath, filename))
+                            for dirpath, dirnames, filenames in os.walk(template_path)
+                            for filename in filenames)
+        report = {
+            'created': datetime.now(utc).isoformat(),
+            'python': platform.python_version(),
+            'trac': trac.__version__,
+            'standins': sorted(standins.INSTALLED),
+            'format': options.format,
+            'template_bytes': template_size,
+            'sizes': dict((key, getattr(options, key)) for key in
+                          ('pages', 'page_size', 'attachments', 'attachment_size',
+                           'milestones', 'components', 'groups', 'permissions',
+                           'workflows')),
+            'steps': results,
+        }
+    finally:
+        shutil.rmtree(work_dir)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output == '-':
+        print output
+    else:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Compares the per-page and batched query wiki export paths.
+
+Creates a throwaway SQLite backed environment filled with synthetic
+wiki pages, then times how long it takes to load every page through
+WikiPage objects (the old export path) against the batched queries used
+by GenerateTemplate.get_latest_wiki_pages(), which read the latest
+version of wiki_export_batch_size pages at a time, and finally times a
+complete export_wiki_pages() run.
+
+    python -m benchmarks.wiki_export --pages 10000
+"""
+
+import optparse
+import shutil
+import tempfile
+import time
+
+from benchmarks import standins
+standins.install()
+
+from trac.env import Environment
+from trac.wiki.api import WikiSystem
+from trac.wiki.model import WikiPage
+from trac.util.datefmt import to_utimestamp, utc
+
+from datetime import datetime
+
+
+def create_environment(path, pages, page_size):
+    """Creates an environment at path with the requested number of wiki
+    pages, each with two versions so the latest version lookup has 
+    some work to do."""
+
+    env = Environment(path, create=True,
+                      options=[('trac', 'database', 'sqlite:db/trac.db'),
+                               ('components', 'createtemplate.*', 'enabled'),
+                               ('components', 'benchmarks.*', 'enabled')])
+    now = to_utimestamp(datetime.now(utc))
+    text = 'x' * page_size
+
+    @env.with_transaction()
+    def insert_pages(db):
+        cursor = db.cursor()
+        cursor.execute("DELETE FROM wiki")
+        cursor.executemany("""INSERT INTO wiki (name, version, time, author,
+                                                ipnr, text, comment, readonly)
+                              VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+                           [('BenchPage%05d' % i, version, now, 'bench',
+                             '127.0.0.1', text, '', 0)
+                            for i in xrange(pages) for version in (1, 2)])
+    return env
+
+
+def legacy_load(env):
+    """The old export path - one WikiPage object (and query) per page."""
+
+    return [WikiPage(env, name) for name in WikiSystem(env).get_pages()]
+
+
+def bulk_load(env):
+    """The new export path - one query for the latest version of each 
+    batch of wiki_export_batch_size pages."""
+
+    from createtemplate.admin import GenerateTemplate
+    return list(GenerateTemplate(env).get_latest_wiki_pages())
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--pages', type='int', default=10000,
+                      help='number of wiki pages to create [%default]')
+    parser.add_option('--page-size', type='int', default=2000,
+                      help='size of each wiki page in bytes [%default]')
+    options, args = parser.parse_args()
+
+    from createtemplate.admin import GenerateTemplate
+
+    env_path = tempfile.mkdtemp(prefix='bench-env-')
+    template_path = tempfile.mkdtemp(prefix='bench-template-')
+    try:
+        env = create_environment(env_path, options.pages, options.page_size)
+
+        # reset the page name cache so both paths start cold
+        del WikiSystem(env).pages
+        legacy_time, legacy = timed(legacy_load, env)
+        bulk_time, bulk = timed(bulk_load, env)
+        assert len(legacy) == len(bulk) == options.pages
+        export_time, exported = timed(GenerateTemplate(env).export_wiki_pages,
+                                      template_path)
+
+        print "pages:                 %d" % options.pages
+        print "per-page WikiPage:     %.3fs" % legacy_time
+        print "batched queries:       %.3fs" % bulk_time
+        print "speed up:              %.1fx" % (legacy_time / max(bulk_time, 1e-6))
+        print "export_wiki_pages():   %.3fs (%d pages)" % (export_time,
+                                                          len(exported))
+    finally:
+        shutil.rmtree(env_path)
+        shutil.rmtree(template_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,36 +2,37 @@ import pkg_resources
 import os
 import datetime
 import shutil
-import subprocess
 import errno
-import gzip
 import re
 import json
 from operator import itemgetter
 from itertools import groupby
-# cElementTree is C implementation and faster
-# http://eli.thegreenplace.net/2012/03/15/processing-xml-in-python-with-elementtree/
-try:
-    import xml.etree.cElementTree as ET
-except ImportError:
-    import xml.etree.ElementTree as ET
 
 from trac.core import *
-from trac.web.chrome import ITemplateProvider, add_script, add_notice, add_script_data
+from trac.web.chrome import ITemplateProvider, add_script, add_notice, add_script_data, add_warning
 from trac.admin.api import IAdminPanelProvider
-from trac.wiki.model import WikiPage
-from trac.wiki.api import WikiSystem
 from trac.ticket import model
 from logicaordertracker.controller import LogicaOrderController
-from trac.perm import DefaultPermissionStore, IPermissionRequestor, PermissionSystem
+from trac.perm import DefaultPermissionStore, IPermissionRequestor
 from trac.ticket import Priority
-from trac.attachment import Attachment
-from trac.config import PathOption
+from trac.config import BoolOption, ChoiceOption, IntOption, PathOption
+from trac.resource import ResourceNotFound
 
 from simplifiedpermissionsadminplugin.model import Group
 from simplifiedpermissionsadminplugin.simplifiedpermissions import SimplifiedPermissions
 from mailinglistplugin.model import Mailinglist
 from createtemplate.api import ProjectTemplateAPI
+from createtemplate.archive import (CODECS, archive_filename, codec_available, 
+                                    dump_archive, throughput, youngest_revision)
+from createtemplate.blobstore import BlobStore, update_manifest
+from createtemplate.jobs import TemplateJobSystem
+from createtemplate.files import attachment_path, attachment_relpath, copy_file
+from createtemplate.packed import PACKED_EXTENSION, pack_template
+from createtemplate.templateio import (TEMPLATE_FORMATS, AttachmentRecord, ComponentRecord,
+                                       GroupRecord, MailinglistRecord, MilestoneRecord,
+                                       PriorityRecord, TemplateWriter, TicketTypeRecord,
+                                       VersionRecord, WikiPageRecord)
+from createtemplate.workers import run_tasks
 from tracremoteticket.web_ui import RemoteTicketSystem 
 
 # Author: Danny Milsom <danny.milsom@cgi.com>
@@ -42,6 +43,97 @@ class GenerateTemplate(Component):
     template_dir_path = PathOption('project_templates', 'template_dir',
                     doc="The default path for the project template directory")
 
+    # reflink comes first, so it is the default
+    copy_strategy = ChoiceOption('project_templates', 'copy_strategy', 
+                    ('reflink', 'copy', 'hardlink'),
+                    doc="""How attachment files are copied between projects and
+                    templates. `reflink` makes a copy-on-write clone on 
+                    filesystems which support it (e.g. btrfs, XFS), `copy` 
+                    copies the data and `hardlink` shares the file without 
+                    copying any data. If a strategy can't be used we fall 
+                    back to the next one of `hardlink`, `reflink` and `copy`,
+                    so by default attachments are copied where they can't be
+                    cloned. With `hardlink` a project, its templates and the 
+                    projects created from them all share the same files, so 
+                    a file changed in one of them changes in all of them - 
+                    only choose it if nothing changes attachment files in 
+                    place.""")
+
+    blob_store = BoolOption('project_templates', 'blob_store', 'false',
+                    doc="""Store the attachments and workflows of new templates
+                    once in a shared, content addressed blob store inside the 
+                    template directory, rather than giving every template its 
+                    own copy. Run `trac-admin $ENV template gc` to remove blobs
+                    which no template refers to any more.""")
+
+    wiki_export_batch_size = IntOption('project_templates', 'wiki_export_batch_size', 100,
+                    doc="""Number of wiki pages read from the database with 
+                    each query when exporting the wiki into a template. Most
+                    database drivers hold every row of a query in memory, so 
+                    this bounds the memory an export of a large wiki takes.""")
+
+    export_threads = IntOption('project_templates', 'export_threads', 4,
+                    doc="""Number of template components which are exported at
+                    the same time when creating a template.""")
+
+    background_jobs = BoolOption('project_templates', 'background_jobs', 'false',
+                    doc="""Create templates in a background job rather than 
+                    while the admin page request waits. The page shows the 
+                    progress of the job instead. Jobs are kept in their own 
+                    tables, so after turning this on the environment has to 
+                    be upgraded with `trac-admin $ENV upgrade`.""")
+
+    archive_codec = ChoiceOption('project_templates', 'archive_codec', CODECS,
+                    doc="""How the Subversion dump of a template is compressed.
+                    `gzip` compresses it in the Trac process, `pigz` uses the
+                    multi-threaded pigz program (its output is still a .gz 
+                    file) and `zstd` uses zstd, which compresses much faster.
+                    If pigz or zstd isn't installed we fall back to `gzip`.""")
+
+    archive_compression_level = IntOption('project_templates', 'archive_compression_level', 9,
+                    doc="""Compression level of the Subversion dump, 1 to 9 for
+                    gzip and pigz and 1 to 19 for zstd. Lower levels compress
+                    faster but make larger archives.""")
+
+    archive_threads = IntOption('project_templates', 'archive_threads', 0,
+                    doc="""Number of threads pigz and zstd use to compress the
+                    Subversion dump, 0 meaning one per CPU core.""")
+
+    incremental_archives = BoolOption('project_templates', 'incremental_archives', 'false',
+                    doc="""Rather than dumping the whole Subversion repository
+                    into every template, only dump the revisions made since the
+                    last template created from the project and load that 
+                    template's archive first when importing. The first 
+                    archive of a chain holds the whole history of the 
+                    repository, so revision numbers are kept. Templates which
+                    others build on must not be removed.""")
+
+    archive_max_chain = IntOption('project_templates', 'archive_max_chain', 10,
+                    doc="""Maximum number of archives in a chain of incremental
+                    archives. Once a chain is this long the next template gets
+                    a full dump again, which bounds the time it takes to import
+                    a template.""")
+
+    template_format = ChoiceOption('project_templates', 'template_format', TEMPLATE_FORMATS,
+                    doc="""The format new templates store their tables in. `xml`
+                    writes an XML file per table, which is what older releases
+                    can read. `jsonl` writes gzip compressed JSON lines, which
+                    are much smaller and quicker to import, in particular for 
+                    ticket types. Templates of either format can be imported.""")
+
+    packed_templates = BoolOption('project_templates', 'packed_templates', 'false',
+                    doc="""Pack each new template into a single uncompressed
+                    tar file, `<name>.tar`, with a manifest at its start, 
+                    rather than leaving it as a directory of many small files.
+                    Packed templates are much quicker to copy between servers
+                    and are imported without unpacking them. Their attachments
+                    and workflows are packed too, so they don't use the blob
+                    store. The template is exported into a directory first
+                    and then packed, so the template directory needs room
+                    for the template twice while it is being created, and
+                    every file, including the Subversion dump, is written
+                    twice.""")
+
     implements(IPermissionRequestor, IAdminPanelProvider, ITemplateProvider)
 
     # IPermissionRequestor methods
@@ -69,15 +161,9 @@ class GenerateTemplate(Component):
             add_script_data(req, { 'usedNames':all_templates })
 
             # find templates for this project and place them into data dict
-            # as a list of dicts so we can display on page
-            templates = []
-            for template in all_templates:
-                template_data = template_api.get_template_information(template)
-                if template_data.get('project') == self.env.project_name:
-                    templates.append(template_data)
-
-            # sort template order based on created date
-            templates = sorted(templates, key=itemgetter('created'))
+            # as a list of dicts so we can display on page, sorted based on 
+            # created date
+            templates = template_api.get_project_templates(self.env.project_name)
 
             data = {
                     'name': self.env.project_name, 
@@ -118,6 +204,9 @@ class GenerateTemplate(Component):
                 # we can catch this on client side with JS too
                 template_path = os.path.join(self.template_dir_path, template_name)
                 try:
+                    if template_name in all_templates:
+                        # a packed template doesn't have a directory
+                        raise OSError(errno.EEXIST, "Template %s exists" % template_name)
                     os.mkdir(template_path)
                     self.log.debug("Created directory for project template at", template_path)
                 except OSError as exception:
@@ -131,32 +220,25 @@ class GenerateTemplate(Component):
                 # so far so good
                 # we now call functions which create the XML template files
                 # and append that data to a data dict we return to the template
-                if 'template_components' in req.args:
-                    options = req.args['template_components']
-
-                    if 'wiki' in options:
-                        data['wiki_pages'] = self.export_wiki_pages(template_path)
-                        data['attachments'] = self.export_wiki_attachments(req, template_name)
-                    if 'ticket' in options:
-                        data['ticket_types'] = self.export_ticket_types(template_path)
-                        data['workflows'] = self.export_workflows(req, template_path)
-                        # we export priority, version and components if we export tickets
-                        data['priority'] = self.export_priorites(template_path)
-                        data['versions'] = self.export_versions(template_path)
-                        data['components'] = self.export_components(template_path)
-                    if 'archive' in options:
-                        data['repos'] = self.export_file_archive(req, os.path.join(template_path, template_name + '.dump.gz'))
-                    if 'group' in options:
-                        # we import the group perms as part of the group export
-                        data['groups'] = self.export_groups_and_permissions(template_path)
-                    if 'list' in options:
-                        data['lists'] = self.export_mailinglists(template_path)
-                    if 'milestone' in options:
-                        data['milestones'] = self.export_milestones(template_path)
-
-                # create an info file to store the exact time of template
-                # creation, username of template creator etc.
-                self.create_template_info_file(req, template_name, template_path)
+                options = req.args.get('template_components', [])
+                if isinstance(options, basestring):
+                    options = [options]
+
+                if self.background_jobs:
+                    # creating the template can take several minutes, so we
+                    # queue a job and let the page poll for its progress
+                    job_id = TemplateJobSystem(self.env).submit(template_name, template_path,
+                                                                req.authname,
+                                                                req.args['description'],
+                                                                options)
+                    add_script_data(req, {'jobStatusUrl': req.href.templates('jobs', job_id)})
+                    data.update({'job_id': job_id,
+                                 'template_name': template_name,
+                                 })
+                    return 'template_admin.html', data
+
+                data.update(self.create_template(req, template_name, template_path, options,
+                                                 req.authname, req.args['description']))
 
                 data.update({'success':True,
                              'template_name':template_name,
@@ -168,49 +250,174 @@ class GenerateTemplate(Component):
 
             return 'template_admin.html', data
 
+    def create_template(self, req, template_name, template_path, options, author,
+                        description, progress=None):
+        """Exports the selected components into the template directory and
+        writes its info file. With [project_templates] packed_templates the
+        directory is then packed into a packed template and removed. Returns
+        the results of export_template().
+
+        This is run by the admin panel itself or by a background job, in 
+        which case req is None. If creating the template fails the template
+        directory is removed, so the name can be used again."""
+
+        archive = dict()
+        try:
+            results = self.export_template(req, template_name, template_path, options,
+                                           progress=progress, archive=archive)
+
+            # create an info file to store the exact time of template
+            # creation, username of template creator etc.
+            self.create_template_info_file(template_name, template_path, author,
+                                           description, archive=archive or None)
+        except:
+            self.log.error("Unable to create template %s, removing %s", template_name,
+                           template_path)
+            shutil.rmtree(template_path, ignore_errors=True)
+            raise
+
+        if self.packed_templates:
+            self.pack_template(template_name, template_path)
+
+        return results
+
+    def pack_template(self, template_name, template_path):
+        """Packs the template directory at template_path into a packed 
+        template next to it and removes the directory. The directory is 
+        left alone if packing fails."""
+
+        template_api = ProjectTemplateAPI(self.env)
+        info = template_api.get_template_information(template_name)
+        components = info.pop('components', [])
+        packed_path = os.path.normpath(template_path) + PACKED_EXTENSION
+        try:
+            count = pack_template(template_path, packed_path, info, components)
+        except (IOError, OSError, ValueError) as exception:
+            self.log.error("Unable to pack template %s into %s due to %s",
+                           template_name, packed_path, exception)
+            return
+        self.log.info("Packed %s files of template %s into %s", count, template_name,
+                      packed_path)
+
+        shutil.rmtree(template_path)
+        template_api.update_index(template_name)
+
+    def export_template(self, req, template_name, template_path, options, progress=None,
+                        archive=None):
+        """Exports the selected components of the project into the template
+        directory and returns a dictionary with the result of each export.
+        If archive is given it is updated with the statistics of the file
+        archive export, see export_file_archive().
+
+        The exports are independent of each other, so rather than running 
+        them one after another we run them on a bounded pool of threads. 
+        This way slow I/O bound exports like the Subversion dump and the 
+        attachment copy overlap with the XML exports, and creating a
+        template takes about as long as the slowest export. A failing 
+        export is reported as a warning, without stopping the others."""
+
+        tasks = list()
+        if 'wiki' in options:
+            tasks.append(('wiki_pages', self.export_wiki_pages, (template_path,)))
+            tasks.append(('attachments', self.export_wiki_attachments, (req, template_name)))
+        if 'ticket' in options:
+            tasks.append(('ticket_types', self.export_ticket_types, (template_path,)))
+            tasks.append(('workflows', self.export_workflows, (req, template_path)))
+            # we export priority, version and components if we export tickets
+            tasks.append(('priority', self.export_priorites, (template_path,)))
+            tasks.append(('versions', self.export_versions, (template_path,)))
+            tasks.append(('components', self.export_components, (template_path,)))
+        if 'archive' in options:
+            tasks.append(('repos', self.export_file_archive, 
+                          (req, template_path, archive)))
+        if 'group' in options:
+            # we import the group perms as part of the group export
+            tasks.append(('groups', self.export_groups_and_permissions, (template_path,)))
+        if 'list' in options:
+            tasks.append(('lists', self.export_mailinglists, (template_path,)))
+        if 'milestone' in options:
+            tasks.append(('milestones', self.export_milestones, (template_path,)))
+
+        results, errors = run_tasks(self.env, tasks, self.export_threads, progress)
+        for key, exc_info in errors.iteritems():
+            self.log.error("Unable to export %s into template %s", key, template_name, 
+                           exc_info=exc_info)
+            if req:
+                add_warning(req, "Unable to export %s into the template." % key.replace('_', ' '))
+
+        return results
+
     def export_wiki_pages(self, template_path):
         """Export wiki page data into a wiki.xml file.
         
-        Get data for each wiki page that has not been deleted and place
-        that inside an new XML tree. When we've finished building the tree, 
-        create a new XML file called wiki.xml to store the content.
+        Get data for each wiki page that has not been deleted and stream
+        it into a wiki.xml (or wiki.jsonl.gz) file. Pages are read in 
+        batches by get_latest_wiki_pages() and written one at a time, so we
+        never hold more than a batch of wiki text in memory, no matter how
+        large the project wiki is.
         """
 
         # a list to return to the template with info about transaction
         successful_exports = list()
 
-        # Get page names and create wiki page objects
-        # get_pages() already excludes deleted pages
-        wiki_names = WikiSystem(self.env).get_pages()
-        if wiki_names:
-            project_wiki = [WikiPage(self.env, wiki_page) for wiki_page in wiki_names]
-
-            # create an XML tree using ElementTree
-            root = ET.Element("wiki", project=self.env.project_name, date=datetime.date.today().isoformat())
-            for wiki in project_wiki:
+        template_writer = self._template_writer(template_path)
+        filename = template_writer.filename('wiki')
+        writer = None
+        try:
+            for name, readonly, author, text in self.get_latest_wiki_pages():
                 # only export wiki pages with text
-                if wiki.text:
-
-                    # standard attributes
-                    attribs = {
-                        'name': wiki.name,
-                        'readonly': str(wiki.readonly),
-                    }
-
-                    # we can't serialize None
-                    if wiki.author:
-                        attribs['author'] = wiki.author
+                if not text:
+                    continue
 
-                    page = ET.SubElement(root, "page", attribs).text = wiki.text
-                    successful_exports.append(wiki.name)
+                # only create the wiki file if we have at least one page
+                if writer is None:
+                    writer = template_writer.open('wiki')
 
-            # create the actual xml file
-            filename = os.path.join(template_path, 'wiki.xml')
-            ET.ElementTree(root).write(filename)
-            self.log.info("File %s has been created at %s" % (filename, template_path))
+                writer.write(WikiPageRecord(name, readonly, author or None, text))
+                successful_exports.append(name)
+        finally:
+            if writer is not None:
+                writer.close()
+                self.log.info("File %s has been created at %s" % (filename, template_path))
 
         return successful_exports
 
+    def get_latest_wiki_pages(self):
+        """Yields a (name, readonly, author, text) tuple for the latest 
+        version of every wiki page.
+
+        Creating a WikiPage object for each page costs a query per page, 
+        which adds up to thousands of round trips on large projects. Here we 
+        fetch the pages in batches of wiki_export_batch_size, each starting
+        after the name of the last page of the one before. The database 
+        drivers of PostgreSQL and MySQL buffer the whole result of a query 
+        on the client, so a single query would hold the text of every page 
+        in memory at once. Deleted pages have no rows left in the wiki 
+        table, so like get_pages() they are excluded."""
+
+        # fetching no pages at a time would export no pages at all
+        batch_size = max(1, self.wiki_export_batch_size)
+        last_name = ''
+        while True:
+            db = self.env.get_read_db()
+            cursor = db.cursor()
+            cursor.execute("""SELECT w.name, w.readonly, w.author, w.text
+                              FROM wiki AS w
+                              INNER JOIN (SELECT name, MAX(version) AS version
+                                          FROM wiki WHERE name > %s GROUP BY name
+                                          ORDER BY name LIMIT %s) AS latest
+                              ON w.name = latest.name AND w.version = latest.version
+                              ORDER BY w.name""",
+                           (last_name, batch_size))
+            rows = cursor.fetchall()
+            for name, readonly, author, text in rows:
+                yield name, readonly or 0, author, text
+            if len(rows) < batch_size:
+                return
+            last_name = rows[-1][0]
+            # don't hold on to this batch while the next one is fetched
+            del rows
+
     def export_wiki_attachments(self, req, template_name):
         """Export wiki attachent files into a new wiki attachment directory.
 
@@ -222,54 +429,118 @@ class GenerateTemplate(Component):
         # a list to return to the template with info about transaction
         successful_exports = list()
 
-        # Get information about attachments
-        # Not really a nice way to get all the attachments in trac/attachments
+        # Get information about attachments, keeping only those which
+        # still have a file on disk. Most pages have several attachments,
+        # so rather than checking each file we list each directory once.
         attachments = list()
-        for wiki_name in WikiSystem(self.env).get_pages():
-            for attachment in Attachment.select(self.env, 'wiki', wiki_name):
-                if attachment.exists:
-                    attachments.append(attachment)
+        listed_dirs = dict()
+        for attachment in self.get_wiki_attachments():
+            path = attachment_path(self.env, attachment['parent_id'], attachment['filename'])
+            attachment_dir, filename = os.path.split(path)
+            if attachment_dir not in listed_dirs:
+                try:
+                    listed_dirs[attachment_dir] = set(os.listdir(attachment_dir))
+                except OSError:
+                    listed_dirs[attachment_dir] = set()
+            if filename in listed_dirs[attachment_dir]:
+                attachment['path'] = path
+                attachments.append(attachment)
 
         # write this information to XML tree if there are attachments to export
         if attachments:
-            self.log.info("Creating wiki attachment XML file for template archive")
-            root = ET.Element("attachments", project=self.env.project_name, date=datetime.date.today().isoformat())
-            for attachment in attachments:
-                ET.SubElement(root, "attachment", name=attachment.filename, 
-                                                  parent_id=attachment.parent_id,
-                                                  size=str(attachment.size),
-                                                  version=str(attachment.version)).text = attachment.description
-                successful_exports.append(attachment.filename)
-
-            # create the xml file
-            filename = os.path.join(self.template_dir_path, template_name, "attachment.xml")
-            ET.ElementTree(root).write(filename)
+            self.log.info("Creating wiki attachment file for template archive")
+            template_writer = self._template_writer(os.path.join(self.template_dir_path, 
+                                                                 template_name))
+            with template_writer.open('attachment') as writer:
+                for attachment in attachments:
+                    version = attachment.get('version')
+                    writer.write(AttachmentRecord(attachment['filename'],
+                                                  attachment['parent_id'],
+                                                  attachment['size'],
+                                                  version is not None and str(version) or None,
+                                                  attachment['description']))
+                    successful_exports.append(attachment['filename'])
+            filename = template_writer.filename('attachment')
             self.log.info("File %s has been created at %s" % (filename, os.path.join(self.template_dir_path, template_name)))
 
+            if self.blob_store:
+                # add the files to the shared blob store and record their 
+                # hashes, rather than giving this template its own copy
+                store = BlobStore(self.template_dir_path)
+                entries = {}
+                for attachment in attachments:
+                    relpath = attachment_relpath(attachment['parent_id'], attachment['filename'])
+                    entries[relpath] = store.add(attachment['path'], self.copy_strategy)
+                update_manifest(os.path.join(self.template_dir_path, template_name),
+                                'attachments/wiki', entries)
+                self.log.info("Added %s wiki attachments to the template blob store", len(entries))
+                return successful_exports
+
             # copy the project attachments into our new directory
-            attachment_dir_path = os.path.join(self.env.path, 'attachments', 'wiki')
             attachment_template_path = os.path.join(self.template_dir_path, template_name, 'attachments', 'wiki')
 
-            # the directory we copy to can't exist before shutil.copytree()
+            # start from an empty directory so no stale files are left behind
             try:
                 shutil.rmtree(attachment_template_path)
             except OSError as exception:
                 # no directory to remove
                 if exception.errno == errno.ENOENT:
-                    self.log.debug("No workflow directory at %s to remove", attachment_template_path)
+                    self.log.debug("No attachment directory at %s to remove", attachment_template_path)
 
-            # now copy the directory
-            shutil.copytree(attachment_dir_path, attachment_template_path)
-            self.log.info("Copied wiki attachments to %s", attachment_template_path)
+            # now copy the files, laid out by the name of their page and 
+            # their own name whatever the version of Trac
+            strategy = self.copy_strategy
+            created_dirs = set()
+            for attachment in attachments:
+                destination = os.path.join(attachment_template_path, 
+                                           attachment_relpath(attachment['parent_id'], 
+                                                              attachment['filename']))
+                destination_dir = os.path.dirname(destination)
+                if destination_dir not in created_dirs:
+                    os.makedirs(destination_dir)
+                    created_dirs.add(destination_dir)
+                # once a strategy falls back we use the fallback for the rest
+                strategy = copy_file(attachment['path'], destination, strategy)
+            self.log.info("Copied %s wiki attachments to %s using %s", len(attachments), 
+                          attachment_template_path, strategy)
 
             return successful_exports
 
+    def get_wiki_attachments(self):
+        """Returns a list of dictionaries describing every attachment on an
+        existing wiki page.
+
+        Attachment.select() only works for a single parent, so using it for 
+        each wiki page costs one query per page even though most pages have
+        no attachments at all. Here we read all of the wiki attachment rows 
+        with one query instead. The dictionary keys are the attachment table
+        column names, with the id column renamed to parent_id. If there are
+        several versions of an attachment we only keep the latest one."""
+
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("""SELECT * FROM attachment
+                          WHERE type='wiki' AND id IN (SELECT name FROM wiki)
+                          ORDER BY id, filename""")
+        columns = [column[0] == 'id' and 'parent_id' or column[0] 
+                   for column in cursor.description]
+
+        attachments = {}
+        for row in cursor:
+            attachment = dict(zip(columns, row))
+            key = (attachment['parent_id'], attachment['filename'])
+            if (key not in attachments 
+                or attachment.get('version', 0) > attachments[key].get('version', 0)):
+                attachments[key] = attachment
+
+        return [attachments[attachment_key] for attachment_key in sorted(attachments)]
+
     def export_ticket_types(self, template_path):
         """Export ticket types by saving type JSON data in ticket.xml file.
         
         Creates a dictionary where each key is a ticket type and the value
-        is ticket type information. We then iterate over this to create a XML
-        file using ElementTree lib.
+        is ticket type information. We then iterate over this to write the
+        ticket.xml (or ticket.jsonl.gz) file.
         """
 
         # a list to return to the template with info about transaction
@@ -283,17 +554,13 @@ class GenerateTemplate(Component):
             # using a _method() is a bit naughty
             ticket_types_dict[ticket_type] = controller._serialize_ticket_type(ticket_type)
 
-        # create the XML tree
-        self.log.info("Creating ticket type XML file for template archive")
-
-        root = ET.Element("ticket_types", project=self.env.project_name, date=datetime.date.today().isoformat())
-        for type_name, type_info in ticket_types_dict.iteritems():
-            ET.SubElement(root, "type_name", name=type_name).text = type_info
-            successful_exports.append(type_name)
-
-        # create the xml file
-        filename = os.path.join(template_path, 'ticket.xml')
-        ET.ElementTree(root).write(filename)
+        self.log.info("Creating ticket type file for template archive")
+        template_writer = self._template_writer(template_path)
+        with template_writer.open('ticket') as writer:
+            for type_name, type_info in ticket_types_dict.iteritems():
+                writer.write(TicketTypeRecord(type_name, type_info))
+                successful_exports.append(type_name)
+        filename = template_writer.filename('ticket')
         self.log.info("File %s has been created at %s" % (filename, template_path))
 
         return successful_exports
@@ -312,6 +579,28 @@ class GenerateTemplate(Component):
         # a list to return to the template with info about transaction
         successful_exports = list()
 
+        # find the project specific workflows
+        workflow_dir = os.path.join(self.env.path, 'workflows')
+        try:
+            workflows = [workflow for workflow in sorted(os.listdir(workflow_dir))
+                         if workflow.lower().endswith('.xml')
+                         and os.path.isfile(os.path.join(workflow_dir, workflow))]
+        except OSError as exception:
+            if exception.errno != errno.ENOENT:
+                raise
+            self.log.debug("No workflows to export from current project.")
+            workflows = []
+
+        if self.blob_store:
+            # workflows are edited in place by projects, so we always copy
+            # them into the store rather than linking them
+            store = BlobStore(self.template_dir_path)
+            entries = dict((workflow, store.add(os.path.join(workflow_dir, workflow)))
+                           for workflow in workflows)
+            update_manifest(template_path, 'workflows', entries)
+            self.log.info("Added %s workflows to the template blob store", len(entries))
+            return workflows
+
         # make a directory to hold workflows
         workflow_template_path = os.path.join(template_path, 'workflows')
         try:
@@ -324,18 +613,10 @@ class GenerateTemplate(Component):
         self.log.info("Created a template workflow directory at %s", workflow_template_path)
 
         # copy the workflows into our new directory
-        workflow_dir = os.path.join(self.env.path, 'workflows')
-        try:
-            for workflow in os.listdir(workflow_dir):
-                if workflow.lower().endswith('.xml'):
-                    full_file_name = os.path.join(workflow_dir, workflow)
-                    if (os.path.isfile(full_file_name)):
-                        shutil.copy(full_file_name, workflow_template_path)
-                        self.log.info("%s moved to %s template directory", (workflow, workflow_template_path))
-                        successful_exports.append(workflow)
-        except OSError as exception:
-            if exception.errno == errno.ENOENT:
-                self.log.debug("No workflows to export from current project.")
+        for workflow in workflows:
+            shutil.copy(os.path.join(workflow_dir, workflow), workflow_template_path)
+            self.log.info("%s moved to %s template directory", workflow, workflow_template_path)
+            successful_exports.append(workflow)
 
         return successful_exports
 
@@ -349,16 +630,13 @@ class GenerateTemplate(Component):
         # a list to return to the template with info about transaction
         successful_exports = list()
 
-        # create the XML tree
-        self.log.info("Creating priority XML file for template archive")
-        root = ET.Element("ticket_priority", project=self.env.project_name, date=datetime.date.today().isoformat())
-        for priority in Priority.select(self.env):
-            ET.SubElement(root, "priority_info", name=priority.name, value=str(priority.value))
-            successful_exports.append(priority.name)
-
-        # create the xml file
-        filename = os.path.join(template_path, 'priority.xml')
-        ET.ElementTree(root).write(filename)
+        self.log.info("Creating priority file for template archive")
+        template_writer = self._template_writer(template_path)
+        with template_writer.open('priority') as writer:
+            for priority in Priority.select(self.env):
+                writer.write(PriorityRecord(priority.name, str(priority.value)))
+                successful_exports.append(priority.name)
+        filename = template_writer.filename('priority')
         self.log.info("File %s has been created at %s" % (filename, template_path))
 
         return successful_exports
@@ -367,24 +645,21 @@ class GenerateTemplate(Component):
         """Export version data into a new version.xml file.
         
         Get the different ticket version values from the version table using 
-        the select class method and save the result into a XML file.
+        the select class method and save the result into a template file.
         """
 
         # a list to return to the template with info about transaction
         successful_exports = list()
 
-        # create the XML tree
-        self.log.info("Creating version XML file for template archive")
-        root = ET.Element("ticket_versions", project=self.env.project_name, date=datetime.date.today().isoformat())
-        for version in model.Version.select(self.env):
-            # not exporting time as this is unlikely to be relevant 
-            # to any new project using this template
-            ET.SubElement(root, "version_info", name=version.name, description=version.description)
-            successful_exports.append(version.name)
-
-        # create the xml file
-        filename = os.path.join(template_path, 'version.xml')
-        ET.ElementTree(root).write(filename)
+        self.log.info("Creating version file for template archive")
+        template_writer = self._template_writer(template_path)
+        with template_writer.open('version') as writer:
+            for version in model.Version.select(self.env):
+                # not exporting time as this is unlikely to be relevant 
+                # to any new project using this template
+                writer.write(VersionRecord(version.name, version.description))
+                successful_exports.append(version.name)
+        filename = template_writer.filename('version')
         self.log.info("File %s has been created at %s" % (filename, template_path))
 
         return successful_exports
@@ -393,75 +668,155 @@ class GenerateTemplate(Component):
         """Export component data into a new component.xml file.
 
         Get the different ticket component values from the component table 
-        using the select class method and save the result into a XML file."""
+        using the select class method and save the result into a template 
+        file."""
 
         # a list to return to the template with info about transaction
         successful_exports = list()
 
-        # create the XML tree
-        self.log.info("Creating component XML file for template archive")
-        root = ET.Element("ticket_components", project=self.env.project_name, date=datetime.date.today().isoformat())
-        for component in model.Component.select(self.env):
-            # we don't save the owner as that user might not be a member
-            # of the new project
-            ET.SubElement(root, "component_info", name=component.name, 
-                          description=component.description)
-            successful_exports.append(component.name)
-
-        # create the xml file
-        filename = os.path.join(template_path, 'component.xml')
-        ET.ElementTree(root).write(filename)
+        self.log.info("Creating component file for template archive")
+        template_writer = self._template_writer(template_path)
+        with template_writer.open('component') as writer:
+            for component in model.Component.select(self.env):
+                # we don't save the owner as that user might not be a member
+                # of the new project
+                writer.write(ComponentRecord(component.name, component.description))
+                successful_exports.append(component.name)
+        filename = template_writer.filename('component')
         self.log.info("File %s has been created at %s" % (filename, template_path))
 
         return successful_exports
 
-    def export_file_archive(self, req, new_repo_path):
+    def export_file_archive(self, req, template_path, archive=None):
         """Export project file archive, saving it in the new template directory.
 
         For now we only deal with Subversion repositories. We won't support
         the export of Git repos - but we will come back to solve this 
         issue (probably via GIT clone) in a future release.
 
-        We compress this file via gzip.
+        We compress this file with the archive_codec. If archive is given 
+        the file name, codec, size and throughput of the dump are stored in
+        it, for the info.json file of the template, along with the dumped
+        revision.
+
+        With incremental_archives we only dump the revisions made since the
+        newest template from this project, and record that template as the
+        base of ours - see _find_base_archive(). If nothing has been 
+        committed since, we don't write an archive at all. Without a base 
+        we dump the whole history of the repository rather than a snapshot,
+        so later templates can build on it.
         """
 
         # a list to return to the template with info about transaction
         successful_exports = list()
         old_repo_path = self.env.get_repository().repos.path
 
+        codec = self.archive_codec
+        if not codec_available(codec):
+            self.log.warning("%s is not installed. Compressing the file archive "
+                             "with gzip instead.", codec)
+            codec = 'gzip'
+        template_name = os.path.basename(os.path.normpath(template_path))
+        new_repo_path = os.path.join(template_path, archive_filename(template_name, codec))
+
         try:
-            # Dump the file archive at the latest version (-rHEAD)
-            process = subprocess.Popen(['svnadmin', 'dump', '--quiet', '-rHEAD', old_repo_path],
-                                       executable='/usr/bin/svnadmin',
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.PIPE)
-            output = gzip.GzipFile(new_repo_path, 'w')
-            bs = 1024*1000
-            while True:
-                data = process.stdout.read(bs)
-                if data:
-                    output.write(data)
-                else:
-                    # any remaining stderr will be read in a moment by communicate()
-                    break
-                stderrdata = process.stderr.read()
-                if stderrdata:
-                    self.log.warning("stderr from svnadmin: %s", stderrdata)                    
-            output.close()
-            stdoutdata, stderrdata = process.communicate()
-            if stderrdata:
-                self.log.warning("stderr from svnadmin: %s", stderrdata)
-            self.log.info("Dumped the file archive (return code %s) at %s into the project template directory", 
-                          process.returncode, 
-                          old_repo_path)
+            # Dump the file archive at the latest version, recording which
+            # revision that was so later templates can build on it
+            try:
+                revision = youngest_revision(old_repo_path)
+            except OSError as exception:
+                # without the revision nothing can build on the archive, 
+                # but we can still dump the latest version
+                self.log.warning("Unable to find the youngest revision of %s, creating a "
+                                 "full dump instead: %s", old_repo_path, exception)
+                revision = None
+            incremental = self.incremental_archives and revision is not None
+            info = {'revision': revision,
+                    'repository': old_repo_path,
+                    'history': incremental,
+                    'base': None,
+                    'chain_length': 1}
+            if incremental:
+                base, base_archive = self._find_base_archive(template_name, old_repo_path)
+                if base:
+                    info.update({'base': base,
+                                 'base_revision': base_archive['revision'],
+                                 'chain_length': base_archive.get('chain_length', 1) + 1})
+
+            if info['base'] and info['base_revision'] >= revision:
+                self.log.info("No changes to the file archive at %s since template %s",
+                              old_repo_path, info['base'])
+                if archive is not None:
+                    info['file'] = None
+                    archive.update(info)
+                return [old_repo_path.split("/")[-1]]
+
+            stats = dump_archive(old_repo_path, new_repo_path, codec,
+                                 self.archive_compression_level, self.archive_threads,
+                                 revision=revision or 'HEAD',
+                                 base_revision=info.get('base_revision'),
+                                 history=info['history'])
+            if stats['stderr']:
+                self.log.warning("stderr from svnadmin: %s", stats['stderr'])
+            if stats['returncode']:
+                # a failed dump or compressor leaves a truncated archive
+                self.log.error("Unable to dump the file archive at %s into the project "
+                               "template directory (return code %s)", old_repo_path,
+                               stats['returncode'])
+                os.remove(new_repo_path)
+                if req:
+                    add_warning(req, "Unable to export the file archive.")
+                return successful_exports
+            self.log.info("Dumped the file archive at %s into the project template "
+                          "directory (%s bytes compressed to %s with %s in %.1fs, "
+                          "%.1f MB/s)", old_repo_path, stats['bytes'],
+                          stats['compressed_bytes'], codec, stats['seconds'], throughput(stats))
+            if archive is not None:
+                archive.update(info)
+                archive.update({'file': os.path.basename(new_repo_path),
+                                'codec': codec,
+                                'level': self.archive_compression_level,
+                                'dump_size': stats['bytes'],
+                                'compressed_size': stats['compressed_bytes'],
+                                'seconds': round(stats['seconds'], 3),
+                                'throughput': round(throughput(stats), 3)})
             successful_exports = [old_repo_path.split("/")[-1]]
         except OSError as exception:
             self.log.info("No subversion repository at the path %s. Unable to export file archive.", old_repo_path)
             self.log.debug(exception)
-            add_notice(req, "No Subversion repository found. Unable to export the file archive.")
+            if req:
+                add_notice(req, "No Subversion repository found. Unable to export the file archive.")
 
         return successful_exports
 
+    def _find_base_archive(self, template_name, repo_path):
+        """Returns the name and archive information of the newest template
+        created from this project whose archive an incremental dump of 
+        repo_path can build on, or (None, None) if there isn't one or its
+        chain already has archive_max_chain archives. Only archives holding
+        the whole history of the repository can be built on, as an 
+        incremental dump refers to the revisions before it by number."""
+
+        api = ProjectTemplateAPI(self.env)
+        for template in reversed(api.get_project_templates(self.env.project_name)):
+            if template['name'] == template_name:
+                continue
+            try:
+                base_archive = api.get_template_information(template['name']).get('archive')
+            except ResourceNotFound:
+                continue
+            if not base_archive or base_archive.get('revision') is None \
+                    or base_archive.get('repository') != repo_path \
+                    or not base_archive.get('history'):
+                continue
+            if base_archive.get('chain_length', 1) >= self.archive_max_chain:
+                self.log.info("The archive chain of template %s is %s long. Creating "
+                              "a full dump instead.", template['name'], 
+                              base_archive.get('chain_length', 1))
+                break
+            return template['name'], base_archive
+        return None, None
+
     def export_groups_and_permissions(self, template_path):
         """
         Export project group data, saving it into a new group.xml file.
@@ -491,31 +846,25 @@ class GenerateTemplate(Component):
         for group, perms in groupby(export_perms, key=itemgetter(0)):
             perm_dict[group] = [p for p in perms]
 
-        root = ET.Element("membership_group", 
-                          project=self.env.project_name, 
-                          date=datetime.date.today().isoformat())
-
-        # tried to unify the handling of the group_info XML generation
-        for group in [Group(self.env, sid) for sid in group_sids] + domains + virtual_groups:
-            group_element = ET.SubElement(root, "group_info", name=unicode(group))
-            if isinstance(group, Group):
-                if group.external_group:
-                    # we don't remember why we skip these
-                    continue
-                group_element.attrib['sid'] = group.sid
-                group_element.attrib['label'] = group.label
-                group_element.text = group.description
-                group_sid = group.sid
-            else:
-                group_sid = group
-            for perm in perm_dict.get(group_sid, []):
-                ET.SubElement(group_element, "group_perms",
-                              name=perm[0], action=perm[1])
-            successful_exports.append(unicode(group))
-
-        self.log.info("Creating membership group XML file for template archive")
-        filename = os.path.join(template_path, 'group.xml')
-        ET.ElementTree(root).write(filename)
+        self.log.info("Creating membership group file for template archive")
+        template_writer = self._template_writer(template_path)
+        with template_writer.open('group') as writer:
+            # tried to unify the handling of the group_info generation
+            for group in [Group(self.env, sid) for sid in group_sids] + domains + virtual_groups:
+                if isinstance(group, Group):
+                    if group.external_group:
+                        # we don't remember why we skip these
+                        writer.write(GroupRecord(unicode(group), None, None, None, []))
+                        continue
+                    sid, label, description = group.sid, group.label, group.description
+                    group_sid = group.sid
+                else:
+                    sid = label = description = None
+                    group_sid = group
+                perms = [(perm[0], perm[1]) for perm in perm_dict.get(group_sid, [])]
+                writer.write(GroupRecord(unicode(group), sid, label, description, perms))
+                successful_exports.append(unicode(group))
+        filename = template_writer.filename('group')
         self.log.info("File %s has been created at %s", filename, template_path)
 
         return successful_exports
@@ -526,19 +875,14 @@ class GenerateTemplate(Component):
         # a list to return to the template with info about transaction
         successful_exports = list()
 
-        self.log.info("Creating mailing list XML file for template archive")
-        root = ET.Element("lists", project=self.env.project_name, date=datetime.date.today().isoformat())
-        for ml in Mailinglist.select(self.env):
-            ET.SubElement(root, "list_info", name=ml.name,
-                                             email=ml.emailaddress,
-                                             private=str(ml.private),
-                                             postperm=ml.postperm,
-                                             replyto=ml.replyto).text = ml.description
-            successful_exports.append(ml.name)
-
-        # save the xml file
-        filename = os.path.join(template_path, 'mailinglist.xml')
-        ET.ElementTree(root).write(filename)
+        self.log.info("Creating mailing list file for template archive")
+        template_writer = self._template_writer(template_path)
+        with template_writer.open('mailinglist') as writer:
+            for ml in Mailinglist.select(self.env):
+                writer.write(MailinglistRecord(ml.name, ml.emailaddress, str(ml.private),
+                                               ml.postperm, ml.replyto, ml.description))
+                successful_exports.append(ml.name)
+        filename = template_writer.filename('mailinglist')
         self.log.info("File %s has been created at %s" % (filename, template_path))
 
         return successful_exports
@@ -554,38 +898,33 @@ class GenerateTemplate(Component):
         # a list to return to the template with info about transaction
         successful_exports = list()
 
-        self.env.log.info("Creating milestone XML file for template archive")
-        root = ET.Element("milestones", project=self.env.project_name, date=datetime.date.today().isoformat())
+        self.env.log.info("Creating milestone file for template archive")
+        template_writer = self._template_writer(template_path)
         all_milestones = model.Milestone.select(self.env, include_children=True)
-        for milestone in all_milestones:
-            ms = ET.SubElement(root, "milestone_info", name=milestone.name)
-            # we need to do some checking incase the attribute has a None type
-            if milestone.start:
-                ms.attrib['start'] = milestone.start.strftime("%Y-%m-%d")
-            if milestone.due:
-                ms.attrib['due'] = milestone.due.strftime("%Y-%m-%d")
-            if milestone.completed:
-                ms.attrib['completed'] = milestone.completed.strftime("%Y-%m-%d")
-            if milestone.parent:
-                ms.attrib['parent'] = milestone.parent
-            if milestone.description:
-                ms.text = milestone.description
-            successful_exports.append(milestone.name)
-
-        # save the xml file in the template directory
-        filename = os.path.join(template_path, 'milestone.xml')
-        ET.ElementTree(root).write(filename)
+        with template_writer.open('milestone') as writer:
+            for milestone in all_milestones:
+                # we need to do some checking incase the attribute has a None type
+                dates = [date and date.strftime("%Y-%m-%d") or None
+                         for date in (milestone.start, milestone.due, milestone.completed)]
+                writer.write(MilestoneRecord(milestone.name, 
+                                             *(dates + [milestone.parent or None,
+                                                        milestone.description or None])))
+                successful_exports.append(milestone.name)
+        filename = template_writer.filename('milestone')
         self.log.info("File %s has been created at %s" % (filename, template_path))
 
         return successful_exports
 
-    def create_template_info_file(self, req, template_name, template_path):
+    def create_template_info_file(self, template_name, template_path, author, description,
+                                  archive=None):
         """Creates a new json file which stores metadata about the template. 
 
         This metadta includes information including the author who invoked the
         create template event, the date the template was created, the 
         description given by the author of the template and version data 
-        taken from the system table.
+        taken from the system table. The statistics of the file archive
+        export are stored too if archive is given. The template is then 
+        added to the template index.
         """
 
         filename = os.path.join(template_path, "info.json")
@@ -599,20 +938,34 @@ class GenerateTemplate(Component):
             'name': template_name,
             'project': self.env.project_name,
             'created': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            'author': req.authname,
-            'description': req.args['description'],
+            'author': author,
+            'description': description,
             'versions': dict(kv for kv in cursor.fetchall())
         }
+        if archive:
+            text['archive'] = archive
+        text['format'] = self.template_format
 
         # add some extra version data from config file not system table
         text['versions']['json_latest_version'] = self.env.config.get('logica workflows', 'json_version')
         text['versions']['type_config_version'] = self.env.config.get('logica workflows', 'type_config_version')
 
         try:
-            f = file(filename, "w")
-            f.write(json.dumps(text))
+            with open(filename, "w") as f:
+                f.write(json.dumps(text))
         except IOError:
             self.log.info("Unable to create new file info folder at %s", filename)
+        else:
+            # add the template to the index of all templates
+            ProjectTemplateAPI(self.env).update_index(template_name)
+
+    def _template_writer(self, template_path):
+        """Returns a TemplateWriter for the tables of the template at 
+        template_path in the configured template_format."""
+
+        return TemplateWriter(template_path, self.template_format,
+                              project=self.env.project_name,
+                              date=datetime.date.today().isoformat())
 
     # ITemplateProvider methods
 
@@ -1,11 +1,21 @@
+import copy
 import json
 import os
 import itertools
+import stat
+import threading
 
 from trac.core import *
 from tracrpc.api import IXMLRPCHandler
+from trac.admin.api import AdminCommandError, IAdminCommandProvider
 from trac.config import PathOption
 from trac.resource import ResourceNotFound
+from trac.util.text import printout
+
+from createtemplate.blobstore import BlobStore, read_manifest, referenced_digests
+from createtemplate.files import locked, write_atomically
+from createtemplate.packed import PACKED_EXTENSION, read_packed_manifest
+from createtemplate.templateio import table_name
 
 # Author: Danny Milsom <danny.milsom@cgi.com>
 
@@ -20,6 +30,12 @@ class ProjectTemplatesRPC(Component):
     def xmlrpc_methods(self):
         yield (None, ((list,),), self.getTemplatesNames)
         yield (None, ((dict, str),), self.getTemplateInformation)
+        yield (None, ((dict, str),), self.getImportPlan)
+        yield (None, ((list,), (list, list), (list, list, str),
+                      (list, list, str, str), (list, list, str, str, str),
+                      (list, list, str, str, str, int),
+                      (list, list, str, str, str, int, int)),
+               self.getTemplatesInformation)
 
     def getTemplatesNames(self, req):
         """Get a list of all project templates available."""
@@ -33,58 +49,476 @@ class ProjectTemplatesRPC(Component):
 
         return ProjectTemplateAPI(self.env).get_template_information(template_name)
 
+    def getImportPlan(self, req, template_name):
+        """Describes what importing a project template would do, without
+        importing anything. This includes the number of rows of each table,
+        the tables whose content would be replaced, the size of the wiki 
+        attachments and the file archive, and an estimate in seconds of how
+        long the import would take, based on earlier imports. Returns a 
+        dictionary."""
+
+        return ProjectTemplateAPI(self.env).plan_import(template_name)
+
+    def getTemplatesInformation(self, req, template_names=None, project='', 
+                                created_from='', created_to='', offset=0, limit=0):
+        """Gets information about several project templates in one call. 
+        Returns a list of dictionaries with the name, project, created date,
+        author, description and components of each template, ordered by 
+        the date they were created.
+
+        Pass a list of template names, or an empty list for all templates. 
+        The remaining optional arguments filter the templates by the project 
+        they were created from and by their created date (inclusive, as
+        'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS'), and page through the results
+        by skipping the first offset templates and returning at most limit
+        templates. Empty strings and a limit of 0 mean no restriction."""
+
+        return ProjectTemplateAPI(self.env).query_templates(template_names or None,
+                                                            project or None,
+                                                            created_from or None,
+                                                            created_to or None,
+                                                            offset, limit or None)
+
+# The template index is a single file in the template directory which holds
+# the main details of every template, so listing templates doesn't need to
+# open the info.json file of each one. Templates are often copied between
+# servers by hand, so the index isn't trusted to say which templates exist
+# - that is always the template directory itself - and templates missing 
+# from the index are read from their own info.json
+INDEX_FILE = 'index.json'
+INDEX_LOCK = '.index.lock'
+INDEX_VERSION = 1
+INDEX_FIELDS = ('name', 'project', 'created', 'author', 'description', 'components')
+
 class ProjectTemplateAPI(Component):
     """Useful methods to return information about project templates"""
 
     template_dir_path = PathOption('project_templates', 'template_dir', 
                     doc="The default path for the project template directory")
 
+    def __init__(self):
+        # the template catalog cache - see _stat_key() for how entries
+        # are validated
+        self._catalog_lock = threading.Lock()
+        self._templates = None
+        self._template_info = {}
+        self._index = None
+
     def get_all_templates(self):
         """Gets a list of all templates stored in var/define/templates on 
         production servers or development-environment/templates under
-        run-in-place.sh"""
+        run-in-place.sh
+
+        We list the directories and packed templates in the template 
+        directory, and cache the list until the directory changes - so 
+        templates copied in by hand are found straight away, whether or 
+        not they are in the template index."""
 
         try:
-            # list all directories in the template dir
-            return os.walk(self.template_dir_path).next()[1]
+            key = self._stat_key(self.template_dir_path)
         except TypeError:
             # catch a TypeError incase the template_dir_path defaults to None
             return []
 
+        with self._catalog_lock:
+            if self._templates is None or self._templates[0] != key:
+                self._templates = (key, self._list_templates())
+            return list(self._templates[1])
+
+    def get_catalog_key(self):
+        """Returns a value which changes whenever a template is added or
+        removed or the template index is replaced. Callers can use it to 
+        cache things derived from get_all_templates() for the price of two
+        stat calls."""
+
+        if not self.template_dir_path:
+            return None
+        return (self._stat_key(self.template_dir_path),
+                self._stat_key(os.path.join(self.template_dir_path, INDEX_FILE)))
+
+    def get_template_path(self, template_name):
+        """Returns the path of the template directory or packed template 
+        with the given name. Raises ResourceNotFound if there is neither."""
+
+        template_dir = os.path.join(self.template_dir_path, template_name)
+        if os.path.isdir(template_dir):
+            return template_dir
+        if os.path.isfile(template_dir + PACKED_EXTENSION):
+            return template_dir + PACKED_EXTENSION
+        raise ResourceNotFound('There is no such template with the name %s'
+                               % template_name)
+
     def get_template_information(self, template_name):
         """Returns a dictionary containing information about the specified 
         project template. This includes the name, description, date and a list
         of all the components exported - loaded from the JSON in info.json
 
-        If there is no template directory with that name in the 
-        template folder we return a string informing the user. There is 
+        If there is no template directory or packed template with that name
+        in the template folder we return a string informing the user. There is 
         no point in returning a warning or notice as this method is intended
-        for API style usage."""
+        for API style usage.
+
+        The information is cached until the template directory or its 
+        info.json changes, so repeated calls only cost two stats. A new 
+        template directory is created empty and only gets its info.json
+        once the template is finished, which doesn't change the directory
+        itself in a way we can rely on."""
 
         # create the path to the template and check it exists
         template_dir = os.path.join(self.template_dir_path, template_name)
-        template_info = {}
+        key = self._stat_key(template_dir)
+        if key is None or not stat.S_ISDIR(key[0]):
+            template_dir += PACKED_EXTENSION
+            key = self._stat_key(template_dir)
 
-        if os.path.isdir(template_dir):
-            try:
-                template_info = json.loads(open(os.path.join(template_dir, 'info.json')).read())
-            except (ValueError, IOError), e:
-                self.log.exception("Unable to read info.json in %s due to %s", template_dir, e)
+        if key is None:
+            # no template at the path specified
+            with self._catalog_lock:
+                self._template_info.pop(template_name, None)
+            raise ResourceNotFound('There is no such template with the name %s'
+                                   % template_name)
 
-            # get a list of all the files and folders inside the template directory
-            # [1] is directories, [2] is files
-            template_contents = os.walk(template_dir).next()[1:]
-            available_components = list(itertools.chain(*template_contents))
+        is_dir = stat.S_ISDIR(key[0])
+        if is_dir:
+            key = (key, self._file_key(os.path.join(template_dir, 'info.json')))
 
-            # add component info into the dict
-            # we are only interested in xml files and directories
-            template_info['components'] = [template_file.rstrip(".xml") for template_file in available_components 
-                                                         if template_file.lower().endswith(".xml") 
-                                                         or os.path.isdir(os.path.join(template_dir, template_file))]
+        with self._catalog_lock:
+            cached = self._template_info.get(template_name)
+        if cached is None or cached[0] != key:
+            if is_dir:
+                cached = (key, self._read_template_information(template_dir))
+            else:
+                cached = (key, self._read_packed_information(template_dir))
+            with self._catalog_lock:
+                self._template_info[template_name] = cached
 
-            return template_info
+        # callers are free to modify the dictionary we return
+        return copy.deepcopy(cached[1])
 
+    def plan_import(self, template_name):
+        """Returns what importing the named template would do, see 
+        ImportTemplate.plan_import(). Raises ResourceNotFound if there is
+        no such template."""
+
+        # imported here as the importer uses this module
+        from createtemplate.importer import ImportTemplate
+        return ImportTemplate(self.env).plan_import(self.get_template_path(template_name))
+
+    def get_project_templates(self, project_name):
+        """Returns a list of dictionaries with index information about each 
+        template created from the named project, oldest first.
+
+        With a template index this only reads index.json, rather than the
+        info.json of every template, see _indexed_templates()."""
+
+        templates = [copy.deepcopy(info) for info in self._indexed_templates().itervalues()]
+        return sorted([info for info in templates if info.get('project') == project_name],
+                      key=lambda info: info.get('created'))
+
+    def query_templates(self, template_names=None, project_name=None, created_from=None,
+                        created_to=None, offset=0, limit=None):
+        """Returns a list of dictionaries with index information about the
+        templates matching all of the given criteria, oldest first.
+
+        The created dates are compared as strings, so a date without a time
+        matches any template created on that day. offset and limit select a
+        page of the results."""
+
+        templates = self._indexed_templates()
+        if template_names is None:
+            template_names = templates.keys()
+
+        results = list()
+        for template_name in template_names:
+            info = templates.get(template_name)
+            if info is None:
+                continue
+            created = info.get('created') or ''
+            if project_name is not None and info.get('project') != project_name:
+                continue
+            if created_from is not None and created[:len(created_from)] < created_from:
+                continue
+            if created_to is not None and created[:len(created_to)] > created_to:
+                continue
+            results.append(info)
+
+        # templates created in the same second need a stable order, or 
+        # pages of the results could skip or repeat them
+        results.sort(key=lambda info: (info.get('created'), info.get('name')))
+        if limit is None:
+            results = results[offset:]
         else:
-            # no directory at the path specified
-            raise ResourceNotFound('There is no such template with the name %s'
-                                   % template_name)
+            results = results[offset:offset + limit]
+        return [dict((field, result.get(field)) for field in INDEX_FIELDS) 
+                for result in results]
+
+    def update_index(self, template_name):
+        """Adds or refreshes the entry of a template in the template index.
+        This is called when a template is created. If there is no index yet
+        we build one from all of the existing templates."""
+
+        if self._read_index() is None:
+            self.rebuild_index()
+            return
+
+        self.invalidate(template_name)
+        template_info = self.get_template_information(template_name)
+
+        def add_template(templates):
+            templates[template_name] = dict((field, template_info.get(field)) 
+                                            for field in INDEX_FIELDS)
+        self._update_index(add_template)
+
+    def rebuild_index(self):
+        """Recreates the template index from the info.json file of every 
+        template directory, e.g. after templates were copied or removed by
+        hand. Returns the number of templates in the new index."""
+
+        self.invalidate()
+        template_names = self._list_templates()
+
+        def replace_templates(templates):
+            templates.clear()
+            for template_name in template_names:
+                template_info = self.get_template_information(template_name)
+                templates[template_name] = dict((field, template_info.get(field)) 
+                                                for field in INDEX_FIELDS)
+        return len(self._update_index(replace_templates))
+
+    def invalidate(self, template_name=None):
+        """Drops cached information about a template, or about every 
+        template if no name is given. This should be called whenever a
+        template is created, changed or removed. Changes made by other 
+        processes are noticed when the directory modification time changes."""
+
+        with self._catalog_lock:
+            self._templates = None
+            self._index = None
+            if template_name is None:
+                self._template_info.clear()
+            else:
+                self._template_info.pop(template_name, None)
+
+    def _indexed_templates(self):
+        """Returns a {template name: information} dictionary for every 
+        template in the template directory. The information comes from the
+        template index, apart from templates which aren't in it - e.g. 
+        copied in by hand, or whose update_index() failed - which are read
+        from their info.json. Templates which are only in the index are 
+        left out. The dictionaries are shared with the index cache, so 
+        callers must not modify them."""
+
+        index = self._read_index() or {}
+        templates = dict()
+        for template_name in self.get_all_templates():
+            template_info = index.get(template_name)
+            if template_info is None:
+                try:
+                    template_info = self.get_template_information(template_name)
+                except ResourceNotFound:
+                    # removed since we listed the template directory
+                    continue
+            templates[template_name] = template_info
+        return templates
+
+    def _read_index(self):
+        """Returns the {template name: information} dictionary from the 
+        template index, or None if there is no index yet. The index is 
+        cached until index.json is replaced."""
+
+        if not self.template_dir_path:
+            return None
+        path = os.path.join(self.template_dir_path, INDEX_FILE)
+        key = self._file_key(path)
+        if key is None:
+            return None
+
+        with self._catalog_lock:
+            if self._index is None or self._index[0] != key:
+                try:
+                    with open(path) as fileobj:
+                        templates = json.load(fileobj)['templates']
+                except (ValueError, KeyError, IOError), e:
+                    self.log.exception("Unable to read template index %s due to %s", path, e)
+                    return None
+                self._index = (key, templates)
+            return self._index[1]
+
+    def _update_index(self, update):
+        """Calls update with the dictionary of indexed templates and writes
+        the result back to index.json. Holds a lock on the index while doing
+        so, as several processes might create templates at the same time."""
+
+        path = os.path.join(self.template_dir_path, INDEX_FILE)
+        with locked(os.path.join(self.template_dir_path, INDEX_LOCK)):
+            try:
+                with open(path) as fileobj:
+                    templates = json.load(fileobj)['templates']
+            except (ValueError, KeyError, IOError):
+                # missing or broken, so start a new index
+                templates = {}
+            update(templates)
+            write_atomically(path, json.dumps({'version': INDEX_VERSION,
+                                               'templates': templates}))
+
+        with self._catalog_lock:
+            self._index = None
+        return templates
+
+    def _stat_key(self, path):
+        """Returns a value which changes whenever entries are added to or 
+        removed from the directory at path, or None if it doesn't exist. 
+        We use the link count as well as the modification time, as the 
+        latter only has a resolution of a second on some NFS servers."""
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mode, st.st_mtime, st.st_nlink)
+
+    def _file_key(self, path):
+        """Returns a value which changes whenever the file at path is 
+        replaced or written to, or None if it doesn't exist. Files like 
+        index.json are replaced by a rename, which changes the inode, and 
+        the size catches most writes made within the same second."""
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def _list_templates(self):
+        """Returns the names of the template directories and packed 
+        templates in the template directory, apart from hidden ones such
+        as the blob store."""
+
+        try:
+            dirnames, filenames = os.walk(self.template_dir_path).next()[1:]
+        except StopIteration:
+            # the template directory doesn't exist
+            return []
+        names = set(name for name in dirnames if not name.startswith('.'))
+        names.update(name[:-len(PACKED_EXTENSION)] for name in filenames
+                     if name.endswith(PACKED_EXTENSION) and not name.startswith('.'))
+        return sorted(names)
+
+    def _read_packed_information(self, packed_path):
+        """Loads information about the packed template at packed_path from
+        the manifest at the start of the file."""
+
+        try:
+            manifest = read_packed_manifest(packed_path)
+        except (ValueError, IOError), e:
+            self.log.exception("Unable to read the manifest of %s due to %s", packed_path, e)
+            return {'components': []}
+
+        template_info = manifest.get('info') or {}
+        template_info['components'] = manifest.get('components') or []
+        return template_info
+
+    def _read_template_information(self, template_dir):
+        """Loads information about the template at template_dir from disk."""
+
+        template_info = {}
+        try:
+            template_info = json.loads(open(os.path.join(template_dir, 'info.json')).read())
+        except (ValueError, IOError), e:
+            self.log.exception("Unable to read info.json in %s due to %s", template_dir, e)
+
+        # get a list of all the files and folders inside the template directory
+        # [1] is directories, [2] is files
+        template_contents = os.walk(template_dir).next()[1:]
+        available_components = list(itertools.chain(*template_contents))
+
+        # add component info into the dict
+        # we are only interested in table files and directories
+        template_info['components'] = [table_name(template_file) or template_file.rstrip(".xml") 
+                                       for template_file in available_components 
+                                       if table_name(template_file)
+                                       or template_file.lower().endswith(".xml") 
+                                       or os.path.isdir(os.path.join(template_dir, template_file))]
+
+        # components kept in the blob store have no directory of their own
+        for component in read_manifest(template_dir):
+            component = component.split('/')[0]
+            if component not in template_info['components']:
+                template_info['components'].append(component)
+
+        return template_info
+
+class ProjectTemplateAdminCommands(Component):
+    """trac-admin commands to maintain the project template directory"""
+
+    implements(IAdminCommandProvider)
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('template gc', '',
+               'Remove blobs which are no longer used by any template',
+               None, self._do_gc)
+        yield ('template index rebuild', '',
+               'Rebuild the template index from the template directories',
+               None, self._do_index_rebuild)
+        yield ('template provision', '<template> <envpath> [envpath ...]',
+               """Import a template into several existing environments
+
+               The template is parsed once and imported into up to
+               [project_templates] provision_processes environments at 
+               the same time.""",
+               self._complete_provision, self._do_provision)
+
+    def _do_gc(self):
+        template_api = ProjectTemplateAPI(self.env)
+        template_dir = template_api.template_dir_path
+        if not template_dir:
+            raise AdminCommandError("No [project_templates] template_dir configured")
+
+        # the index could be missing templates, whose blobs we would then
+        # remove, so we look at what is actually on disk
+        referenced = referenced_digests(os.path.join(template_dir, name) 
+                                        for name in template_api._list_templates())
+        removed = BlobStore(template_dir).collect_garbage(referenced)
+        self.log.info("Removed %s unreferenced template blobs", len(removed))
+        printout("Removed %s unreferenced blobs, %s blobs are still in use" 
+                 % (len(removed), len(referenced)))
+
+    def _do_index_rebuild(self):
+        template_api = ProjectTemplateAPI(self.env)
+        if not template_api.template_dir_path:
+            raise AdminCommandError("No [project_templates] template_dir configured")
+
+        count = template_api.rebuild_index()
+        printout("Indexed %s templates" % count)
+
+    def _complete_provision(self, args):
+        if len(args) == 1:
+            return ProjectTemplateAPI(self.env).get_all_templates()
+
+    def _do_provision(self, template_name, *env_paths):
+        if not env_paths:
+            raise AdminCommandError("No environments to provision given")
+        template_api = ProjectTemplateAPI(self.env)
+        if not template_api.template_dir_path:
+            raise AdminCommandError("No [project_templates] template_dir configured")
+        try:
+            template_path = template_api.get_template_path(template_name)
+        except ResourceNotFound:
+            raise AdminCommandError("No template named %s" % template_name)
+
+        def report(result):
+            printout("%s: %s in %.1fs" % (result['env'], result['status'], result['seconds']))
+            for key, error in sorted(result['errors'].iteritems()):
+                printout("  %s: %s" % (key, error))
+
+        # imported here as the importer uses this module
+        from createtemplate.provision import TemplateProvisioning
+        results = TemplateProvisioning(self.env).provision(template_path, env_paths,
+                                                            progress=report)
+        failed = [result for result in results if result['status'] != 'ok']
+        printout("Provisioned %s of %s environments from template %s" 
+                 % (len(results) - len(failed), len(results), template_name))
+        if failed:
+            raise AdminCommandError("Unable to provision %s environments" % len(failed))
@@ -0,0 +1,339 @@
+import gzip
+import errno
+import os
+import subprocess
+import sys
+import threading
+import time
+from distutils.spawn import find_executable
+
+# Streams Subversion dump archives in and out of project templates.
+#
+# Templates store the file archive as a compressed `svnadmin dump`. These
+# helpers move the dump between svnadmin and the archive in large chunks
+# without going through a shell, and drain the stderr of every process on
+# a thread of its own so a chatty process can't fill the pipe and stall
+# the copy.
+#
+# The dump can be compressed with Python's gzip module, with pigz (a
+# multi-threaded gzip, whose output any gzip can read) or with zstd. The
+# codec of an archive is recognised from its file extension.
+#
+# An archive either holds a snapshot of the repository at one revision,
+# the full history of the repository up to a revision, or an incremental
+# dump of the revisions made since the archive of an earlier template. A
+# chain of incremental archives always starts with a full history dump,
+# so every archive of the chain loads with the revision numbers it had in
+# the project, and the copy sources and mergeinfo of branches, tags and
+# moves still name the right revisions. Such a chain is loaded base first.
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+CODECS = ('gzip', 'pigz', 'zstd')
+
+EXTENSIONS = {'gzip': '.gz', 'pigz': '.gz', 'zstd': '.zst'}
+
+# the codec we decompress each extension with, in order of preference
+DECODERS = (('.zst', 'zstd'), ('.gz', 'gzip'))
+
+class PipeReader(threading.Thread):
+    """Reads a pipe until EOF on a daemon thread, keeping what it read."""
+
+    def __init__(self, pipe):
+        super(PipeReader, self).__init__(name='template-pipe-reader')
+        self.daemon = True
+        self.pipe = pipe
+        self.chunks = list()
+        self.start()
+
+    def run(self):
+        for line in iter(self.pipe.readline, ''):
+            self.chunks.append(line)
+        self.pipe.close()
+
+    @property
+    def data(self):
+        self.join()
+        return ''.join(self.chunks)
+
+class PipeWriter(threading.Thread):
+    """Copies a file object into a pipe on a daemon thread, and closes the
+    pipe when it is done. An exception raised by the copy is kept and 
+    raised again by close()."""
+
+    def __init__(self, fileobj, pipe, chunk_size=CHUNK_SIZE):
+        super(PipeWriter, self).__init__(name='template-pipe-writer')
+        self.daemon = True
+        self.fileobj = fileobj
+        self.pipe = pipe
+        self.chunk_size = chunk_size
+        self.exc_info = None
+        self.start()
+
+    def run(self):
+        try:
+            try:
+                _copy(self.fileobj, self.pipe, self.chunk_size)
+            finally:
+                _close(self.pipe)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def close(self):
+        """Waits for the copy to finish, and raises the exception it failed
+        with if it did."""
+
+        self.join()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+def archive_filename(template_name, codec):
+    """Returns the file name of the archive of a template made with codec."""
+
+    return template_name + '.dump' + EXTENSIONS[codec]
+
+def find_archive(template_path):
+    """Returns the path of the file archive in the template directory, or
+    None if the template doesn't have one."""
+
+    template_name = os.path.basename(os.path.normpath(template_path))
+    for extension, codec in DECODERS:
+        path = os.path.join(template_path, template_name + '.dump' + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+def archive_codec(archive_path):
+    """Returns the codec to decompress archive_path with, based on its
+    file extension."""
+
+    for extension, codec in DECODERS:
+        if archive_path.endswith(extension):
+            return codec
+    raise ValueError("Unknown archive format %s" % archive_path)
+
+def codec_available(codec):
+    """Returns True if the programs needed by codec are installed."""
+
+    return codec == 'gzip' or find_executable(codec) is not None
+
+def youngest_revision(repo_path):
+    """Returns the youngest revision of the repository at repo_path.
+
+    Raises OSError if svnlook can't be run or fails."""
+
+    process = subprocess.Popen(['svnlook', 'youngest', repo_path],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               close_fds=True)
+    stdout, stderr = process.communicate()
+    if process.returncode:
+        raise OSError("svnlook youngest %s failed: %s" % (repo_path, stderr.strip()))
+    return int(stdout)
+
+def dump_archive(repo_path, archive_path, codec='gzip', level=9, threads=0,
+                 chunk_size=CHUNK_SIZE, revision='HEAD', base_revision=None,
+                 history=False):
+    """Dumps the repository at repo_path into a new archive at
+    archive_path, compressed with codec at the given level. threads limits
+    the threads used by pigz and zstd, 0 meaning one per core.
+
+    Without a base_revision the archive is a snapshot of the repository at
+    revision, which loads as r1, or with history the whole history of the
+    repository up to revision. Otherwise it is an incremental dump, with
+    deltas, of the revisions after base_revision up to revision, which
+    only loads into a repository holding revisions 0 to base_revision.
+
+    Returns a dictionary with the exit status of svnadmin, or failing that
+    of the compressor ('returncode'), the size of the dump ('bytes') and of the
+    archive ('compressed_bytes'), the time the dump took ('seconds') and
+    anything written to stderr ('stderr').
+
+    Raises OSError if svnadmin or the compressor can't be run."""
+
+    start = time.time()
+    if base_revision is not None:
+        args = ['-r%s:%s' % (base_revision + 1, revision), '--incremental', '--deltas']
+    elif history:
+        args = ['-r0:%s' % revision, '--deltas']
+    else:
+        args = ['-r%s' % revision]
+    dump = subprocess.Popen(['svnadmin', 'dump', '--quiet'] + args + [repo_path],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            bufsize=chunk_size,
+                            close_fds=True)
+    dump_stderr = PipeReader(dump.stderr)
+
+    try:
+        output, compressor, compressor_stderr = _open_compressor(archive_path, codec,
+                                                                 level, threads)
+    except OSError:
+        dump.kill()
+        dump.wait()
+        raise
+
+    try:
+        size = _copy(dump.stdout, output, chunk_size)
+    finally:
+        dump.stdout.close()
+        _close(output)
+        returncodes = [dump.wait()]
+        stderr = [dump_stderr.data]
+        if compressor:
+            returncodes.append(compressor.wait())
+            stderr.append(compressor_stderr.data)
+
+    return {'returncode': ([code for code in returncodes if code] or [0])[0],
+            'bytes': size,
+            'compressed_bytes': os.path.getsize(archive_path),
+            'seconds': time.time() - start,
+            'stderr': ''.join(stderr)}
+
+def load_archive(archive_path, repo_path, chunk_size=CHUNK_SIZE, fileobj=None):
+    """Loads the dump in the archive at archive_path into the repository
+    at repo_path with `svnadmin load`, decompressing it with the codec
+    matching its extension. If fileobj is given the archive is read from
+    it rather than from archive_path, e.g. out of a packed template.
+
+    Returns a dictionary with the exit status of svnadmin, or failing that
+    of the decompressor ('returncode'), the number of uncompressed bytes fed to
+    svnadmin ('bytes'), the time the load took ('seconds') and anything
+    written to stderr ('stderr').
+
+    Raises IOError if the archive can't be opened or fileobj can't be 
+    read, and OSError if svnadmin or the decompressor can't be run."""
+
+    start = time.time()
+    archive, decompressor, decompressor_stderr, writer = \
+        _open_decompressor(archive_path, fileobj)
+    devnull = open(os.devnull, 'wb')
+    try:
+        process = subprocess.Popen(['svnadmin', 'load', '--quiet', repo_path],
+                                   stdin=subprocess.PIPE,
+                                   stdout=devnull,
+                                   stderr=subprocess.PIPE,
+                                   bufsize=chunk_size,
+                                   close_fds=True)
+    except OSError:
+        _close(archive)
+        if decompressor:
+            decompressor.wait()
+        if writer:
+            writer.join()
+        devnull.close()
+        raise
+    load_stderr = PipeReader(process.stderr)
+
+    try:
+        size = _copy(archive, process.stdin, chunk_size)
+    finally:
+        _close(archive)
+        devnull.close()
+        _close(process.stdin)
+        returncodes = [process.wait()]
+        stderr = [load_stderr.data]
+        if decompressor:
+            returncodes.append(decompressor.wait())
+            stderr.append(decompressor_stderr.data)
+        # if fileobj couldn't be read the dump svnadmin got was cut short,
+        # which is what we report rather than its exit status
+        if writer:
+            writer.close()
+
+    return {'returncode': ([code for code in returncodes if code] or [0])[0],
+            'bytes': size,
+            'seconds': time.time() - start,
+            'stderr': ''.join(stderr)}
+
+def throughput(stats):
+    """Returns the throughput in MB/s of a load or dump described by
+    stats, as returned by load_archive() or dump_archive()."""
+
+    if stats['seconds'] <= 0:
+        return 0.0
+    return stats['bytes'] / stats['seconds'] / (1024 * 1024)
+
+def _open_compressor(archive_path, codec, level, threads):
+    """Returns a (file, process, stderr) tuple - the file to write the
+    dump to, and the compressor process and its PipeReader if the codec
+    uses one."""
+
+    if codec == 'gzip':
+        return gzip.GzipFile(archive_path, 'wb', level), None, None
+
+    if codec == 'pigz':
+        args = ['pigz', '-%d' % level, '-c']
+        if threads:
+            args[1:1] = ['-p', str(threads)]
+    elif codec == 'zstd':
+        args = ['zstd', '-%d' % level, '-T%d' % threads, '-q', '-c']
+    else:
+        raise ValueError("Unknown archive codec %s" % codec)
+
+    with open(archive_path, 'wb') as output:
+        process = subprocess.Popen(args,
+                                   stdin=subprocess.PIPE,
+                                   stdout=output,
+                                   stderr=subprocess.PIPE,
+                                   close_fds=True)
+    return process.stdin, process, PipeReader(process.stderr)
+
+def _open_decompressor(archive_path, fileobj=None):
+    """Returns a (file, process, stderr, writer) tuple - the file to read
+    the dump from, the decompressor process and its PipeReader if the
+    codec uses one, and the PipeWriter feeding fileobj to the 
+    decompressor if there is one, which has to be closed once the 
+    decompressor has exited."""
+
+    codec = archive_codec(archive_path)
+    if codec == 'gzip':
+        if fileobj is not None:
+            return gzip.GzipFile(mode='rb', fileobj=fileobj), None, None, None
+        return gzip.GzipFile(archive_path, 'rb'), None, None, None
+
+    if fileobj is not None:
+        process = subprocess.Popen(['zstd', '-d', '-q', '-c'],
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   close_fds=True)
+        writer = PipeWriter(fileobj, process.stdin)
+        return process.stdout, process, PipeReader(process.stderr), writer
+
+    # raise the IOError GzipFile would for a missing archive, rather than
+    # leaving zstd to fail on it
+    open(archive_path, 'rb').close()
+    process = subprocess.Popen(['zstd', '-d', '-q', '-c', archive_path],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               close_fds=True)
+    return process.stdout, process, PipeReader(process.stderr), None
+
+def _copy(source, target, chunk_size):
+    """Copies source to target in chunks until source is exhausted or the
+    process reading target exits, and returns the number of bytes copied."""
+
+    size = 0
+    while True:
+        data = source.read(chunk_size)
+        if not data:
+            break
+        try:
+            target.write(data)
+        except IOError as exception:
+            # the process gave up, its exit status and stderr say why
+            if exception.errno == errno.EPIPE:
+                break
+            raise
+        size += len(data)
+    return size
+
+def _close(fileobj):
+    """Closes fileobj, ignoring a broken pipe - see _copy()."""
+
+    try:
+        fileobj.close()
+    except IOError as exception:
+        if exception.errno != errno.EPIPE:
+            raise
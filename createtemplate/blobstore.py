@@ -0,0 +1,201 @@
+import errno
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from createtemplate.files import copy_file, locked
+
+# A content addressed store for the files inside project templates.
+#
+# Templates taken from the same project usually contain the same
+# attachments and workflows, so instead of every template keeping its own
+# copy we store each distinct file once under the template directory,
+# named by the SHA-256 of its content. Each template then has a small
+# blobs.json manifest which maps the paths of its files to those hashes:
+#
+#   {"attachments/wiki": {"WikiStart/logo.png": "3a7bd3e2360a..."},
+#    "workflows": {"task.xml": "b5bb9d8014a0..."}}
+
+BLOB_DIR = '.blobs'
+BLOB_LOCK = '.lock'
+MANIFEST = 'blobs.json'
+
+# blobs.json is shared by the components of a template which might be
+# exported concurrently, so updates to it are serialized
+_manifest_lock = threading.Lock()
+
+class BlobStore(object):
+    """The shared blob store of a template directory."""
+
+    def __init__(self, template_dir):
+        self.path = os.path.join(template_dir, BLOB_DIR)
+
+    @classmethod
+    def for_template(cls, template_path):
+        """Returns the blob store used by the template at template_path."""
+
+        return cls(os.path.dirname(os.path.normpath(template_path)))
+
+    def blob_path(self, digest):
+        """Returns the path of the blob with the given hash. The first two
+        characters are used as a subdirectory to keep directories small."""
+
+        return os.path.join(self.path, digest[:2], digest)
+
+    def add(self, filename, strategy='copy'):
+        """Adds the file at filename to the store unless a blob with the
+        same content already exists, in which case the blob is touched so
+        collect_garbage() leaves it alone until our manifest is written.
+        Returns the hash of the file.
+
+        The hardlink strategy is treated as reflink, as a blob sharing its
+        inode with the file of a project would change when the project 
+        changes the file."""
+
+        strategy = _unlinked_strategy(strategy)
+        digest = file_digest(filename)
+        blob_path = self.blob_path(digest)
+        blob_dir = os.path.dirname(blob_path)
+        _makedirs(blob_dir)
+        with self.locked():
+            if os.path.exists(blob_path):
+                os.utime(blob_path, None)
+                return digest
+
+        # place the blob under a temporary name and rename it, so a half
+        # written blob is never visible under its hash. The rename gives 
+        # the blob a new ctime, so we don't need the lock for this.
+        fd, temp_path = tempfile.mkstemp(dir=blob_dir, prefix='.tmp-')
+        os.close(fd)
+        try:
+            copy_file(filename, temp_path, strategy)
+            os.rename(temp_path, blob_path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return digest
+
+    def place(self, digest, destination, strategy='copy'):
+        """Places a copy of the blob with the given hash at destination 
+        with copy_file() and returns the strategy used.
+
+        As in add(), the hardlink strategy is treated as reflink - the 
+        blob is shared by every template and project which uses it, so 
+        it must never share its inode with a file a project can change."""
+
+        return copy_file(self.blob_path(digest), destination, 
+                         _unlinked_strategy(strategy))
+
+    def locked(self):
+        """Returns a context manager holding the lock of the store, which 
+        keeps collect_garbage() from removing a blob while add() reuses it."""
+
+        _makedirs(self.path)
+        return locked(os.path.join(self.path, BLOB_LOCK))
+
+    def digests(self):
+        """Yields the hash of every blob in the store."""
+
+        try:
+            subdirs = os.listdir(self.path)
+        except OSError as exception:
+            if exception.errno == errno.ENOENT:
+                return
+            raise
+        for subdir in subdirs:
+            if subdir.startswith('.'):
+                # the lock file
+                continue
+            for name in os.listdir(os.path.join(self.path, subdir)):
+                if not name.startswith('.'):
+                    yield name
+
+    def collect_garbage(self, referenced, min_age=3600):
+        """Removes every blob whose hash is not in referenced and returns a
+        list of the removed hashes.
+
+        A blob is added before the manifest which refers to it is written,
+        so we leave alone blobs which were added to the store, or reused by
+        add(), less than min_age seconds ago in case an export is still 
+        running. We check the ctime, which renaming or touching a blob 
+        always updates."""
+
+        removed = []
+        now = time.time()
+        for digest in list(self.digests()):
+            if digest in referenced:
+                continue
+            blob_path = self.blob_path(digest)
+            with self.locked():
+                if now - os.stat(blob_path).st_ctime < min_age:
+                    continue
+                os.remove(blob_path)
+            removed.append(digest)
+        return removed
+
+def _unlinked_strategy(strategy):
+    """Returns the copy strategy to use for a blob instead of strategy."""
+
+    if strategy == 'hardlink':
+        return 'reflink'
+    return strategy
+
+def _makedirs(path):
+    """Creates the directory at path unless it already exists."""
+
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+def file_digest(filename):
+    """Returns the SHA-256 hex digest of the content of filename."""
+
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as fileobj:
+        while True:
+            data = fileobj.read(1024*1024)
+            if not data:
+                break
+            sha.update(data)
+    return sha.hexdigest()
+
+def read_manifest(template_path):
+    """Returns the blob manifest of a template, or an empty dictionary if
+    the template stores its files in its own directory."""
+
+    try:
+        with open(os.path.join(template_path, MANIFEST)) as fileobj:
+            return json.load(fileobj)
+    except IOError as exception:
+        # ENOTDIR for packed templates, which are files
+        if exception.errno in (errno.ENOENT, errno.ENOTDIR):
+            return {}
+        raise
+
+def update_manifest(template_path, component, entries):
+    """Records the {relative path: hash} entries of a template component,
+    such as attachments/wiki, in the template's blob manifest."""
+
+    with _manifest_lock:
+        manifest = read_manifest(template_path)
+        manifest[component] = entries
+        temp_path = os.path.join(template_path, MANIFEST + '.tmp')
+        with open(temp_path, 'w') as fileobj:
+            json.dump(manifest, fileobj)
+        os.rename(temp_path, os.path.join(template_path, MANIFEST))
+
+def referenced_digests(template_paths):
+    """Returns the set of hashes referenced by the given templates."""
+
+    referenced = set()
+    for template_path in template_paths:
+        for entries in read_manifest(template_path).itervalues():
+            referenced.update(entries.itervalues())
+    return referenced
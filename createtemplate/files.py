@@ -0,0 +1,249 @@
+import errno
+import os
+import tempfile
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where we can't reflink anyway
+    fcntl = None
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+from trac.attachment import Attachment
+from trac.util.text import unicode_quote
+
+# Filesystem helpers shared by the template export and import code
+
+def attachment_relpath(parent_id, filename):
+    """Returns the path of an attachment relative to the attachments/wiki
+    directory of a template, quoted in the same way as the attachment
+    directories of Trac 0.12."""
+
+    return os.path.join(unicode_quote(parent_id), unicode_quote(filename))
+
+def attachment_path(env, parent_id, filename):
+    """Returns the path of the file of an attachment to the wiki page 
+    parent_id in env. Where the files are kept differs between versions of
+    Trac (Trac 1.0 names them after hashes), so we ask trac.attachment."""
+
+    attachment = Attachment(env, 'wiki', parent_id)
+    attachment.filename = filename
+    return attachment.path
+
+# ioctl request number for FICLONE from linux/fs.h, which asks filesystems
+# such as btrfs and XFS to share the data blocks of two files (a reflink)
+FICLONE = 0x40049409
+
+COPY_STRATEGIES = ('hardlink', 'reflink', 'copy')
+
+def copy_file(src, dst, strategy='copy'):
+    """Places a copy of the src file at dst, replacing any existing file.
+
+    The hardlink strategy makes dst another name for src, the reflink 
+    strategy makes a new file which shares its data blocks with src, and 
+    the copy strategy copies the data. If a strategy is not supported for
+    the two paths (e.g. they are on different filesystems) we fall back to 
+    the next one in that order, so the copy always succeeds if a plain copy 
+    would. Returns the strategy which was actually used, so callers copying
+    many files can skip strategies which are known not to work. The copy
+    strategy copies with copy_data(), so the data stays in the kernel
+    where possible."""
+
+    for candidate in COPY_STRATEGIES[COPY_STRATEGIES.index(strategy):]:
+        if os.path.lexists(dst):
+            os.remove(dst)
+        if candidate == 'hardlink':
+            try:
+                os.link(src, dst)
+                return candidate
+            except OSError as exception:
+                if exception.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+        elif candidate == 'reflink':
+            if _reflink(src, dst):
+                return candidate
+        else:
+            with open(src, 'rb') as source:
+                with open(dst, 'wb') as target:
+                    copy_data(source.fileno(), target.fileno())
+            return candidate
+
+# the largest amount of data we ask the kernel to copy in one call, and 
+# the size of the chunks we copy through Python otherwise
+KERNEL_COPY_SIZE = 1024 * 1024 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+
+def copy_data(src_fd, dst_fd, offset=0, count=None):
+    """Copies count bytes from offset in the file open as src_fd (by 
+    default up to its end) to the current position of the file open as 
+    dst_fd. Returns the number of bytes copied.
+
+    The data is copied by the kernel with copy_file_range() - which can 
+    share blocks or copy on the server on some filesystems - or failing 
+    that sendfile(), so it never passes through Python buffers. If neither
+    is available for these files we fall back to reading and writing 
+    chunks. The positions of both descriptors are undefined afterwards."""
+
+    if count is None:
+        count = max(os.fstat(src_fd).st_size - offset, 0)
+
+    copied = 0
+    for copier in _kernel_copiers():
+        try:
+            while copied < count:
+                size = copier(src_fd, dst_fd, offset + copied,
+                              min(count - copied, KERNEL_COPY_SIZE))
+                if size == 0:
+                    # the source ended early
+                    return copied
+                copied += size
+            return copied
+        except (IOError, OSError) as exception:
+            # try the next way of copying for the rest of the data
+            if exception.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+
+    os.lseek(src_fd, offset + copied, os.SEEK_SET)
+    while copied < count:
+        data = os.read(src_fd, min(count - copied, COPY_CHUNK_SIZE))
+        if not data:
+            break
+        while data:
+            written = os.write(dst_fd, data)
+            data = data[written:]
+            copied += written
+    return copied
+
+_copiers = None
+
+def _kernel_copiers():
+    """Returns the functions copying data between file descriptors in the
+    kernel which this system has, best first. Each is called with the 
+    source and destination descriptors, the offset in the source and the
+    number of bytes to copy, and returns the number of bytes copied."""
+
+    global _copiers
+    if _copiers is None:
+        _copiers = [copier for copier in (_copy_file_range(), _sendfile())
+                    if copier is not None]
+    return _copiers
+
+def _copy_file_range():
+    if hasattr(os, 'copy_file_range'):
+        return lambda src_fd, dst_fd, offset, count: \
+            os.copy_file_range(src_fd, dst_fd, count, offset)
+
+    function = _libc_function('copy_file_range', 
+                              [ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_int,
+                               ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint]
+                              if ctypes else None)
+    if function is None:
+        return None
+
+    def copy_file_range(src_fd, dst_fd, offset, count):
+        src_offset = ctypes.c_int64(offset)
+        return _check_result(function(src_fd, ctypes.byref(src_offset), dst_fd, None, 
+                                      count, 0))
+    return copy_file_range
+
+def _sendfile():
+    if hasattr(os, 'sendfile'):
+        return lambda src_fd, dst_fd, offset, count: \
+            os.sendfile(dst_fd, src_fd, offset, count)
+
+    function = _libc_function('sendfile64',
+                              [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                               ctypes.c_size_t]
+                              if ctypes else None)
+    if function is None:
+        return None
+
+    def sendfile(src_fd, dst_fd, offset, count):
+        src_offset = ctypes.c_int64(offset)
+        return _check_result(function(dst_fd, src_fd, ctypes.byref(src_offset), count))
+    return sendfile
+
+def _libc_function(name, argtypes):
+    """Returns the named function of the C library, or None if ctypes or
+    the function isn't available."""
+
+    if ctypes is None:
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+    function = getattr(libc, name, None)
+    if function is not None:
+        function.argtypes = argtypes
+        function.restype = ctypes.c_ssize_t
+    return function
+
+def _check_result(result):
+    """Raises an OSError from errno if result says a libc call failed."""
+
+    if result < 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+    return result
+
+# errno values which mean a link or clone isn't possible for these paths, 
+# rather than that something is actually wrong
+_UNSUPPORTED_ERRNOS = set(getattr(errno, name) for name in 
+                          ('EXDEV', 'EPERM', 'EMLINK', 'EOPNOTSUPP', 'ENOTSUP',
+                           'EINVAL', 'ENOTTY', 'ENOSYS')
+                          if hasattr(errno, name))
+
+def _reflink(src, dst):
+    """Tries to clone src to dst with the FICLONE ioctl. Returns False and
+    leaves no dst file behind if the filesystem can't do it."""
+
+    if fcntl is None:
+        return False
+    with open(src, 'rb') as source:
+        with open(dst, 'wb') as target:
+            try:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+                return True
+            except (IOError, OSError) as exception:
+                if exception.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+    os.remove(dst)
+    return False
+
+@contextmanager
+def locked(path):
+    """Holds an exclusive lock on the file at path (created if needed) for
+    the duration of the with block. This serializes updates to shared files
+    between processes, and between servers sharing an NFS mount which 
+    supports locking."""
+
+    with open(path, 'a') as lockfile:
+        if fcntl is not None:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+
+def write_atomically(path, data):
+    """Replaces the file at path with data. The data is written to a 
+    temporary file which is then renamed, so readers either see the old 
+    or the new content and never a partially written file."""
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), 
+                                     prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as fileobj:
+            fileobj.write(data)
+        # mkstemp only gives the owner access
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
@@ -1,8 +1,13 @@
+import json
+import threading
+
 from trac.core import *
-from trac.config import PathOption
-from trac.web import ITemplateStreamFilter
+from trac.config import ChoiceOption
+from trac.web import IRequestFilter, IRequestHandler, ITemplateStreamFilter
+from trac.web.chrome import Chrome, add_script, add_script_data
 from createtemplate.api import ProjectTemplateAPI
 from genshi.builder import tag
+from genshi.core import Markup, TEXT
 from genshi.filters.transform import Transformer
 
 # Author: Danny Milsom <danny.milsom@cgi.com>
@@ -12,7 +17,57 @@ class Filter(Component):
     dashboard project. We do this so we can dynamically list all project 
     templates."""
 
-    implements(ITemplateStreamFilter)
+    template_widget = ChoiceOption('project_templates', 'template_widget', 
+                    ['select', 'autocomplete'],
+                    doc="""How project request tickets offer the available 
+                    templates. `select` replaces the template field with a 
+                    select list of every template. `autocomplete` leaves the 
+                    field in place and searches the templates with 
+                    /templates/names as the user types, so the names aren't 
+                    sent with every page.""")
+
+    implements(IRequestFilter, IRequestHandler, ITemplateStreamFilter)
+
+    def __init__(self):
+        # (catalog key, events) of the rendered template select list
+        self._select_lock = threading.Lock()
+        self._select = None
+
+    # IRequestFilter
+
+    def pre_process_request(self, req, handler):
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        """Adds the template search script, and the jQuery UI autocomplete
+        widget it uses, to project request tickets when template_widget is 
+        `autocomplete`."""
+
+        if (template == 'ticket.html'
+            and self.template_widget == 'autocomplete'
+            and self._is_project_request(data)):
+            Chrome(self.env).add_jquery_ui(req)
+            add_script(req, 'createtemplate/js/template_autocomplete.js')
+            add_script_data(req, {'templateNamesUrl': req.href.templates('names')})
+        return template, data, content_type
+
+    # IRequestHandler
+
+    def match_request(self, req):
+        return req.path_info == '/templates/names'
+
+    def process_request(self, req):
+        """Returns the names of the templates as a JSON list. If the q 
+        argument is given only names containing it are returned."""
+
+        req.perm.require('TICKET_VIEW')
+
+        names = sorted(ProjectTemplateAPI(self.env).get_all_templates(),
+                       key=lambda name: name.lower())
+        query = req.args.get('q', '').strip().lower()
+        if query:
+            names = [name for name in names if query in name.lower()]
+        req.send(json.dumps(names), 'application/json')
 
     # ITemplateStreamFilter
 
@@ -26,31 +81,61 @@ class Filter(Component):
 
         We don't have these options in the trac.ini file as they are dynamic, 
         and don't use a select list by default as this will cause validation
-        issues."""
+        issues.
+
+        This runs for every template Trac renders, so we return straight 
+        away unless we are rendering ticket.html with the `select` 
+        template_widget."""
+
+        if filename != 'ticket.html' or self.template_widget != 'select':
+            return stream
+
+        if self._is_project_request(data):
+            # replace the text input with a select list
+            stream = stream | Transformer("//*[@id='field-template']").replace(self._template_select())
+
+        return stream
+
+    def _is_project_request(self, data):
+        """Returns True if data is for a project request ticket on the 
+        dashboard project."""
 
         try:
             ticket_type = data['ticket']['type']
-        except KeyError:
+        except (KeyError, TypeError):
             ticket_type = None
 
-        if (filename == 'ticket.html' 
-            and ticket_type == 'projectrequest'
-            and self.env.is_component_enabled('define.dashboard.DashboardDisplayModule')):
+        return (ticket_type == 'projectrequest'
+                and self.env.is_component_enabled('define.dashboard.DashboardDisplayModule'))
 
-            # get a list of available templates
-            templates = ProjectTemplateAPI(self.env).get_all_templates()
-            # we need a None option for the default
-            templates.insert(0, 'None')
+    def _template_select(self):
+        """Returns the stream events of the select list of templates.
 
-            # generate the select list markup
-            select = tag.select(name='field_template')
-            for template in templates:
-                if template == 'None':
-                    select.append(tag.option(template, value=template, selected='selected'))
-                else:
-                    select.append(tag.option(template, value=template))
+        Listing the templates and building the select list is costly, so 
+        we render the list once and reuse the markup until the catalog of
+        templates changes."""
 
-            # replace the text input with a select list
-            stream = stream | Transformer("//*[@id='field-template']").replace(select)
+        api = ProjectTemplateAPI(self.env)
+        key = api.get_catalog_key()
+        with self._select_lock:
+            if key is not None and self._select is not None and self._select[0] == key:
+                return self._select[1]
+
+        # get a list of available templates
+        templates = api.get_all_templates()
+        # we need a None option for the default
+        templates.insert(0, 'None')
+
+        # generate the select list markup
+        select = tag.select(name='field_template')
+        for template in templates:
+            if template == 'None':
+                select.append(tag.option(template, value=template, selected='selected'))
+            else:
+                select.append(tag.option(template, value=template))
 
-        return stream
\ No newline at end of file
+        events = [(TEXT, Markup(select.generate().render('xhtml', encoding=None)),
+                   (None, -1, -1))]
+        with self._select_lock:
+            self._select = (key, events)
+        return events
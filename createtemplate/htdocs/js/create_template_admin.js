@@ -11,6 +11,9 @@ var form = {
       width: "off"
     });
     form.events();
+    if (window.jobStatusUrl) {
+      job.poll();
+    }
   },
 
   draw_dialogs: function() {
@@ -62,4 +65,79 @@ var form = {
   }
 };
 
+var job = {
+
+  interval: 2000,
+
+  // polls in a row which may fail before we give up on the job
+  max_failures: 5,
+  failures: 0,
+
+  labels: {
+    wiki_pages: "Wiki Pages",
+    attachments: "Wiki Attachments",
+    ticket_types: "Ticket Types",
+    workflows: "Workflows",
+    priority: "Priorities",
+    versions: "Versions",
+    components: "Components",
+    repos: "Subversion Repositories",
+    milestones: "Milestones",
+    groups: "Groups",
+    lists: "Mailing lists"
+  },
+
+  poll: function() {
+    $.getJSON(window.jobStatusUrl, job.update)
+      .fail(function(xhr) {
+        // the job is gone or we may not see it, so polling won't help
+        if (xhr.status == 404 || xhr.status == 403) {
+          job.finish("box-warning", "fa-exclamation-triangle",
+                     "Sorry, the progress of the template can't be shown.");
+        } else if (++job.failures >= job.max_failures) {
+          job.finish("box-warning", "fa-exclamation-triangle",
+                     "Sorry, the progress of the template couldn't be " +
+                     "fetched. Reload the page to try again.");
+        } else {
+          setTimeout(job.poll, job.interval);
+        }
+      });
+  },
+
+  update: function(status) {
+    job.failures = 0;
+    var $list = $("#template-job-components").empty(),
+        partial = false;
+    $.each(status.components, function(__, component) {
+      var label = job.labels[component.component] || component.component,
+          text = label + ": " + component.status;
+      if (component.status == "done" && component.result) {
+        text += " (" + component.result.length + ")";
+      } else if (component.status == "failed") {
+        partial = true;
+      }
+      $("<li>").text(text).appendTo($list);
+    });
+
+    if (status.status == "done") {
+      job.finish("box-success", "fa-check-circle",
+                 "Congratulations! You created a new template!");
+    } else if (status.status == "failed" && partial) {
+      job.finish("box-warning", "fa-exclamation-triangle",
+                 "Sorry, some parts of the template could not be created.");
+    } else if (status.status == "failed") {
+      job.finish("box-warning", "fa-exclamation-triangle",
+                 "Sorry, the template could not be created.");
+    } else {
+      setTimeout(job.poll, job.interval);
+    }
+  },
+
+  finish: function(box, icon, message) {
+    $("#template-job").removeClass("box-info").addClass(box)
+      .find("h3 i").attr("class", "fa " + icon);
+    $("#template-job-status").text(message);
+  }
+};
+
 $(document).ready(form.init);
\ No newline at end of file
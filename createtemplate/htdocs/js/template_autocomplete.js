@@ -0,0 +1,44 @@
+var templateSearch = {
+
+  names: [],
+
+  init: function() {
+    var $field = $("#field-template");
+    if (!$field.length || !window.templateNamesUrl) {
+      return;
+    }
+    if (!$field.val()) {
+      $field.val("None");
+    }
+
+    $field.autocomplete({
+      minLength: 0,
+      delay: 200,
+      source: templateSearch.source,
+      change: templateSearch.validate
+    }).on("focus", function() {
+      $(this).autocomplete("search", $(this).val());
+    });
+  },
+
+  source: function(request, response) {
+    $.getJSON(window.templateNamesUrl, { q: request.term })
+      .done(function(names) {
+        // we still offer None for projects without a template
+        templateSearch.names = ["None"].concat(names);
+        response(templateSearch.names);
+      })
+      .fail(function() {
+        response([]);
+      });
+  },
+
+  validate: function(event, ui) {
+    // only accept template names, like the select list did
+    if (!ui.item && $.inArray($(this).val(), templateSearch.names) == -1) {
+      $(this).val("None");
+    }
+  }
+};
+
+$(document).ready(templateSearch.init);
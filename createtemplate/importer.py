@@ -1,30 +1,47 @@
 import os
-import subprocess
 import shutil
 import errno
-# cElementTree is C implementation and faster
-# http://eli.thegreenplace.net/2012/03/15/processing-xml-in-python-with-elementtree/
-try:
-    import xml.etree.cElementTree as ET
-except ImportError:
-    import xml.etree.ElementTree as ET
-
-from trac.attachment import Attachment
+import time
+from datetime import datetime
+
 from trac.core import *
+from trac.wiki.api import WikiSystem
 from trac.wiki.model import WikiPage
 from trac.ticket import model
 from trac.perm import PermissionSystem
-from trac.config import PathOption, ListOption
-from trac.util.datefmt import parse_date
-from trac.util.text import unicode_quote
+from trac.config import BoolOption, ChoiceOption, IntOption, PathOption, ListOption
+from trac.resource import Resource, ResourceNotFound
+from trac.util.datefmt import from_utimestamp, parse_date, to_utimestamp, utc
 
 from logicaordertracker.controller import LogicaOrderController
 from simplifiedpermissionsadminplugin.simplifiedpermissions import SimplifiedPermissions
 from mailinglistplugin.model import Mailinglist
+from createtemplate.admin import GenerateTemplate
 from createtemplate.api import ProjectTemplateAPI
+from createtemplate.archive import find_archive, load_archive, throughput
+from createtemplate.blobstore import BlobStore, read_manifest
+from createtemplate.files import attachment_path, attachment_relpath
+from createtemplate.importstats import ImportStats
+from createtemplate.packed import open_template, template_name
+from createtemplate.templateio import JSONL_EXTENSION, TemplateReader, table_name
+from createtemplate.workers import run_tasks
 
 # Author: Danny Milsom <danny.milsom@cgi.com>
 
+# The tables template_populate() imports, and the database tables (and
+# enum types) it clears before doing so
+POPULATED_TABLES = {'group': ['groups', 'permission'],
+                    'milestone': ['milestone'],
+                    'component': ['component'],
+                    'version': ['version'],
+                    'priority': ['enum:priority'],
+                    'ticket': ['enum:ticket_type'],
+}
+
+# The steps of the database stage of import_template(), in the order they
+# run, as named in its results and the import statistics
+DATABASE_PARTS = ('tables', 'wiki', 'attachments', 'mailinglists')
+
 class ImportTemplate(Component):
     """Creates data and components inside #define based on XML template files"""
 
@@ -35,60 +52,453 @@ class ImportTemplate(Component):
                         'initial_define_data_version, define_data_version',
                         doc='Version values which should be updated.')
 
+    bulk_wiki_import = BoolOption('project_templates', 'bulk_wiki_import', 'true',
+                        doc="""Insert template wiki pages in batches directly into
+                        the wiki table, rather than saving each page through
+                        the wiki API.""")
+
+    wiki_import_batch_size = IntOption('project_templates', 'wiki_import_batch_size', 500,
+                        doc="Number of wiki pages inserted per transaction by a bulk import.")
+
+    wiki_import_listeners = ChoiceOption('project_templates', 'wiki_import_listeners',
+                        ['deferred', 'suppressed'],
+                        doc="""Whether wiki change listeners are notified about
+                        the pages created by a bulk wiki import once each batch
+                        of pages has been committed (`deferred`), or not at all
+                        (`suppressed`).""")
+
+    # set by use_parsed_template()
+    _parsed_template = None
+
+    def use_parsed_template(self, parsed_template):
+        """Makes the importers read the template of parsed_template, a
+        ParsedTemplate, from memory rather than from its files."""
+
+        self._parsed_template = parsed_template
+
+    def template_reader(self, template_path):
+        """Returns the TemplateReader the importers read the template at 
+        template_path with."""
+
+        parsed = self._parsed_template
+        if parsed is not None and parsed.template_path == template_path:
+            return parsed
+        return TemplateReader(template_path)
+
+    def import_template(self, template_path, progress=None):
+        """Imports the template data, wiki and file archive into the project.
+
+        Loading the Subversion dump is bound by svnadmin and the disk, while
+        populating the tables and wiki is bound by the database, so rather
+        than one after the other we run them as two stages on their own 
+        threads. The database stage runs template_populate(), 
+        import_wiki_pages(), import_wiki_attachments() and 
+        import_mailinglist() in order, as they share one database 
+        connection. 
+
+        Returns the (results, errors) of the stages, keyed on 'database'
+        and 'repos', as run_tasks() does. The result of 'database' has the
+        seconds taken by its 'tables', 'wiki', 'attachments' and 
+        'mailinglists' steps, and
+        the result of 'repos' is None if the template has no file archive. 
+        progress is passed on to run_tasks().
+
+        The throughput of each step is recorded for plan_import()."""
+
+        tasks = [('database', self._import_database, (template_path,)),
+                 ('repos', self.import_file_archive, (template_path,))]
+
+        results, errors = run_tasks(self.env, tasks, len(tasks), progress)
+        for key, exc_info in errors.iteritems():
+            self.log.error("Unable to import %s from template %s", key, template_path,
+                           exc_info=exc_info)
+        self._record_throughput(template_path, results)
+        return results, errors
+
+    def _import_database(self, template_path):
+        """The database stage of import_template(). A step which fails
+        fails the whole stage, as the steps after it would import into a
+        half populated project."""
+
+        timings = dict()
+        for part, step in (('tables', self.template_populate),
+                           ('wiki', self.import_wiki_pages),
+                           ('attachments', self.import_wiki_attachments),
+                           ('mailinglists', self.import_mailinglist)):
+            start = time.time()
+            try:
+                step(template_path)
+            except Exception:
+                self.log.error("Importing the %s of template %s failed after "
+                               "importing %s", part, template_path, 
+                               ', '.join(sorted(timings)) or 'nothing')
+                raise
+            timings[part] = time.time() - start
+        return timings
+
+    def _record_throughput(self, template_path, results):
+        """Records the throughput of the steps of import_template() which
+        succeeded, see ImportStats."""
+
+        try:
+            sizes = self.template_sizes(template_path)
+            timings = results.get('database') or {}
+            measurements = [(self._throughput_kind(part, sizes['format']), 
+                             sizes[part], timings[part])
+                            for part in DATABASE_PARTS if part in timings]
+            repos = results.get('repos')
+            if repos and not repos['returncode'] and sizes['archive'] is not None:
+                measurements.append(('archive', sizes['archive'], repos['seconds']))
+            ImportStats.for_template(template_path).record(measurements)
+        except (IOError, OSError, ResourceNotFound) as exception:
+            self.log.warning("Unable to record the import throughput of %s: %s", 
+                             template_path, exception)
+
+    def _throughput_kind(self, part, template_format):
+        """Returns the kind of throughput measurement for part of a template,
+        see ImportStats."""
+
+        if part in ('tables', 'wiki', 'mailinglists'):
+            return '%s.%s' % (part, template_format)
+        return part
+
+    def template_sizes(self, template_path):
+        """Returns a dictionary with the size in bytes of the parts of the
+        template which import_template() imports - the tables imported by
+        template_populate() ('tables'), the wiki pages ('wiki'), the wiki
+        attachment files ('attachments'), the mailing lists 
+        ('mailinglists') and the compressed archives of the
+        file archive ('archive', None if a base template is missing) - and
+        the format of the table files ('format').
+
+        Only the sizes of files are looked up, nothing is read."""
+
+        template = open_template(template_path)
+        sizes = {'format': 'xml', 'tables': 0, 'wiki': 0, 'attachments': 0,
+                 'mailinglists': 0, 'archive': 0}
+
+        for filename in template.listdir():
+            table = table_name(filename)
+            if table is None:
+                continue
+            if filename.endswith(JSONL_EXTENSION):
+                sizes['format'] = 'jsonl'
+            if table == 'wiki':
+                sizes['wiki'] += template.size(filename)
+            elif table == 'mailinglist':
+                sizes['mailinglists'] += template.size(filename)
+            elif table in POPULATED_TABLES:
+                sizes['tables'] += template.size(filename)
+
+        attachment_blobs = read_manifest(template_path).get('attachments/wiki')
+        if attachment_blobs is not None:
+            store = BlobStore.for_template(template_path)
+            sizes['attachments'] = sum(os.path.getsize(store.blob_path(digest))
+                                       for digest in attachment_blobs.itervalues())
+        elif template.isdir('attachments/wiki'):
+            sizes['attachments'] = sum(size for relpath, size 
+                                       in template.files('attachments/wiki'))
+
+        try:
+            sizes['archive'] = sum(archive.size(relpath) for archive, relpath
+                                   in self.archive_chain(template_path))
+        except ResourceNotFound:
+            sizes['archive'] = None
+        return sizes
+
+    def plan_import(self, template_path):
+        """Returns a dictionary describing what import_template() would do
+        with the template, without writing anything to the project.
+
+        The template is streamed through once to count the rows of each 
+        table ('rows', with the permissions of groups as 'permission'). We
+        also report the database tables whose content would be replaced 
+        ('replaces'), the number and total size of wiki attachments, the
+        number of mailing lists (as 'mailinglist' in 'rows'), the
+        number of workflows, the archives of the file archive with their 
+        compressed and uncompressed ('dump_bytes') sizes, and an estimate
+        of how long the import would take in seconds.
+
+        The estimate divides the sizes from template_sizes() by the 
+        throughput measured during earlier imports on this server. The 
+        database and repository stages run in parallel, so the estimate is
+        the longer of the two. Parts which haven't been measured yet are
+        listed as 'unmeasured', and leave the estimates they are needed for
+        as None."""
+
+        name = template_name(template_path)
+        template = open_template(template_path)
+        reader = self.template_reader(template_path)
+        tables = set(table_name(filename) for filename in template.listdir())
+
+        rows = dict()
+        replaces = set()
+        for table in sorted(tables & set(POPULATED_TABLES)):
+            replaces.update(POPULATED_TABLES[table])
+            rows[table] = 0
+            for record in reader.records(table):
+                rows[table] += 1
+                if table == 'group':
+                    rows['permission'] = rows.get('permission', 0) + len(record.perms)
+        if 'wiki' in tables:
+            rows['wiki'] = sum(1 for page in reader.wiki_pages() if page.text)
+        if 'attachment' in tables:
+            replaces.add('attachment')
+            rows['attachment'] = sum(1 for attachment in reader.attachments())
+        if 'mailinglist' in tables:
+            rows['mailinglist'] = sum(1 for mailinglist in reader.mailinglists())
+
+        workflow_blobs = read_manifest(template_path).get('workflows')
+        if workflow_blobs is not None:
+            workflows = len(workflow_blobs)
+        elif template.isdir('workflows'):
+            workflows = sum(1 for workflow in template.files('workflows'))
+        else:
+            workflows = 0
+
+        archive = {'archives': [], 'compressed_bytes': 0, 'dump_bytes': 0}
+        api = ProjectTemplateAPI(self.env)
+        try:
+            for source, relpath in self.archive_chain(template_path):
+                archive['archives'].append(os.path.join(source.path, relpath))
+                archive['compressed_bytes'] += source.size(relpath)
+                info = api.get_template_information(template_name(source.path))
+                dump_size = (info.get('archive') or {}).get('dump_size')
+                if dump_size is None or archive['dump_bytes'] is None:
+                    archive['dump_bytes'] = None
+                else:
+                    archive['dump_bytes'] += dump_size
+        except ResourceNotFound as exception:
+            archive['error'] = unicode(exception)
+
+        sizes = self.template_sizes(template_path)
+        stats = ImportStats.for_template(template_path)
+        samples = stats.samples()
+        seconds = dict()
+        unmeasured = list()
+        for part in DATABASE_PARTS + ('archive',):
+            kind = self._throughput_kind(part, sizes['format'])
+            if not sizes[part]:
+                seconds[part] = 0.0 if sizes[part] is not None else None
+                continue
+            throughput = stats.throughput(kind, samples)
+            if throughput is None:
+                unmeasured.append(kind)
+                seconds[part] = None
+            else:
+                seconds[part] = round(sizes[part] / throughput, 3)
+
+        database_parts = [seconds[part] for part in DATABASE_PARTS]
+        database = None if None in database_parts else sum(database_parts)
+        repos = seconds['archive']
+        total = None if database is None or repos is None else max(database, repos)
+
+        return {'template': name,
+                'format': sizes['format'],
+                'rows': rows,
+                'replaces': sorted(replaces),
+                'attachments': {'count': rows.get('attachment', 0),
+                                'bytes': sizes['attachments']},
+                'workflows': workflows,
+                'archive': archive,
+                'sizes': sizes,
+                'estimate': {'seconds': total,
+                             'database_seconds': database,
+                             'repos_seconds': repos,
+                             'parts': seconds,
+                             'unmeasured': unmeasured}}
+
     def import_wiki_pages(self, template_path):
         """Creates wiki pages from wiki.xml template file.
 
         Creates wiki pages inside the project using data extracted from
         an wiki.ml file. We don't set the author or version as that wouldn't 
         be applicable to a new project.
+
+        Unless bulk_wiki_import is disabled, pages are inserted directly
+        in batches while we stream through wiki.xml - see 
+        _bulk_import_wiki_pages().
         """
 
         # open the wiki XML file, parse the data and create wiki pages
-        full_path = os.path.join(template_path, 'wiki.xml')
+        reader = self.template_reader(template_path)
+        full_path = os.path.join(template_path, reader.filename('wiki'))
+        pages = reader.wiki_pages()
         try:
-            tree = ET.ElementTree(file=full_path)
-            for page in tree.getroot():
+            if self.bulk_wiki_import:
+                self._bulk_import_wiki_pages(pages)
+                return
+
+            for page in pages:
                 if page.text:
-                    wikipage = WikiPage(self.env, page.attrib['name'])
-                    wikipage.readonly = int(page.attrib['readonly']) # we store as a string in xml
+                    wikipage = WikiPage(self.env, page.name)
+                    wikipage.readonly = page.readonly
                     wikipage.text = page.text
                     wikipage.save(None, None, None)
-                    self.log.info("Wiki page %s created", page.attrib['name'])
+                    self.log.info("Wiki page %s created", page.name)
                 else:
                     self.log.debug("Cannot create wiki pages with no text. "
-                                   "Unable to import %s", wikipage)
+                                   "Unable to import %s", page.name)
         except IOError as exception:
             if exception.errno == errno.ENOENT:
-                self.log.info("Path to wiki.xml file %s does not exist. Unable "
+                self.log.info("Path to wiki file %s does not exist. Unable "
                               "to import wiki pages from template.", full_path)
+                return
+            raise
+
+    def _bulk_import_wiki_pages(self, pages):
+        """Inserts the pages read from wiki.xml straight into the wiki table.
+
+        WikiPage.save() commits once per page and notifies every wiki change
+        listener (search indexers, notifications etc.) as it goes, which 
+        makes importing a large wiki very slow. Here we stream the pages 
+        out of wiki.xml with TemplateReader and insert them in batches of
+        wiki_import_batch_size per transaction. Listeners are either 
+        notified about the pages of each batch once it has been committed,
+        or not at all, depending on wiki_import_listeners. The pages they
+        are given are built from the rows we inserted, rather than loaded 
+        back from the database one by one.
+        """
 
-    def import_wiki_attachments(self, template_path):
-        """Imports wiki attachments from template using the Attachment API."""
+        # pages which already exist (like WikiStart) get a new version
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT name, MAX(version) FROM wiki GROUP BY name")
+        versions = dict(cursor.fetchall())
 
-        # check that there are attachments to import
-        template_attachment_path = os.path.join(template_path, 'attachments', 'wiki')
-        if os.path.isdir(template_attachment_path):
+        now = to_utimestamp(datetime.now(utc))
+        notify = self.wiki_import_listeners == 'deferred'
+        listeners = WikiSystem(self.env).change_listeners
+        batch = list()
 
-            # clear the wiki attachment table
+        def insert_batch():
             @self.env.with_transaction()
-            def clear_attachments(db):
-                """Clears any wiki attachments from the current attachment table."""
+            def insert_pages(db):
+                cursor = db.cursor()
+                cursor.executemany("""INSERT INTO wiki (name, version, time, author,
+                                                        ipnr, text, comment, readonly)
+                                      VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""", batch)
+            self.log.info("Inserted %s wiki pages from template", len(batch))
+            if notify and listeners:
+                # listeners may look up the names of the pages
+                del WikiSystem(self.env).pages
+                for row in batch:
+                    wikipage = self._inserted_wiki_page(row)
+                    for listener in listeners:
+                        if wikipage.version == 1:
+                            listener.wiki_page_added(wikipage)
+                        else:
+                            listener.wiki_page_changed(wikipage, wikipage.version, 
+                                                       wikipage.time, None, None, None)
+            del batch[:]
+
+        for page in pages:
+            if page.text:
+                version = versions.get(page.name, 0) + 1
+                versions[page.name] = version
+                batch.append((page.name, version, now, None, None, page.text, None,
+                              page.readonly))
+                if len(batch) >= self.wiki_import_batch_size:
+                    insert_batch()
+            else:
+                self.log.debug("Cannot create wiki pages with no text. "
+                               "Unable to import %s", page.name)
+        if batch:
+            insert_batch()
+
+        # invalidate the page name cache
+        del WikiSystem(self.env).pages
+
+    def _inserted_wiki_page(self, row):
+        """Returns the WikiPage for a row inserted by 
+        _bulk_import_wiki_pages(), as WikiPage(env, name) would load it,
+        without querying the database."""
+
+        name, version, time, author, ipnr, text, comment, readonly = row
+        wikipage = WikiPage(self.env)
+        wikipage.name = name
+        wikipage.resource = Resource('wiki', name)
+        wikipage.version = version
+        wikipage.time = from_utimestamp(time)
+        wikipage.author = author
+        wikipage.text = wikipage.old_text = text
+        wikipage.comment = comment
+        wikipage.readonly = wikipage.old_readonly = int(readonly) if readonly else 0
+        return wikipage
+
+    def import_wiki_attachments(self, template_path):
+        """Imports wiki attachments from the template.
+
+        Rather than pushing every file through Attachment.insert(), which
+        copies the data and commits once per attachment, we place the files
+        with the configured copy strategy (reflinking by default where the 
+        filesystem can, so no data is copied - blobs from the blob store are
+        never hard linked, as they are shared) and then insert all of the 
+        attachment rows in a single transaction. Files which have to be copied, e.g. out of a
+        packed template, are copied by the kernel - see copy_data(). Each 
+        file is closed before the next one is opened, so the number of 
+        attachments isn't limited by the number of open files we may have.
+        As we bypass the Attachment API no attachment change listeners are
+        notified - the project is brand new, so there is nobody to notify."""
+
+        # check that there are attachments to import - either in the 
+        # template (directory or packed) or in the blob store
+        template = open_template(template_path)
+        attachment_blobs = read_manifest(template_path).get('attachments/wiki')
+        if attachment_blobs is not None or template.isdir('attachments/wiki'):
+
+            now = to_utimestamp(datetime.now(utc))
+            # the option is shared with, and declared by, the exporter
+            strategy = GenerateTemplate(self.env).copy_strategy
+            store = BlobStore.for_template(template_path)
+
+            # move attachment files into the env and remember their rows
+            attachments = list()
+            created_dirs = set()
+            for att in self.template_reader(template_path).attachments():
+                relpath = attachment_relpath(att.parent_id, att.name)
+                destination = attachment_path(self.env, att.parent_id, att.name)
+                if attachment_blobs is not None:
+                    if relpath not in attachment_blobs:
+                        self.log.info("No blob for attachment %s in template", att.name)
+                        continue
+                    digest = attachment_blobs[relpath]
+                else:
+                    source = 'attachments/wiki/' + relpath
+                try:
+                    # most pages have several attachments, so we only check
+                    # each directory once
+                    destination_dir = os.path.dirname(destination)
+                    if destination_dir not in created_dirs:
+                        if not os.path.isdir(destination_dir):
+                            os.makedirs(destination_dir)
+                        created_dirs.add(destination_dir)
+                    if attachment_blobs is not None:
+                        # blobs are never hard linked, see BlobStore.place()
+                        strategy = store.place(digest, destination, strategy)
+                    else:
+                        strategy = template.place(source, destination, strategy)
+                except (IOError, OSError):
+                    self.log.info("Unable to import attachment %s", att.name)
+                    continue
+                # rendering the timeline expects strings for author and ipnr
+                attachments.append(('wiki', att.parent_id, att.name, att.size, now,
+                                    att.description, '', ''))
+
+            @self.env.with_transaction()
+            def clear_and_insert_attachments(db):
+                """Replaces any wiki attachments in the current attachment 
+                table with those from the template."""
 
                 cursor = db.cursor()
                 cursor.execute("DELETE FROM attachment WHERE type='wiki'")
+                cursor.executemany("""INSERT INTO attachment 
+                                      (type, id, filename, size, time, description,
+                                       author, ipnr)
+                                      VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                                      """, attachments)
 
-            # move attachment file into the env and insert database row
-            filepath = os.path.join(template_path, 'attachment.xml')
-            tree = ET.ElementTree(file=filepath)
-            for att in tree.getroot():
-                attachment = Attachment(self.env, 'wiki', att.attrib['parent_id'])
-                attachment.description = att.text
-                try:
-                    fileobj = open(os.path.join(template_attachment_path, 
-                               att.attrib['parent_id'], unicode_quote(att.attrib['name'])))
-                    attachment.insert(att.attrib['name'], fileobj, att.attrib['size'])
-                except IOError:
-                    self.log.info("Unable to import attachment %s", att.attrib['name'])
+            self.log.info("Imported %s wiki attachments using %s", len(attachments), strategy)
 
     def template_populate(self, template_path):
         """Clears default data and inserts template specific data from xml files.
@@ -102,40 +512,63 @@ class ImportTemplate(Component):
 
         First we deal with seperate tables such as the milestone, group
         and version tables - then we move onto the enum table.
-        """
 
+        The tables are populated in a single transaction. Each importer 
+        still has its own transaction block, but Trac nests those inside 
+        ours, so we commit once rather than once per table and row, and if
+        anything fails the tables are left with their default data instead
+        of being half populated. This doesn't cover the workflow files, 
+        which are copied into the project inside the transaction as the 
+        ticket types need them, and are left behind if it is rolled back.
+        The workflow versions are only written to trac.ini once the 
+        transaction has been committed.
+        """
 
-        importer_functions = {'group.xml': self.import_groups,
-                              'milestone.xml': self.import_milestones,
-                              'component.xml': self.import_components,
+        importer_functions = {'group': self.import_groups,
+                              'milestone': self.import_milestones,
+                              'component': self.import_components,
+                              'version': self.import_versions,
         }
 
-        enum_values = {'priority.xml': 'priority',
-                       'ticket.xml': 'ticket_type',
+        enum_values = {'priority': 'priority',
+                       'ticket': 'ticket_type',
         }
 
-        # for vales stored in the enum table we only want to clear certain rows
-        enum_to_clear = list()
-
-        # go through template dir to see which tables and rows we want to modify
-        try:
-            for filename in os.listdir(template_path):
-                if filename in importer_functions:
-                    importer_functions[filename](template_path)
-
-                elif filename in enum_values:
-                    enum_to_clear.append(enum_values[filename])
+        @self.env.with_transaction()
+        def populate(db):
+            """Runs all of the table importers inside one transaction."""
+
+            # for vales stored in the enum table we only want to clear certain rows
+            enum_to_clear = list()
+
+            # go through template dir to see which tables and rows we want to modify
+            try:
+                # tables can be stored as XML or JSON lines - TemplateReader
+                # reads either
+                tables = set(table_name(filename) for filename 
+                             in open_template(template_path).listdir())
+                for table in sorted(tables - set([None])):
+                    if table in importer_functions:
+                        importer_functions[table](template_path)
+
+                    elif table in enum_values:
+                        enum_to_clear.append(enum_values[table])
+
+            except OSError as exception:
+                if exception.errno == errno.ENOENT:
+                    self.log.info("Unable to list files at %s."
+                                  "Import of template data failed.", template_path)
+                else:
+                    raise
 
-        except OSError as exception:
-            if exception.errno == errno.ENOENT:
-                self.log.info("Unable to list files at %s."
-                              "Import of template data failed.", template_path)
+            if enum_to_clear:
+                self.import_enum(template_path, enum_to_clear)
 
-        if enum_to_clear:
-            self.import_enum(template_path, enum_to_clear)
+            # we also need to populate the system table
+            self.import_version_data(template_path)
 
-        # we also need to populate the system table and conf file
-        self.import_version_data(template_path)
+        # and the conf file, which can't be rolled back
+        self._import_workflow_versions(template_path)
 
     def import_groups(self, template_path):
         """Create project groups from group.xml template file.
@@ -143,8 +576,9 @@ class ImportTemplate(Component):
         First we clear the existing data in the groups table and then we insert
         group data taken from the group.xml file.
 
-        If this import is successful, we then continue to use the group.xml 
-        file to import permission data relating to groups and domains."""
+        If this import is successful, we then import the permission data 
+        relating to groups and domains, which we collect from group.xml as we
+        read the groups so the file is only parsed once."""
 
         @self.env.with_transaction()
         def clear_groups(db):
@@ -156,55 +590,75 @@ class ImportTemplate(Component):
             cursor.execute("DELETE FROM groups")
 
         self.log.info("Creating groups from template")
-        path = os.path.join(template_path, "group.xml")
+        reader = self.template_reader(template_path)
+        path = os.path.join(template_path, reader.filename('group'))
+        perm_data = list()
         try:
-            tree = ET.ElementTree(file=path)
-            for group in tree.getroot():
+            for group in reader.groups():
                 # have to use _new_group() not add_group() otherwise we can't specify the sid
-                if 'sid' in group.attrib:
-                    SimplifiedPermissions(self.env)._new_group(group.attrib['sid'], 
-                                group.attrib['name'], description=group.text)
+                if group.sid is not None:
+                    SimplifiedPermissions(self.env)._new_group(group.sid, 
+                                group.name, description=group.description)
+                perm_data.extend(group.perms)
 
-            # now we pull the permissions data from groups.xml too
-            self.import_perms(path)
+            # now we import the permissions data from groups.xml too
+            self.import_perms(perm_data)
 
         except IOError as exception:
             if exception.errno == errno.ENOENT:
-                self.log.info("Path to group.xml at %s does not exist. Unable to "
+                self.log.info("Path to group file %s does not exist. Unable to "
                               "import group data from template.", path)
+                return
+            raise
 
-    def import_perms(self, template_path):
+    def import_perms(self, perm_data):
         """Creates permissions from data stored in groups.xml.
 
-        Parses this XML file to get the data we need to insert into the 
-        permissions table. If we have this data we clear the existing
-        permission data, and then insert the template data using the 
-        PermissionSystem API.
+        perm_data is the list of (username, action) pairs read from the
+        groups in group.xml by import_groups(). We clear the existing 
+        permission data, and then insert the template data.
 
         If we don't create a perm_data list, we exit the function and 
         continue to use default data.
+
+        Granting each permission through the PermissionSystem API costs an
+        INSERT, a commit and a cache invalidation per (subject, action) 
+        pair, and templates with many groups and domains have thousands of
+        them. Instead we insert all of the distinct pairs with one 
+        executemany() in the same transaction as the DELETE, and invalidate
+        the permission cache once at the end.
         """
 
-        # parse the tree to get username, action data
-        # we know the file exists as we check that in import_groups()
-        tree = ET.ElementTree(file=template_path)
-        perm_data = [(subelement.attrib['name'], subelement.attrib['action']) 
-                     for perm in tree.getroot() for subelement in perm
-                     if subelement.attrib['name'].strip()]
+        # the permission table has a (username, action) primary key, and
+        # the same pair can be listed under more than one group
+        unique_perms = list()
+        seen = set()
+        for perm in perm_data:
+            if not perm[0].strip():
+                continue
+            if perm not in seen:
+                seen.add(perm)
+                unique_perms.append(perm)
 
         @self.env.with_transaction()
-        def clear_perms(db):
-            """Clears the whole permissions table of default data."""
+        def clear_and_insert_perms(db):
+            """Replaces the whole permissions table of default data with 
+            the template permissions."""
 
             cursor = db.cursor()
             self.log.info("Clearing permissions table")
             # cant pass the table name as an arg so its hard coded
             cursor.execute("DELETE FROM permission")
 
-        self.log.info("Inserting template data into permissions table")
-        perm_system = PermissionSystem(self.env).store
-        for username, action in perm_data:
-            perm_system.grant_permission(username, action)
+            self.log.info("Inserting template data into permissions table")
+            cursor.executemany("""INSERT INTO permission (username, action)
+                                  VALUES (%s, %s)""", unique_perms)
+
+        # newer versions of Trac cache the permission table in the default
+        # permission store, which grant_permission() would have reset
+        perm_store = PermissionSystem(self.env).store
+        if hasattr(perm_store.__class__, '_all_permissions'):
+            del perm_store._all_permissions
 
     def import_milestones(self, template_path):
         """Create project milestones from milestone.xml template file.
@@ -213,38 +667,44 @@ class ImportTemplate(Component):
         based on the information in milestone XML template.
         """
 
-        @self.env.with_transaction()
-        def clear_milestones(db):
-            """Clears all rows in milestone table. This value is hard coded
-            as you can't pass a table name with parameter substitution."""
-
-            cursor = db.cursor()
-            cursor.execute("""DELETE FROM milestone""")
-
-        # Parse the XML tree and create milestones
-        path = os.path.join(template_path, "milestone.xml")
+        # Parse the XML tree to get the milestones
+        reader = self.template_reader(template_path)
+        path = os.path.join(template_path, reader.filename('milestone'))
+        milestones = list()
         try:
-            tree = ET.ElementTree(file=path)
-            for m in tree.getroot():
+            for m in reader.milestones():
                 milestone = model.Milestone(self.env)
-                if 'name' in m.attrib:
-                    milestone.name = m.attrib['name']
-                if 'start' in m.attrib:
-                    milestone.start = parse_date(m.attrib['start'])
-                if 'due' in m.attrib:
-                    milestone.due = parse_date(m.attrib['due'])
-                if 'completed' in m.attrib:
-                    milestone.completed = parse_date(m.attrib['completed'])
-                if 'parent' in m.attrib:
-                    milestone.parent = m.attrib['parent']
-                if m.text:
-                    milestone.description = m.text
-                # save the milestone
-                milestone.insert()
+                if m.name is not None:
+                    milestone.name = m.name
+                if m.start is not None:
+                    milestone.start = parse_date(m.start)
+                if m.due is not None:
+                    milestone.due = parse_date(m.due)
+                if m.completed is not None:
+                    milestone.completed = parse_date(m.completed)
+                if m.parent is not None:
+                    milestone.parent = m.parent
+                if m.description:
+                    milestone.description = m.description
+                milestones.append(milestone)
         except IOError as exception:
             if exception.errno == errno.ENOENT:
-                self.log.info("Path to milestone.xml at %s does not exist. "
+                self.log.info("Path to milestone file %s does not exist. "
                               "Unable to import milestone data from tempalte.", path)
+                return
+            raise
+
+        @self.env.with_transaction()
+        def clear_and_insert_milestones(db):
+            """Clears all rows in milestone table and saves the template 
+            milestones. This value is hard coded as you can't pass a table 
+            name with parameter substitution. We use Milestone.insert() 
+            rather than raw SQL so sub-milestones are handled for us."""
+
+            cursor = db.cursor()
+            cursor.execute("""DELETE FROM milestone""")
+            for milestone in milestones:
+                milestone.insert(db=db)
 
     def import_versions(self, template_path):
         """Create project milestones from milestone.xml template file.
@@ -253,28 +713,29 @@ class ImportTemplate(Component):
         data in the version table.
         """
 
-        @self.env.with_transaction()
-        def clear_versions(db):
-            """Clears the whole version table of default data. You can't pass
-            a table name as an argument for parameter substitution, so it
-            has to be hard coded."""
-            cursor = db.cursor()
-            self.log.info("Clearing version table")
-            cursor.execute("DELETE FROM version")
-
         self.log.info("Creating versions from template")
-        path = os.path.join(template_path, "version.xml")
+        reader = self.template_reader(template_path)
+        path = os.path.join(template_path, reader.filename('version'))
         try:
-            tree = ET.ElementTree(file=path)
-            for version in tree.getroot():
-                ver = model.Version(self.env)
-                ver.name = version.attrib['name']
-                ver.description = version.attrib['description']
-                ver.insert()
+            versions = [(version.name, version.description)
+                        for version in reader.versions()]
         except IOError as exception:
             if exception.errno == errno.ENOENT:
-                self.log.info("Path to version.xml at %s does not exist. Unable to "
+                self.log.info("Path to version file %s does not exist. Unable to "
                               "import version data from template.", path)
+                return
+            raise
+
+        @self.env.with_transaction()
+        def clear_and_insert_versions(db):
+            """Clears the whole version table of default data and inserts
+            the template versions. You can't pass a table name as an 
+            argument for parameter substitution, so it has to be hard coded."""
+            cursor = db.cursor()
+            self.log.info("Clearing version table")
+            cursor.execute("DELETE FROM version")
+            cursor.executemany("""INSERT INTO version (name, description)
+                                  VALUES (%s, %s)""", versions)
 
     def import_components(self, template_path):
         """Create project components from component.xml template file.
@@ -283,30 +744,31 @@ class ImportTemplate(Component):
         existing default data in the component table.
         """
 
-        @self.env.with_transaction()
-        def clear_components(db):
-            """Clears the whole component table of default data. You can't pass
-            a table name as an argument for parameter substitution, so it
-            has to be hard coded."""
-            cursor = db.cursor()
-            self.log.info("Clearing component table")
-            cursor.execute("DELETE FROM component")
-
         self.log.info("Creating components from template")
-        path = os.path.join(template_path, "component.xml")
+        reader = self.template_reader(template_path)
+        path = os.path.join(template_path, reader.filename('component'))
         try:
-            tree = ET.ElementTree(file=path)
-            for component in tree.getroot():
-                # not exporting owner as they might not be a member
-                # of the new project who use this template
-                comp = model.Component(self.env)
-                comp.name = component.attrib['name']
-                comp.description = component.attrib['description']
-                comp.insert()
+            # not exporting owner as they might not be a member
+            # of the new project who use this template
+            components = [(component.name, component.description)
+                          for component in reader.components()]
         except IOError as exception:
             if exception.errno == errno.ENOENT:
-                self.log.info("Path to component.xml at %s does not exist. Unable to "
+                self.log.info("Path to component file %s does not exist. Unable to "
                               "import component data from template.", path)
+                return
+            raise
+
+        @self.env.with_transaction()
+        def clear_and_insert_components(db):
+            """Clears the whole component table of default data and inserts
+            the template components. You can't pass a table name as an 
+            argument for parameter substitution, so it has to be hard coded."""
+            cursor = db.cursor()
+            self.log.info("Clearing component table")
+            cursor.execute("DELETE FROM component")
+            cursor.executemany("""INSERT INTO component (name, description)
+                                  VALUES (%s, %s)""", components)
 
     def import_enum(self, template_path, types_to_remove):
         """Removes types from the enum table and then inserts data from the 
@@ -314,15 +776,17 @@ class ImportTemplate(Component):
 
         # create a list of tuples for every enum type in our template 
         # where the tuple follows the synax (type, name, value)
-        path = os.path.join(template_path, 'priority.xml')
+        reader = self.template_reader(template_path)
+        path = os.path.join(template_path, reader.filename('priority'))
         try:
-            tree = ET.ElementTree(file=path)
-            priority_list = [('priority', priority.attrib['name'], priority.attrib['value']) for priority in tree.getroot()]
-        except IOError:
+            priority_list = [('priority', priority.name, priority.value)
+                             for priority in reader.priorities()]
+        except IOError as exception:
             if exception.errno == errno.ENOENT:
-                self.log.info("Path to priority.xml at %s does not exist", path)
+                self.log.info("Path to priority file %s does not exist", path)
                 # return before we clear the enum table
                 return
+            raise
         values = list()
         values.extend(priority_list)
 
@@ -361,16 +825,18 @@ class ImportTemplate(Component):
         controller = LogicaOrderController(self.env)
 
         self.log.info("Creating ticket types from template")
-        path = os.path.join(template_path, 'ticket.xml')
+        reader = self.template_reader(template_path)
+        path = os.path.join(template_path, reader.filename('ticket'))
         try:
-            tree = ET.ElementTree(file=path)
-            for ticket in tree.getroot():
+            for ticket in reader.ticket_types():
                 # using a _method() is a bit naughty
-                controller._import_ticket_type(ticket.text, dry_run=False)
+                controller._import_ticket_type(ticket.data, dry_run=False)
         except IOError as exception:
             if exception.errno == errno.ENOENT:
-                self.log.info("Path to ticket.xml at %s does not exist. "
+                self.log.info("Path to ticket file %s does not exist. "
                               "Unable to import tickets from tempalte.", path)
+                return
+            raise
 
     def import_workflows(self, template_path):
         """Imports workflows from template workflow directory.
@@ -379,6 +845,7 @@ class ImportTemplate(Component):
         project's workflow directory.
         """
 
+        template = open_template(template_path)
         template_workflow_path = os.path.join(template_path, 'workflows')
         project_workflow_path = os.path.join(self.env.path, 'workflows')
 
@@ -389,32 +856,49 @@ class ImportTemplate(Component):
         except OSError:
             self.log.debug("No workflow directory at %s to remove", project_workflow_path)
 
+        # templates using the blob store list their workflows in blobs.json
+        workflow_blobs = read_manifest(template_path).get('workflows')
+        if workflow_blobs is not None:
+            store = BlobStore.for_template(template_path)
+            os.mkdir(project_workflow_path)
+            for workflow, digest in workflow_blobs.iteritems():
+                # copied rather than linked as projects edit workflows in place
+                shutil.copyfile(store.blob_path(digest), 
+                                os.path.join(project_workflow_path, workflow))
+            self.log.info("Copied %s ticket workflows from the template blob store to %s",
+                          len(workflow_blobs), project_workflow_path)
+            return
+
         try:
-            shutil.copytree(template_workflow_path, project_workflow_path)
+            template.copytree('workflows', project_workflow_path)
             self.log.info("Copied ticket workflows to %s", project_workflow_path)
         except OSError as exception:
             if exception.errno == errno.ENOENT:
                 self.log.info("The path to the workflow directory at %s does "
                               "not exist. Unable to import workflows.", template_workflow_path)
+                return
+            raise
 
     def import_mailinglist(self, template_path):
         """Creates project mailing lists from mailinglist.xml template file."""
 
-        path = os.path.join(template_path, 'mailinglist.xml')
+        reader = self.template_reader(template_path)
+        path = os.path.join(template_path, reader.filename('mailinglist'))
         try:
-            tree = ET.ElementTree(file=path)
-            for ml in tree.getroot():
-                mailinglist = Mailinglist(self.env, emailaddress=ml.attrib['email'],
-                                               name=ml.attrib['name'],
-                                               description=ml.text,
-                                               private=ml.attrib['private'],
-                                               postperm=ml.attrib['postperm'],
-                                               replyto=ml.attrib['replyto'])
+            for ml in reader.mailinglists():
+                mailinglist = Mailinglist(self.env, emailaddress=ml.email,
+                                               name=ml.name,
+                                               description=ml.description,
+                                               private=ml.private,
+                                               postperm=ml.postperm,
+                                               replyto=ml.replyto)
                 mailinglist.insert()
         except IOError as exception:
             if exception.errno == errno.ENOENT:
-                self.log.info("Path to mailinglist.xml at %s does not exist. "
+                self.log.info("Path to mailinglist file %s does not exist. "
                               "Unable to import mailing lists from template.", path)
+                return
+            raise
 
         # TODO Get Subscriber informaiton 
         # mailinglist.subscribe(group='project_group', poser=True)
@@ -424,28 +908,97 @@ class ImportTemplate(Component):
         
         Create a new subversion repository using the dump file in 
         the template directory. We don't support Git right now.
+
+        The dump is decompressed with the codec matching its extension and
+        streamed straight into `svnadmin load`, without a shell. If the 
+        archive is incremental, the archives it builds on are loaded first,
+        see archive_chain(). 
+
+        Returns the statistics from load_archive() summed over the chain, 
+        with the paths of the archives which were loaded as 'archives', or 
+        None if the template has no file archive. Archives in packed 
+        templates are read straight out of the packed template.
         """
 
-        template_name = os.path.basename(os.path.normpath(template_path))
-        old_repo_path = os.path.join(template_path,  template_name + '.dump.gz')
+        chain = self.archive_chain(template_path)
+        if not chain:
+            self.log.info("No file archive in template %s. Unable to import "
+                          "file archive from template.", template_path)
+            return None
 
         # should probably use ResourceManager from trac/versioncontrol...
         new_repo_path = self.env.config.get('trac', 'repository_dir')
 
-        subprocess.call("zcat %s | svnadmin load %s" % (old_repo_path, new_repo_path), cwd=os.getcwd(), shell=True)
-        self.log.info("Imported Subversion file archive from %s" % old_repo_path)
+        total = {'returncode': 0, 'bytes': 0, 'seconds': 0.0, 'stderr': '', 
+                 'archives': list()}
+        for template, relpath in chain:
+            old_repo_path = os.path.join(template.path, relpath)
+            with template.open(relpath) as fileobj:
+                stats = load_archive(relpath, new_repo_path, fileobj=fileobj)
+            total['returncode'] = stats['returncode']
+            total['bytes'] += stats['bytes']
+            total['seconds'] += stats['seconds']
+            total['stderr'] += stats['stderr']
+            total['archives'].append(old_repo_path)
+            if stats['returncode']:
+                self.log.error("svnadmin load of %s into %s failed (return code %s): %s",
+                               old_repo_path, new_repo_path, stats['returncode'], 
+                               stats['stderr'])
+                # the rest of the chain builds on this archive
+                break
+            self.log.info("Imported Subversion file archive from %s (%s bytes in "
+                          "%.1fs, %.1f MB/s)", old_repo_path, stats['bytes'],
+                          stats['seconds'], throughput(stats))
+        return total
+
+    def archive_chain(self, template_path):
+        """Returns the archives which make up the file archive of the 
+        template, in the order they have to be loaded, as (template, path)
+        pairs - see open_template().
+
+        A template with a full dump has a single archive. An incremental 
+        archive names the template it builds on as its base in info.json,
+        and we follow those to the full dump at the start of the chain. 
+        Templates created before we recorded archives in info.json have
+        at most one archive, which we look for on disk.
+
+        Raises ResourceNotFound if a base template has been removed."""
+
+        api = ProjectTemplateAPI(self.env)
+        name = template_name(template_path)
+
+        path = template_path
+        chain = list()
+        seen = set()
+        while name and name not in seen:
+            seen.add(name)
+            archive = api.get_template_information(name).get('archive')
+            if archive is None:
+                # packed templates always record their archive
+                archive_path = find_archive(path)
+                if archive_path:
+                    chain.insert(0, (open_template(path), os.path.basename(archive_path)))
+                break
+            if archive.get('file'):
+                chain.insert(0, (open_template(path), archive['file']))
+            name = archive.get('base')
+            if name:
+                path = api.get_template_path(name)
+        return chain
 
     def import_version_data(self, template_path):
         """
         Import system version data from the info.json file. Note that only white 
         listed data will not be imported, but that the entire system table is 
-        exported for traceability."""
+        exported for traceability. The workflow versions in trac.ini are 
+        updated separately by template_populate(), see 
+        _import_workflow_versions()."""
 
-        template_name = os.path.basename(os.path.normpath(template_path))
-        template_info = ProjectTemplateAPI(self.env).get_template_information(template_name)
+        template_info = ProjectTemplateAPI(self.env).get_template_information(
+                                                        template_name(template_path))
 
         # some old test/staging templates won't have version data
-        version_data = template_info.get('versions')
+        version_data = template_info.get('versions') or {}
         system_verson_to_import = dict((n, v) for n, v in version_data.iteritems() 
                                         if n in self.system_version_white_list)
 
@@ -460,6 +1013,13 @@ class ImportTemplate(Component):
                 cursor.execute("""UPDATE system SET value = %s 
                                   WHERE name = %s""", (value, name))
 
+    def _import_workflow_versions(self, template_path):
+        """Updates the workflow versions in trac.ini with those recorded in
+        the info.json file of the template."""
+
+        template_info = ProjectTemplateAPI(self.env).get_template_information(
+                                                        template_name(template_path))
+        version_data = template_info.get('versions') or {}
         json_version = version_data.get('json_latest_version')
         type_config_version = version_data.get('type_config_version')
 
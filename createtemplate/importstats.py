@@ -0,0 +1,95 @@
+import errno
+import json
+import os
+
+from createtemplate.files import locked, write_atomically
+
+# Throughput measured while importing templates.
+#
+# Every import_template() run records how many bytes of each part of the
+# template it imported and how long that took, in a small JSON file in a
+# hidden subdirectory of the template directory shared by all of the 
+# projects on the server. Writing it must not change the mtime of the 
+# template directory, which tells the template catalog caches when 
+# templates are added or removed.
+#
+#   {"version": 1,
+#    "samples": {"tables.xml": [[48213, 0.41], ...],
+#                "wiki.jsonl": [[1902211, 2.3], ...],
+#                "attachments": [[73400320, 1.2], ...],
+#                "archive": [[210763776, 38.0], ...]}}
+#
+# The import planner divides the sizes of a template by the throughput of
+# the last SAMPLES_KEPT imports to estimate how long an import will take.
+# Table throughput depends on the format of the files, so tables, wiki
+# pages and mailing lists are kept apart per format.
+
+STATS_DIR = '.stats'
+STATS_FILE = 'import_stats.json'
+STATS_LOCK = 'import_stats.lock'
+STATS_VERSION = 1
+SAMPLES_KEPT = 20
+
+class ImportStats(object):
+    """The import throughput statistics of a template directory."""
+
+    def __init__(self, template_dir):
+        self.dir = os.path.join(template_dir, STATS_DIR)
+        self.path = os.path.join(self.dir, STATS_FILE)
+        self.lock_path = os.path.join(self.dir, STATS_LOCK)
+
+    @classmethod
+    def for_template(cls, template_path):
+        """Returns the statistics of the template directory holding the 
+        template at template_path."""
+
+        return cls(os.path.dirname(os.path.normpath(template_path)))
+
+    def samples(self):
+        """Returns the {kind: [[bytes, seconds], ...]} samples recorded so
+        far, oldest first."""
+
+        try:
+            with open(self.path) as fileobj:
+                return json.load(fileobj)['samples']
+        except (ValueError, KeyError, IOError):
+            # missing or broken, so nothing has been measured yet
+            return {}
+
+    def throughput(self, kind, samples=None):
+        """Returns the bytes per second measured for kind over the kept
+        samples, or None if it hasn't been measured yet."""
+
+        if samples is None:
+            samples = self.samples()
+        kind_samples = samples.get(kind) or []
+        size = sum(sample[0] for sample in kind_samples)
+        seconds = sum(sample[1] for sample in kind_samples)
+        if not size or seconds <= 0:
+            return None
+        return size / seconds
+
+    def record(self, measurements):
+        """Adds a sample for each (kind, bytes, seconds) in measurements,
+        keeping the last SAMPLES_KEPT of each kind. Empty measurements are
+        left out as they say nothing about throughput."""
+
+        measurements = [(kind, size, seconds) for kind, size, seconds in measurements
+                        if size > 0 and seconds > 0]
+        if not measurements:
+            return
+
+        if not os.path.isdir(self.dir):
+            try:
+                os.mkdir(self.dir)
+            except OSError as exception:
+                if exception.errno != errno.EEXIST:
+                    raise
+        with locked(self.lock_path):
+            samples = self.samples()
+            for kind, size, seconds in measurements:
+                kind_samples = samples.setdefault(kind, [])
+                kind_samples.append([size, round(seconds, 4)])
+                del kind_samples[:-SAMPLES_KEPT]
+            write_atomically(self.path, json.dumps({'version': STATS_VERSION,
+                                                    'samples': samples}))
@@ -0,0 +1,404 @@
+import errno
+import json
+import os
+import re
+import socket
+import threading
+import traceback
+from datetime import datetime
+
+from trac.core import *
+from trac.config import IntOption
+from trac.db import Table, Column, DatabaseManager
+from trac.env import IEnvironmentSetupParticipant
+from trac.web.api import IRequestHandler
+from trac.util.datefmt import to_utimestamp, utc
+
+# Background jobs which create project templates.
+#
+# Dumping the Subversion repository and copying attachments of a big
+# project can take many minutes, which is longer than our proxies wait for
+# a response and ties up a web worker the whole time. Instead the admin
+# panel records a job in the template_job table and returns straight away,
+# and a worker thread in the Trac process picks the job up. The progress
+# of each exported component is stored in template_job_component, and the
+# admin page polls /templates/jobs/<id> to display it.
+#
+# The process running a job records itself as the owner of the job (its
+# host name and pid), and a heartbeat thread updates the heartbeat of the
+# job every job_heartbeat_interval seconds while it runs. A job is only
+# marked as failed when its owner process is gone (which we can only tell
+# on the same host) or its heartbeat hasn't been updated for job_timeout
+# seconds, so a slow export running in another process is left alone.
+# The files of a failed job are left for an operator to look at.
+
+SCHEMA_NAME = 'createtemplate_jobs'
+SCHEMA_VERSION = 1
+
+SCHEMA = [
+    Table('template_job', key='id')[
+        Column('id', auto_increment=True),
+        Column('template'),
+        Column('path'),
+        Column('author'),
+        Column('description'),
+        Column('components'),
+        Column('status'),
+        Column('created', type='int64'),
+        Column('started', type='int64'),
+        Column('finished', type='int64'),
+        Column('error'),
+        Column('owner'),
+        Column('heartbeat', type='int64')],
+    Table('template_job_component', key=('job', 'component'))[
+        Column('job', type='int'),
+        Column('component'),
+        Column('status'),
+        Column('started', type='int64'),
+        Column('finished', type='int64'),
+        Column('result')],
+]
+
+class TemplateJobSystem(Component):
+    """Queues and runs template creation jobs in the background"""
+
+    implements(IEnvironmentSetupParticipant, IRequestHandler)
+
+    job_timeout = IntOption('project_templates', 'job_timeout', 30 * 60,
+                    doc="""Number of seconds without a heartbeat after which a
+                    running template job is assumed to have been abandoned by
+                    a Trac process which crashed or was restarted, and is 
+                    marked as failed. Should be several times 
+                    `job_heartbeat_interval`.""")
+
+    job_heartbeat_interval = IntOption('project_templates', 'job_heartbeat_interval', 60,
+                    doc="""Number of seconds between the heartbeats a process
+                    records while it runs a template job.""")
+
+    def __init__(self):
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    # IEnvironmentSetupParticipant methods
+
+    def environment_created(self):
+        @self.env.with_transaction()
+        def do_create(db):
+            self.upgrade_environment(db)
+
+    def environment_needs_upgrade(self, db):
+        # imported here as the admin module uses this one to submit jobs
+        from createtemplate.admin import GenerateTemplate
+
+        # without background jobs we don't need the job tables, so they
+        # are only created once background_jobs is turned on
+        if not GenerateTemplate(self.env).background_jobs:
+            return False
+        return self._get_schema_version(db) < SCHEMA_VERSION
+
+    def upgrade_environment(self, db):
+        cursor = db.cursor()
+        connector = DatabaseManager(self.env)._get_connector()[0]
+        for table in SCHEMA:
+            for statement in connector.to_sql(table):
+                cursor.execute(statement)
+        if self._get_schema_version(db):
+            cursor.execute("UPDATE system SET value=%s WHERE name=%s",
+                           (str(SCHEMA_VERSION), SCHEMA_NAME))
+        else:
+            cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)",
+                           (SCHEMA_NAME, str(SCHEMA_VERSION)))
+
+    def _get_schema_version(self, db):
+        cursor = db.cursor()
+        cursor.execute("SELECT value FROM system WHERE name=%s", (SCHEMA_NAME,))
+        row = cursor.fetchone()
+        return row and int(row[0]) or 0
+
+    # IRequestHandler methods
+
+    def match_request(self, req):
+        match = re.match(r'/templates/jobs/(\d+)$', req.path_info)
+        if match:
+            req.args['job_id'] = match.group(1)
+            return True
+
+    def process_request(self, req):
+        req.perm.require('PROJECT_TEMPLATE_CREATE')
+
+        # pick up any jobs left behind by a restarted process
+        self.start_worker()
+
+        status = self.get_job_status(int(req.args['job_id']))
+        if status is None:
+            req.send(json.dumps({'error': 'No such job'}), 'application/json', 404)
+        req.send(json.dumps(status), 'application/json')
+
+    # Public API
+
+    def submit(self, template_name, template_path, author, description, components):
+        """Queues a job which exports the given components into the
+        (already created) template directory. Returns the job id."""
+
+        now = to_utimestamp(datetime.now(utc))
+        job = {}
+
+        @self.env.with_transaction()
+        def insert_job(db):
+            cursor = db.cursor()
+            cursor.execute("""INSERT INTO template_job (template, path, author,
+                                  description, components, status, created)
+                              VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                           (template_name, template_path, author, description,
+                            json.dumps(list(components)), 'pending', now))
+            job['id'] = db.get_last_id(cursor, 'template_job')
+
+        self.log.info("Queued job %s to create template %s", job['id'], template_name)
+        self.start_worker()
+        return job['id']
+
+    def get_job_status(self, job_id):
+        """Returns a dictionary describing the state of a job and each of
+        its components, or None if there is no such job."""
+
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("""SELECT template, author, status, created, started,
+                                 finished, error
+                          FROM template_job WHERE id=%s""", (job_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        status = dict(zip(('template', 'author', 'status', 'created', 'started',
+                           'finished', 'error'), row))
+        status['id'] = job_id
+
+        cursor.execute("""SELECT component, status, started, finished, result
+                          FROM template_job_component WHERE job=%s
+                          ORDER BY started""", (job_id,))
+        status['components'] = [{'component': component,
+                                 'status': component_status,
+                                 'started': started,
+                                 'finished': finished,
+                                 'result': result and json.loads(result)}
+                                for component, component_status, started, finished, result
+                                in cursor]
+        return status
+
+    def start_worker(self):
+        """Starts the worker thread unless it is already running."""
+
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run_pending_jobs,
+                                                name='template-jobs')
+                self._worker.daemon = True
+                self._worker.start()
+
+    # Internal methods
+
+    def _run_pending_jobs(self):
+        """Runs queued jobs until there are none left."""
+
+        try:
+            self._fail_stale_jobs()
+            while True:
+                job = self._claim_next_job()
+                if job is None:
+                    return
+                self._run_job(job)
+        finally:
+            self.env.shutdown(threading.current_thread().ident)
+
+    def _fail_stale_jobs(self):
+        """Marks running jobs, and their components, as failed if the
+        process running them is gone or hasn't recorded a heartbeat for
+        job_timeout seconds. Nothing resumes a job whose process died, so
+        it would otherwise stay running for ever. Jobs from before we 
+        recorded heartbeats are judged by when they started.
+
+        The template directory of such a job is left in place, as we can't
+        be sure nothing writes to it any more - an operator has to remove
+        it before its name can be used again."""
+
+        now = to_utimestamp(datetime.now(utc))
+        cutoff = now - self.job_timeout * 1000000
+        stale = []
+
+        @self.env.with_transaction()
+        def fail_jobs(db):
+            cursor = db.cursor()
+            cursor.execute("""SELECT id, path, owner, started, heartbeat 
+                              FROM template_job WHERE status='running'""")
+            for job_id, path, owner, started, heartbeat in cursor.fetchall():
+                if (heartbeat or started or 0) < cutoff:
+                    reason = "it recorded no heartbeat for %s seconds" % self.job_timeout
+                elif not _owner_alive(owner):
+                    reason = "its process %s has gone away" % owner
+                else:
+                    continue
+                stale.append((job_id, path, reason))
+                cursor.execute("""UPDATE template_job_component SET status='failed',
+                                      finished=%s
+                                  WHERE job=%s AND status='running'""", (now, job_id))
+                cursor.execute("""UPDATE template_job SET status='failed', finished=%s,
+                                      error=%s
+                                  WHERE id=%s AND status='running'""",
+                               (now, "The job was abandoned while it was running, "
+                                     "as %s" % reason, job_id))
+
+        for job_id, path, reason in stale:
+            self.log.warning("Marked template job %s as failed, as %s", job_id, reason)
+            # create_template() writes info.json once the exports are done
+            if os.path.isdir(path) and not os.path.exists(os.path.join(path, 'info.json')):
+                self.log.warning("The partial template of job %s has been left at %s, "
+                                 "remove it to use its name again", job_id, path)
+
+    def _claim_next_job(self):
+        """Marks the oldest pending job as running and returns it. Several
+        Trac processes might share the same environment, so we only take a
+        job if our UPDATE was the one which changed its status."""
+
+        while True:
+            db = self.env.get_read_db()
+            cursor = db.cursor()
+            cursor.execute("""SELECT id, template, path, author, description, components
+                              FROM template_job WHERE status='pending'
+                              ORDER BY id LIMIT 1""")
+            row = cursor.fetchone()
+            if not row:
+                return None
+            job = dict(zip(('id', 'template', 'path', 'author', 'description',
+                            'components'), row))
+            claimed = []
+
+            @self.env.with_transaction()
+            def claim(db):
+                cursor = db.cursor()
+                now = to_utimestamp(datetime.now(utc))
+                cursor.execute("""UPDATE template_job SET status='running', started=%s,
+                                      owner=%s, heartbeat=%s
+                                  WHERE id=%s AND status='pending'""",
+                               (now, _owner(), now, job['id']))
+                claimed.append(cursor.rowcount == 1)
+
+            if claimed[0]:
+                job['components'] = json.loads(job['components'])
+                return job
+
+    def _run_job(self, job):
+        """Exports the template for a job, recording progress as we go."""
+
+        # imported here as the admin module uses this one to submit jobs
+        from createtemplate.admin import GenerateTemplate
+
+        self.log.info("Running job %s to create template %s", job['id'], job['template'])
+        record = self._progress_recorder(job['id'])
+        failed = []
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=self._beat, args=(job['id'], stop_heartbeat),
+                                     name='template-job-heartbeat')
+        heartbeat.daemon = True
+        heartbeat.start()
+
+        def progress(component, status, result):
+            if status == 'failed':
+                failed.append(component)
+            record(component, status, result)
+
+        try:
+            try:
+                GenerateTemplate(self.env).create_template(None, job['template'], 
+                                                           job['path'], job['components'],
+                                                           job['author'], job['description'],
+                                                           progress=progress)
+            finally:
+                stop_heartbeat.set()
+                heartbeat.join()
+        except Exception:
+            self.log.exception("Job %s to create template %s failed", job['id'], job['template'])
+            self._finish_job(job['id'], 'failed', traceback.format_exc())
+        else:
+            if failed:
+                # the template was created, but is missing these components
+                self._finish_job(job['id'], 'failed', "Unable to export %s into the template"
+                                 % ', '.join(sorted(failed)))
+            else:
+                self._finish_job(job['id'], 'done')
+
+    def _beat(self, job_id, stop):
+        """Records a heartbeat for the job every job_heartbeat_interval
+        seconds until stop is set, on its own thread so a long export 
+        step doesn't hold it up."""
+
+        try:
+            while not stop.wait(self.job_heartbeat_interval):
+                try:
+                    @self.env.with_transaction()
+                    def update_heartbeat(db):
+                        cursor = db.cursor()
+                        cursor.execute("""UPDATE template_job SET heartbeat=%s
+                                          WHERE id=%s AND status='running'""",
+                                       (to_utimestamp(datetime.now(utc)), job_id))
+                except Exception:
+                    # try again with the next heartbeat
+                    self.log.warning("Unable to record the heartbeat of template job %s",
+                                     job_id, exc_info=True)
+        finally:
+            self.env.shutdown(threading.current_thread().ident)
+
+    def _progress_recorder(self, job_id):
+        """Returns a progress callback for run_tasks() which stores the
+        state of each component of the job."""
+
+        def record(component, status, result):
+            now = to_utimestamp(datetime.now(utc))
+
+            @self.env.with_transaction()
+            def update_component(db):
+                cursor = db.cursor()
+                if status == 'running':
+                    cursor.execute("""INSERT INTO template_job_component
+                                          (job, component, status, started)
+                                      VALUES (%s, %s, %s, %s)""",
+                                   (job_id, component, status, now))
+                else:
+                    if status == 'failed':
+                        # result is an exc_info tuple
+                        value = unicode(result[1])
+                    else:
+                        value = result
+                    cursor.execute("""UPDATE template_job_component
+                                      SET status=%s, finished=%s, result=%s
+                                      WHERE job=%s AND component=%s""",
+                                   (status, now, json.dumps(value), job_id, component))
+        return record
+
+    def _finish_job(self, job_id, status, error=None):
+        @self.env.with_transaction()
+        def update_job(db):
+            cursor = db.cursor()
+            cursor.execute("""UPDATE template_job SET status=%s, finished=%s, error=%s
+                              WHERE id=%s""",
+                           (status, to_utimestamp(datetime.now(utc)), error, job_id))
+
+def _owner():
+    """Returns the owner recorded for the jobs this process runs. The pid
+    is looked up each time, as Trac processes are often forked from a 
+    parent which loaded this module."""
+
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+def _owner_alive(owner):
+    """Returns False if owner is a process on this host which no longer
+    exists. Processes on other hosts, and jobs without an owner, are 
+    assumed to be alive - only their heartbeat tells us otherwise."""
+
+    host, _, pid = (owner or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except OSError as exception:
+        return exception.errno != errno.ESRCH
+    return True
@@ -0,0 +1,356 @@
+import errno
+import json
+import os
+import shutil
+import tarfile
+import time
+from cStringIO import StringIO
+
+from createtemplate.blobstore import BlobStore, MANIFEST as BLOB_MANIFEST, read_manifest
+from createtemplate.files import copy_data, copy_file
+
+# Packed project templates.
+#
+# A template is normally a directory of XML files, info.json, workflows,
+# attachments and the Subversion dump. Copying thousands of small files
+# between servers over NFS is slow, so a template can instead be packed
+# into a single uncompressed tar file, <template_dir>/<name>.tar.
+#
+# The first member of the tar file is always manifest.json, so its data
+# starts at MANIFEST_OFFSET. It is padded with spaces to MANIFEST_SIZE, so
+# we can write it after the rest of the archive and read it with a single
+# seek and read. It holds the contents of info.json, the components of the
+# template, and where to find the index of every other member, so files
+# can be read straight out of the archive without scanning or unpacking it.
+#
+# The importer reads templates through open_template(), which returns a
+# DirectoryTemplate or a PackedTemplate depending on the path it is given.
+
+PACKED_EXTENSION = '.tar'
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_OFFSET = tarfile.BLOCKSIZE
+MANIFEST_SIZE = 64 * 1024
+MANIFEST_VERSION = 1
+INDEX_NAME = 'index.json'
+
+def template_name(template_path):
+    """Returns the name of the template at template_path, which is either
+    a template directory or a packed template."""
+
+    name = os.path.basename(os.path.normpath(template_path))
+    if name.endswith(PACKED_EXTENSION):
+        name = name[:-len(PACKED_EXTENSION)]
+    return name
+
+def is_packed(template_path):
+    return template_path.endswith(PACKED_EXTENSION) and os.path.isfile(template_path)
+
+def open_template(template_path):
+    """Returns a DirectoryTemplate or PackedTemplate to read the template
+    at template_path."""
+
+    if is_packed(template_path):
+        return PackedTemplate(template_path)
+    return DirectoryTemplate(template_path)
+
+def pack_template(template_path, packed_path, info, components):
+    """Packs the template directory at template_path into a new packed
+    template at packed_path. info is the content of info.json and
+    components the list of components of the template, which are both
+    stored in the manifest.
+
+    Files kept in the blob store are packed under their own names, so the
+    packed template doesn't depend on the blob store. The archive is
+    written to a temporary file which is renamed into place when it is
+    complete."""
+
+    # the files to pack, as (name in the archive, path on disk) pairs
+    files = list()
+    for dirpath, dirnames, filenames in os.walk(template_path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            relpath = os.path.relpath(path, template_path)
+            if relpath != BLOB_MANIFEST:
+                files.append((relpath, path))
+    store = BlobStore.for_template(template_path)
+    for component, entries in sorted(read_manifest(template_path).iteritems()):
+        for relpath, digest in sorted(entries.iteritems()):
+            files.append(('/'.join((component, relpath)), store.blob_path(digest)))
+
+    temp_path = packed_path + '.tmp'
+    try:
+        _write_packed(temp_path, template_path, files, info, components)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.rename(temp_path, packed_path)
+    return len(files)
+
+def read_packed_manifest(packed_path):
+    """Returns the manifest of the packed template at packed_path, reading
+    nothing but the manifest itself."""
+
+    with open(packed_path, 'rb') as fileobj:
+        fileobj.seek(MANIFEST_OFFSET)
+        manifest = json.loads(fileobj.read(MANIFEST_SIZE))
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError("Unsupported packed template version %s in %s"
+                         % (manifest.get('version'), packed_path))
+    return manifest
+
+class DirectoryTemplate(object):
+    """Reads the files of a template directory."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def open(self, relpath):
+        return open(os.path.join(self.path, relpath), 'rb')
+
+    def exists(self, relpath):
+        return os.path.exists(os.path.join(self.path, relpath))
+
+    def isdir(self, relpath):
+        return os.path.isdir(os.path.join(self.path, relpath))
+
+    def listdir(self, relpath=''):
+        return os.listdir(os.path.join(self.path, relpath))
+
+    def size(self, relpath):
+        return os.path.getsize(os.path.join(self.path, relpath))
+
+    def files(self, relpath):
+        """Yields a (path, size) pair for every file below the directory
+        relpath, with paths relative to relpath."""
+
+        top = os.path.join(self.path, relpath)
+        for dirpath, dirnames, filenames in os.walk(top):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                yield os.path.relpath(path, top), os.path.getsize(path)
+
+    def place(self, relpath, destination, strategy='copy'):
+        """Copies a file of the template to destination with the copy
+        strategy, see copy_file(), and returns the strategy used."""
+
+        return copy_file(os.path.join(self.path, relpath), destination, strategy)
+
+    def copytree(self, relpath, destination):
+        shutil.copytree(os.path.join(self.path, relpath), destination)
+
+class PackedTemplate(object):
+    """Reads the files of a packed template, without unpacking it."""
+
+    def __init__(self, path):
+        self.path = path
+        self._manifest = None
+        self._index = None
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = read_packed_manifest(self.path)
+        return self._manifest
+
+    @property
+    def index(self):
+        """The {name: (offset, size)} index of the files in the archive."""
+
+        if self._index is None:
+            offset, size = self.manifest['index']
+            with open(self.path, 'rb') as fileobj:
+                fileobj.seek(offset)
+                self._index = json.loads(fileobj.read(size))
+        return self._index
+
+    def open(self, relpath):
+        offset, size = self._member(relpath)
+        return MemberFile(open(self.path, 'rb'), offset, size)
+
+    def exists(self, relpath):
+        return relpath in self.index or self.isdir(relpath)
+
+    def isdir(self, relpath):
+        prefix = relpath.rstrip('/') + '/'
+        return any(name.startswith(prefix) for name in self.index)
+
+    def listdir(self, relpath=''):
+        prefix = relpath and relpath.rstrip('/') + '/'
+        names = set(name[len(prefix):].split('/')[0] for name in self.index
+                    if name.startswith(prefix))
+        if relpath and not names:
+            raise OSError(errno.ENOENT, "No such directory in packed template %s"
+                          % self.path, relpath)
+        return sorted(names)
+
+    def size(self, relpath):
+        return self._member(relpath)[1]
+
+    def files(self, relpath):
+        """Yields a (path, size) pair for every file below the directory
+        relpath, with paths relative to relpath."""
+
+        prefix = relpath.rstrip('/') + '/'
+        for name, (offset, size) in sorted(self.index.iteritems()):
+            if name.startswith(prefix):
+                yield name[len(prefix):], size
+
+    def place(self, relpath, destination, strategy='copy'):
+        """Writes a file of the template to destination. The data has to
+        be copied out of the archive whatever the strategy, but it is 
+        copied by the kernel where possible - see copy_data()."""
+
+        offset, size = self._member(relpath)
+        if os.path.lexists(destination):
+            os.remove(destination)
+        with open(self.path, 'rb') as source:
+            with open(destination, 'wb') as target:
+                copy_data(source.fileno(), target.fileno(), offset, size)
+        return 'copy'
+
+    def _member(self, relpath):
+        """Returns the (offset, size) of the data of a file of the template."""
+
+        try:
+            offset, size = self.index[relpath]
+        except KeyError:
+            raise IOError(errno.ENOENT, "No such file in packed template %s"
+                          % self.path, relpath)
+        return offset, size
+
+    def copytree(self, relpath, destination):
+        prefix = relpath.rstrip('/') + '/'
+        names = [name for name in sorted(self.index) if name.startswith(prefix)]
+        if not names:
+            raise OSError(errno.ENOENT, "No such directory in packed template %s"
+                          % self.path, relpath)
+        os.makedirs(destination)
+        for name in names:
+            path = os.path.join(destination, *name[len(prefix):].split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            self.place(name, path)
+
+class MemberFile(object):
+    """A read only file object for the data of one member of a packed
+    template, which is size bytes at offset in fileobj."""
+
+    def __init__(self, fileobj, offset, size):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.size = size
+        self.position = 0
+        self.name = fileobj.name
+
+    def read(self, size=-1):
+        remaining = self.size - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return ''
+        self.fileobj.seek(self.offset + self.position)
+        data = self.fileobj.read(size)
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = min(max(offset, 0), self.size)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.fileobj.close()
+
+    @property
+    def closed(self):
+        return self.fileobj.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _write_packed(temp_path, template_path, files, info, components):
+    """Writes the packed template described in pack_template() to
+    temp_path."""
+
+    with open(temp_path, 'wb') as fileobj:
+        tar = tarfile.open(fileobj=fileobj, mode='w', format=tarfile.GNU_FORMAT)
+
+        # reserve room for the manifest, which we write once we know the rest
+        manifest = tarfile.TarInfo(MANIFEST_NAME)
+        manifest.size = MANIFEST_SIZE
+        manifest.mtime = time.time()
+        tar.addfile(manifest, _Padding(MANIFEST_SIZE))
+
+        index = dict()
+        for relpath, path in files:
+            member = tar.gettarinfo(path, relpath)
+            with open(path, 'rb') as data:
+                _add_member(tar, member, data)
+            index[relpath] = [_data_offset(tar, member), member.size]
+
+        index_data = json.dumps(index)
+        member = tarfile.TarInfo(INDEX_NAME)
+        member.size = len(index_data)
+        member.mtime = time.time()
+        tar.addfile(member, StringIO(index_data))
+        index_offset = _data_offset(tar, member)
+        tar.close()
+
+        manifest_data = json.dumps({'version': MANIFEST_VERSION,
+                                    'info': info,
+                                    'components': components,
+                                    'index': [index_offset, member.size]})
+        if len(manifest_data) > MANIFEST_SIZE:
+            raise ValueError("The manifest of %s is larger than %s bytes"
+                             % (template_path, MANIFEST_SIZE))
+        fileobj.seek(MANIFEST_OFFSET)
+        fileobj.write(manifest_data.ljust(MANIFEST_SIZE))
+
+def _add_member(tar, member, data):
+    """Adds member to tar with its data read from the file data, as
+    tar.addfile() does. tarfile copies the data through a 16 KB Python
+    buffer, which is slow for a Subversion dump of several GB, so we copy
+    it with copy_data() instead and only write the padding ourselves."""
+
+    tar.addfile(member)
+    tar.fileobj.flush()
+    if copy_data(data.fileno(), tar.fileobj.fileno(), count=member.size) != member.size:
+        raise IOError("%s changed while it was being packed" % data.name)
+    # the file was written behind the back of its buffer
+    tar.fileobj.seek(0, os.SEEK_END)
+
+    blocks, remainder = divmod(member.size, tarfile.BLOCKSIZE)
+    if remainder:
+        tar.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        blocks += 1
+    tar.offset += blocks * tarfile.BLOCKSIZE
+
+class _Padding(object):
+    """A file object of size spaces, for tarfile.addfile()."""
+
+    def __init__(self, size):
+        self.remaining = size
+
+    def read(self, size):
+        size = min(size, self.remaining)
+        self.remaining -= size
+        return ' ' * size
+
+def _data_offset(tar, member):
+    """Returns the offset of the data of member, which was just added to
+    tar. tarfile pads the data to whole blocks after the header(s)."""
+
+    blocks, remainder = divmod(member.size, tarfile.BLOCKSIZE)
+    if remainder:
+        blocks += 1
+    return tar.offset - blocks * tarfile.BLOCKSIZE
@@ -0,0 +1,122 @@
+import multiprocessing
+import time
+import traceback
+
+from trac.core import *
+from trac.config import IntOption
+from trac.env import open_environment
+
+from createtemplate.importer import DATABASE_PARTS, ImportTemplate
+from createtemplate.templateio import ParsedTemplate
+
+# Provisions many projects from one template.
+#
+# Importing a template into a project parses every table file of the
+# template. When a batch of projects is created from the same template
+# (e.g. 50 course projects) we parse the template once, keep the records
+# in memory with a ParsedTemplate, and import it into each environment in
+# a pool of worker processes. The workers are forked after the template
+# has been parsed, so they share the records with the parent process
+# rather than parsing or unpickling them again. Each worker process
+# imports a single environment, so nothing one import leaves behind (open
+# databases, caches) leaks into the next.
+
+# the template being provisioned, set before the worker processes are
+# forked - see TemplateProvisioning.provision()
+_parsed_template = None
+
+class TemplateProvisioning(Component):
+    """Imports a project template into many existing environments at once"""
+
+    provision_processes = IntOption('project_templates', 'provision_processes', 4,
+                    doc="""Maximum number of environments a template is
+                    imported into at the same time by `trac-admin $ENV
+                    template provision`. Each import loads the Subversion
+                    dump with its own svnadmin process.""")
+
+    def provision(self, template_path, env_paths, processes=None, progress=None):
+        """Imports the template at template_path into each of the
+        environments at env_paths with ImportTemplate.import_template(),
+        running at most processes (by default provision_processes) imports
+        at the same time. The template is only parsed once.
+
+        Returns a list with a dictionary for each environment, in the order
+        of env_paths, with its path ('env'), 'ok' or 'error' ('status'),
+        the time its import took ('seconds'), the seconds taken by each
+        step of the database stage which finished ('database'), the 
+        statistics of the file archive import ('archive') and a message
+        for each part of the import which failed ('errors'). An environment
+        is only 'ok' if both stages of the import succeeded, and every step
+        of the database stage (see DATABASE_PARTS) ran. progress is called
+        with each of these dictionaries as soon as the import is 
+        finished."""
+
+        global _parsed_template
+
+        start = time.time()
+        _parsed_template = ParsedTemplate(template_path)
+        self.log.info("Parsed template %s in %.1fs, provisioning %s environments",
+                      template_path, time.time() - start, len(env_paths))
+
+        processes = max(1, min(processes or self.provision_processes, len(env_paths)))
+        pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+        results = [None] * len(env_paths)
+        try:
+            for index, result in pool.imap_unordered(_provision_environment,
+                                                     enumerate(env_paths)):
+                results[index] = result
+                if result['status'] != 'ok':
+                    self.log.error("Unable to provision %s from template %s: %s",
+                                   result['env'], template_path, result['errors'])
+                if progress:
+                    progress(result)
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+            _parsed_template = None
+
+        self.log.info("Provisioned %s environments from template %s in %.1fs",
+                      len(env_paths), template_path, time.time() - start)
+        return results
+
+def _provision_environment(task):
+    """Imports the parsed template into one environment, in a worker
+    process. task is an (index, environment path) pair, and we return the
+    index with the result so results can be put back in order."""
+
+    index, env_path = task
+    result = {'env': env_path, 'database': None, 'archive': None, 'errors': {}}
+    start = time.time()
+    try:
+        env = open_environment(env_path, use_cache=False)
+        try:
+            importer = ImportTemplate(env)
+            importer.use_parsed_template(_parsed_template)
+            results, errors = importer.import_template(_parsed_template.template_path)
+            for key, exc_info in errors.iteritems():
+                result['errors'][key] = ''.join(
+                    traceback.format_exception_only(*exc_info[:2])).strip()
+            database = results.get('database')
+            if database is not None:
+                result['database'] = database
+                missing = [part for part in DATABASE_PARTS if part not in database]
+                if missing:
+                    result['errors']['database'] = "Not imported: %s" % ', '.join(missing)
+            archive = results.get('repos')
+            if archive is not None:
+                result['archive'] = archive
+                if archive['returncode']:
+                    result['errors']['repos'] = archive['stderr'].strip() \
+                        or "svnadmin load failed with exit status %s" % archive['returncode']
+        finally:
+            env.shutdown()
+    except Exception:
+        result['errors']['environment'] = traceback.format_exc().strip().splitlines()[-1]
+
+    result['status'] = result['errors'] and 'error' or 'ok'
+    result['seconds'] = round(time.time() - start, 3)
+    return index, result
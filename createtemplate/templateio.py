@@ -0,0 +1,406 @@
+import errno
+import gzip
+import json
+import os
+from collections import namedtuple
+from xml.sax.saxutils import XMLGenerator
+# cElementTree is C implementation and faster
+# http://eli.thegreenplace.net/2012/03/15/processing-xml-in-python-with-elementtree/
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+from createtemplate.packed import open_template
+
+# Helpers to read and write the files which make up a project template.
+#
+# Each table of a template is stored in a file of its own, either as XML
+# (priority.xml) or as gzip compressed JSON lines (priority.jsonl.gz). The
+# XML format is what templates have always used. The JSON lines format has
+# a header line naming the table and the name and type of each field,
+# followed by a JSON list of values per row. It is much smaller and
+# quicker to parse, in particular for ticket types whose JSON definitions
+# are stored as JSON rather than as strings inside XML elements.
+#
+# Templates are read through TemplateReader and written through
+# TemplateWriter, which deal with both formats, so the exporters and
+# importers don't need to know which format a template uses.
+
+TEMPLATE_FORMATS = ('xml', 'jsonl')
+XML_EXTENSION = '.xml'
+JSONL_EXTENSION = '.jsonl.gz'
+JSONL_FORMAT = 'createtemplate-jsonl'
+JSONL_VERSION = 1
+JSONL_COMPRESSION_LEVEL = 6
+
+class XMLStreamWriter(object):
+    """Writes a template XML file one element at a time.
+
+    ElementTree needs the whole tree in memory before it can serialize
+    anything, which is a problem for files such as wiki.xml where the
+    text of every page ends up in a single tree. This writer emits each
+    element to the file as soon as it is added, so memory use is bounded
+    by the largest element rather than the size of the whole file.
+
+    The root element is opened when the writer is created and closed by
+    close(), so the writer is best used as a context manager:
+
+    >>> with XMLStreamWriter(path, 'wiki', project='foo') as writer:
+    ...     writer.element('page', {'name': 'WikiStart'}, text)
+    """
+
+    def __init__(self, filename, root, **attrib):
+        self.filename = filename
+        self.root = root
+        self.fileobj = open(filename, 'wb')
+        self._generator = XMLGenerator(self.fileobj, 'utf-8')
+        self._generator.startDocument()
+        self._generator.startElement(root, attrib)
+
+    def element(self, tag, attrib=None, text=None):
+        """Writes a complete element with optional text content."""
+
+        self.start(tag, attrib)
+        self.characters(text)
+        self.end(tag)
+
+    def characters(self, text):
+        """Writes text content inside the element opened last."""
+
+        if text:
+            self._generator.characters(text)
+
+    def start(self, tag, attrib=None):
+        """Opens an element which can contain child elements."""
+
+        self._generator.startElement(tag, attrib or {})
+
+    def end(self, tag):
+        """Closes an element previously opened with start()."""
+
+        self._generator.endElement(tag)
+
+    def close(self):
+        """Closes the root element and the underlying file."""
+
+        if not self.fileobj.closed:
+            self._generator.endElement(self.root)
+            self._generator.endDocument()
+            self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# The records TemplateReader yields for each template file. Values are kept
+# as the strings stored in the XML, apart from a few integer fields.
+
+WikiPageRecord = namedtuple('WikiPageRecord', 'name readonly author text')
+AttachmentRecord = namedtuple('AttachmentRecord',
+                              'name parent_id size version description')
+TicketTypeRecord = namedtuple('TicketTypeRecord', 'name data')
+PriorityRecord = namedtuple('PriorityRecord', 'name value')
+VersionRecord = namedtuple('VersionRecord', 'name description')
+ComponentRecord = namedtuple('ComponentRecord', 'name description')
+MilestoneRecord = namedtuple('MilestoneRecord',
+                             'name start due completed parent description')
+GroupRecord = namedtuple('GroupRecord', 'name sid label description perms')
+MailinglistRecord = namedtuple('MailinglistRecord',
+                               'name email private postperm replyto description')
+
+# How the records of each table are stored: the record type, the root and
+# element tags and the fields stored as attributes and as the text of each
+# element in XML, and the fields which aren't text. 'int' fields are
+# integers, 'json' fields are JSON documents - kept as strings in records
+# but stored as JSON in JSON lines files - and 'perms' is the list of
+# (name, action) pairs stored as group_perms elements in XML.
+Table = namedtuple('Table', 'record root tag attributes text types')
+
+TABLES = {
+    'wiki': Table(WikiPageRecord, 'wiki', 'page',
+                  ('name', 'readonly', 'author'), 'text', {'readonly': 'int'}),
+    'attachment': Table(AttachmentRecord, 'attachments', 'attachment',
+                        ('name', 'parent_id', 'size', 'version'), 'description',
+                        {'size': 'int'}),
+    'ticket': Table(TicketTypeRecord, 'ticket_types', 'type_name',
+                    ('name',), 'data', {'data': 'json'}),
+    'priority': Table(PriorityRecord, 'ticket_priority', 'priority_info',
+                      ('name', 'value'), None, {}),
+    'version': Table(VersionRecord, 'ticket_versions', 'version_info',
+                     ('name', 'description'), None, {}),
+    'component': Table(ComponentRecord, 'ticket_components', 'component_info',
+                       ('name', 'description'), None, {}),
+    'milestone': Table(MilestoneRecord, 'milestones', 'milestone_info',
+                       ('name', 'start', 'due', 'completed', 'parent'), 'description', {}),
+    'group': Table(GroupRecord, 'membership_group', 'group_info',
+                   ('name', 'sid', 'label'), 'description', {'perms': 'perms'}),
+    'mailinglist': Table(MailinglistRecord, 'lists', 'list_info',
+                         ('name', 'email', 'private', 'postperm', 'replyto'),
+                         'description', {}),
+}
+
+def table_filename(table, template_format='xml'):
+    """Returns the name of the file table is stored in with template_format."""
+
+    if template_format == 'jsonl':
+        return table + JSONL_EXTENSION
+    return table + XML_EXTENSION
+
+def table_name(filename):
+    """Returns the table stored in the template file filename, or None if
+    it isn't a table file."""
+
+    for extension in (XML_EXTENSION, JSONL_EXTENSION):
+        if filename.endswith(extension) and filename[:-len(extension)] in TABLES:
+            return filename[:-len(extension)]
+    return None
+
+class TemplateWriter(object):
+    """Writes the tables of a template in one of TEMPLATE_FORMATS.
+
+    >>> writer = TemplateWriter(template_path, 'jsonl', project='foo')
+    >>> with writer.open('priority') as table:
+    ...     table.write(PriorityRecord('major', '3'))
+
+    The attributes given to the constructor are stored on the root element
+    of XML files and in the header of JSON lines files.
+    """
+
+    def __init__(self, template_path, template_format='xml', **attrib):
+        if template_format not in TEMPLATE_FORMATS:
+            raise ValueError("Unknown template format %s" % template_format)
+        self.template_path = template_path
+        self.template_format = template_format
+        self.attrib = attrib
+
+    def filename(self, table):
+        return os.path.join(self.template_path, table_filename(table, self.template_format))
+
+    def open(self, table):
+        """Returns a writer for the records of table, which should be
+        closed once every record has been written."""
+
+        if self.template_format == 'jsonl':
+            return JSONLinesTableWriter(self.filename(table), table, **self.attrib)
+        return XMLTableWriter(self.filename(table), table, **self.attrib)
+
+class XMLTableWriter(object):
+    """Writes the records of a table to an XML file, one at a time."""
+
+    def __init__(self, filename, table, **attrib):
+        self.filename = filename
+        self.table = TABLES[table]
+        self._writer = XMLStreamWriter(filename, self.table.root, **attrib)
+
+    def write(self, record):
+        attrib = dict((field, unicode(getattr(record, field))) 
+                      for field in self.table.attributes
+                      if getattr(record, field) is not None)
+        text = self.table.text and getattr(record, self.table.text)
+        self._writer.start(self.table.tag, attrib)
+        self._writer.characters(text)
+        for name, action in getattr(record, 'perms', None) or []:
+            self._writer.element('group_perms', {'name': name, 'action': action})
+        self._writer.end(self.table.tag)
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class JSONLinesTableWriter(object):
+    """Writes the records of a table to a gzip compressed JSON lines file,
+    one at a time."""
+
+    def __init__(self, filename, table, **attrib):
+        self.filename = filename
+        self.table = TABLES[table]
+        self.fileobj = gzip.GzipFile(filename, 'wb', JSONL_COMPRESSION_LEVEL)
+        fields = [[field, self.table.types.get(field, 'text')] 
+                  for field in self.table.record._fields]
+        header = dict(attrib, format=JSONL_FORMAT, version=JSONL_VERSION,
+                      table=table, fields=fields)
+        self._write_line(header)
+
+    def write(self, record):
+        values = list(record)
+        for i, field in enumerate(self.table.record._fields):
+            if self.table.types.get(field) == 'json' and isinstance(values[i], basestring):
+                try:
+                    values[i] = json.loads(values[i])
+                except ValueError:
+                    # not JSON after all, so we keep the string
+                    pass
+        self._write_line(values)
+
+    def close(self):
+        self.fileobj.close()
+
+    def _write_line(self, data):
+        self.fileobj.write(json.dumps(data, separators=(',', ':')) + '\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class TemplateReader(object):
+    """Streams the records out of the table files of a template.
+
+    Each method reads its file incrementally and yields a record per row,
+    whether the table is stored as XML or as JSON lines - see TABLES. XML
+    is parsed with iterparse, clearing each element once its record has 
+    been built. Memory use therefore doesn't grow with the size of the 
+    file, and as every record carries all of the data of its element (e.g.
+    a group and its permissions) no file needs to be parsed twice.
+
+    The template can be a directory or a packed template, see 
+    open_template(). The methods are generators, so an IOError for a 
+    missing file is raised when iteration starts rather than when the 
+    method is called.
+    """
+
+    def __init__(self, template_path):
+        self.template_path = template_path
+        self.template = open_template(template_path)
+
+    def wiki_pages(self):
+        return self.records('wiki')
+
+    def attachments(self):
+        return self.records('attachment')
+
+    def ticket_types(self):
+        return self.records('ticket')
+
+    def priorities(self):
+        return self.records('priority')
+
+    def versions(self):
+        return self.records('version')
+
+    def components(self):
+        return self.records('component')
+
+    def milestones(self):
+        return self.records('milestone')
+
+    def groups(self):
+        return self.records('group')
+
+    def mailinglists(self):
+        return self.records('mailinglist')
+
+    def filename(self, table):
+        """Returns the name of the file the records of table are read from,
+        its JSON lines file if the template has one and its XML file 
+        otherwise."""
+
+        if self.template.exists(table_filename(table, 'jsonl')):
+            return table_filename(table, 'jsonl')
+        return table_filename(table, 'xml')
+
+    def records(self, table):
+        """Yields the records of table from its JSON lines file if the 
+        template has one, and from its XML file otherwise."""
+
+        if self.filename(table).endswith(JSONL_EXTENSION):
+            records = self._jsonl_records(table)
+        else:
+            records = self._xml_records(table)
+        for record in records:
+            yield record
+
+    def _xml_records(self, table):
+        spec = TABLES[table]
+        for element in self._iterparse(table_filename(table, 'xml')):
+            values = dict()
+            for field in spec.record._fields:
+                if field in spec.attributes:
+                    if spec.types.get(field) == 'int':
+                        values[field] = int(element.get(field, 0))
+                    else:
+                        values[field] = element.get(field)
+                elif field == spec.text:
+                    values[field] = element.text
+                elif spec.types.get(field) == 'perms':
+                    values[field] = [(perm.get('name'), perm.get('action')) 
+                                     for perm in element]
+            yield spec.record(**values)
+
+    def _jsonl_records(self, table):
+        spec = TABLES[table]
+        filename = table_filename(table, 'jsonl')
+        with self.template.open(filename) as fileobj:
+            lines = gzip.GzipFile(filename, 'rb', fileobj=fileobj)
+            header = json.loads(lines.readline())
+            if header.get('format') != JSONL_FORMAT or header.get('version') != JSONL_VERSION:
+                raise ValueError("Unsupported table file %s in template %s"
+                                 % (filename, self.template_path))
+            # rows are matched up with the fields named in the header, so 
+            # fields can be added or reordered without breaking old templates
+            names = [name for name, field_type in header['fields']]
+            types = [spec.types.get(field) for field in spec.record._fields]
+            for line in lines:
+                row = dict(zip(names, json.loads(line)))
+                values = list()
+                for field, field_type in zip(spec.record._fields, types):
+                    value = row.get(field)
+                    if field_type == 'int':
+                        value = int(value or 0)
+                    elif field_type == 'json' and value is not None \
+                            and not isinstance(value, basestring):
+                        value = json.dumps(value)
+                    elif field_type == 'perms':
+                        value = [tuple(perm) for perm in value or []]
+                    values.append(value)
+                yield spec.record(*values)
+
+    def _iterparse(self, filename):
+        """Yields each complete child element of the root element of
+        filename, and then frees it."""
+
+        with self.template.open(filename) as fileobj:
+            depth = 0
+            root = None
+            for event, element in ET.iterparse(fileobj, events=('start', 'end')):
+                if event == 'start':
+                    if root is None:
+                        root = element
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 1:
+                        yield element
+                        root.clear()
+
+class ParsedTemplate(TemplateReader):
+    """A TemplateReader which reads every table of the template once and
+    then keeps the records in memory, for importing the same template into
+    many projects."""
+
+    def __init__(self, template_path):
+        super(ParsedTemplate, self).__init__(template_path)
+        self.tables = dict()
+        for table in TABLES:
+            try:
+                self.tables[table] = list(super(ParsedTemplate, self).records(table))
+            except IOError as exception:
+                if exception.errno != errno.ENOENT:
+                    raise
+
+    def records(self, table):
+        if table not in self.tables:
+            raise IOError(errno.ENOENT, "No %s table in template %s" 
+                          % (table, self.template_path))
+        for record in self.tables[table]:
+            yield record
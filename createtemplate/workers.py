@@ -0,0 +1,67 @@
+import sys
+import threading
+from Queue import Queue, Empty
+
+# Runs template export and import steps on a small pool of threads
+
+def run_tasks(env, tasks, max_workers, progress=None):
+    """Runs each (key, function, args) tuple in tasks on a pool of at most
+    max_workers threads and waits for all of them to finish.
+
+    Returns a (results, errors) tuple of dictionaries keyed on the task
+    keys - results holds the return value of each task which succeeded and
+    errors the exc_info tuple of each task which raised an exception.
+
+    If progress is given it is called from the worker thread as
+    progress(key, 'running', None) before each task starts, and as
+    progress(key, 'done', result) or progress(key, 'failed', exc_info)
+    after it finishes.
+
+    Trac hands out database connections per thread, so every worker thread
+    gets its own connection. We release them when each worker is done, as
+    the request handler does for its own thread."""
+
+    results = {}
+    errors = {}
+    queue = Queue()
+    for task in tasks:
+        queue.put(task)
+
+    def run(key, function, args):
+        if progress:
+            progress(key, 'running', None)
+        try:
+            results[key] = function(*args)
+        except Exception:
+            errors[key] = sys.exc_info()
+            if progress:
+                progress(key, 'failed', errors[key])
+        else:
+            if progress:
+                progress(key, 'done', results[key])
+
+    def worker():
+        try:
+            while True:
+                try:
+                    task = queue.get_nowait()
+                except Empty:
+                    return
+                run(*task)
+        finally:
+            env.shutdown(threading.current_thread().ident)
+
+    if max_workers <= 1:
+        # don't bother starting threads if we only want one
+        while not queue.empty():
+            run(*queue.get_nowait())
+        return results, errors
+
+    threads = [threading.Thread(target=worker, name='template-worker-%s' % i)
+               for i in range(min(max_workers, len(tasks)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results, errors
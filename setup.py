@@ -53,7 +53,9 @@ setup(
     entry_points={'trac.plugins':
                    ['createtemplate.admin = createtemplate.admin',
                     'createtemplate.importer = createtemplate.importer',
-                    'createtemplate.filter = createtemplate.filter'
+                    'createtemplate.filter = createtemplate.filter',
+                    'createtemplate.jobs = createtemplate.jobs',
+                    'createtemplate.provision = createtemplate.provision'
                    ]},
     install_requires=['Trac', 'Genshi'
                       ],
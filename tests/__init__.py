@@ -0,0 +1,25 @@
+import unittest
+
+# the template modules import the #define plugins at module level, so
+# stand-ins are installed for any plugin which is missing - each test
+# module does this too, as `unittest discover` imports them on their own
+from benchmarks import standins
+standins.install()
+
+from tests import test_admin, test_archive, test_archive_chain, test_blobstore, \
+                  test_importer, test_packed, test_provision, test_templateio
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(test_admin.suite())
+    suite.addTest(test_archive.suite())
+    suite.addTest(test_archive_chain.suite())
+    suite.addTest(test_blobstore.suite())
+    suite.addTest(test_importer.suite())
+    suite.addTest(test_packed.suite())
+    suite.addTest(test_provision.suite())
+    suite.addTest(test_templateio.suite())
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
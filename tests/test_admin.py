@@ -0,0 +1,51 @@
+import unittest
+
+# the template modules import the #define plugins at module level
+from benchmarks import standins
+standins.install()
+
+from trac.test import EnvironmentStub
+from trac.wiki.model import WikiPage
+
+from createtemplate.admin import GenerateTemplate
+
+class WikiExportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'createtemplate.*'])
+        for name, texts in (('Guide', ['A guide', 'A better guide']),
+                            ('Help', ['Some help']),
+                            ('WikiStart', ['Welcome'])):
+            for text in texts:
+                page = WikiPage(self.env, name)
+                page.text = text
+                page.save('admin', None, None)
+        page = WikiPage(self.env, 'Deleted')
+        page.text = 'Gone'
+        page.save('admin', None, None)
+        page.delete()
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _pages(self, batch_size):
+        self.env.config.set('project_templates', 'wiki_export_batch_size', batch_size)
+        return [(name, text) for name, readonly, author, text
+                in GenerateTemplate(self.env).get_latest_wiki_pages()]
+
+    def test_latest_versions(self):
+        self.assertEqual([('Guide', 'A better guide'), ('Help', 'Some help'),
+                          ('WikiStart', 'Welcome')], self._pages(100))
+
+    def test_batches(self):
+        # batches which end exactly at the last page, and batches smaller
+        # than one page
+        expected = self._pages(100)
+        for batch_size in (1, 2, 3, 0, -1):
+            self.assertEqual(expected, self._pages(batch_size))
+
+def suite():
+    return unittest.makeSuite(WikiExportTestCase)
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,166 @@
+import errno
+import gzip
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+# the template modules import the #define plugins at module level
+from benchmarks import standins
+standins.install()
+
+from createtemplate.archive import PipeWriter, _close, _copy, _open_decompressor, \
+                                   archive_codec, archive_filename, codec_available, \
+                                   find_archive
+
+class BrokenPipe(object):
+    """A pipe whose reader exits after accepting limit bytes."""
+
+    def __init__(self, limit, code=errno.EPIPE):
+        self.limit = limit
+        self.errno = code
+        self.written = list()
+
+    def write(self, data):
+        if sum(len(chunk) for chunk in self.written) >= self.limit:
+            raise IOError(self.errno, os.strerror(self.errno))
+        self.written.append(data)
+
+    def close(self):
+        raise IOError(self.errno, os.strerror(self.errno))
+
+class CopyTestCase(unittest.TestCase):
+
+    def test_copy(self):
+        data = os.urandom(10000)
+        target = StringIO()
+        self.assertEqual(len(data), _copy(StringIO(data), target, 1024))
+        self.assertEqual(data, target.getvalue())
+
+    def test_copy_empty(self):
+        target = StringIO()
+        self.assertEqual(0, _copy(StringIO(''), target, 1024))
+        self.assertEqual('', target.getvalue())
+
+    def test_copy_broken_pipe(self):
+        # the bytes the reader never got aren't counted
+        target = BrokenPipe(3000)
+        self.assertEqual(3072, _copy(StringIO('x' * 10000), target, 1024))
+        self.assertEqual('x' * 3072, ''.join(target.written))
+
+    def test_copy_other_error(self):
+        target = BrokenPipe(0, errno.ENOSPC)
+        try:
+            _copy(StringIO('x' * 10000), target, 1024)
+        except IOError as exception:
+            self.assertEqual(errno.ENOSPC, exception.errno)
+        else:
+            self.fail("IOError not raised")
+
+    def test_close(self):
+        _close(BrokenPipe(0))
+        self.assertRaises(IOError, _close, BrokenPipe(0, errno.EIO))
+
+    def test_copy_to_exited_process(self):
+        # a process which exits without reading its stdin, as svnadmin does
+        # when the dump is broken
+        process = subprocess.Popen(['true'], stdin=subprocess.PIPE)
+        process.wait()
+        size = _copy(StringIO('x' * (4 * 1024 * 1024)), process.stdin, 64 * 1024)
+        self.assertTrue(size < 4 * 1024 * 1024)
+        _close(process.stdin)
+
+class BrokenFile(object):
+    """A file which can't be read after limit bytes."""
+
+    def __init__(self, data, limit):
+        self.data = StringIO(data)
+        self.limit = limit
+
+    def read(self, size):
+        if self.data.tell() >= self.limit:
+            raise IOError(errno.EIO, os.strerror(errno.EIO))
+        return self.data.read(size)
+
+class PipeWriterTestCase(unittest.TestCase):
+
+    def _pipe(self):
+        read_fd, write_fd = os.pipe()
+        return os.fdopen(read_fd, 'rb'), os.fdopen(write_fd, 'wb')
+
+    def test_write(self):
+        reader, pipe = self._pipe()
+        data = os.urandom(100000)
+        writer = PipeWriter(StringIO(data), pipe, 1024)
+        self.assertEqual(data, reader.read())
+        writer.close()
+        reader.close()
+
+    def test_read_error(self):
+        reader, pipe = self._pipe()
+        writer = PipeWriter(BrokenFile('x' * 10000, 2048), pipe, 1024)
+        # the pipe is closed all the same, so the reader isn't left waiting
+        self.assertEqual('x' * 2048, reader.read())
+        reader.close()
+        try:
+            writer.close()
+        except IOError as exception:
+            self.assertEqual(errno.EIO, exception.errno)
+        else:
+            self.fail("IOError not raised")
+
+    def test_decompressor_read_error(self):
+        if not codec_available('zstd'):
+            return
+        # the error reading the archive out of the template is raised,
+        # rather than leaving zstd to fail on a cut short archive
+        archive, process, stderr, writer = _open_decompressor(
+                                                'template.dump.zst',
+                                                BrokenFile('x' * 10000, 1024))
+        archive.read()
+        archive.close()
+        self.assertNotEqual(0, process.wait())
+        self.assertTrue(stderr.data)
+        self.assertRaises(IOError, writer.close)
+
+class ArchiveFilesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_archive_names(self):
+        self.assertEqual('t.dump.gz', archive_filename('t', 'gzip'))
+        self.assertEqual('t.dump.gz', archive_filename('t', 'pigz'))
+        self.assertEqual('t.dump.zst', archive_filename('t', 'zstd'))
+        self.assertEqual('gzip', archive_codec('t.dump.gz'))
+        self.assertEqual('zstd', archive_codec('t.dump.zst'))
+        self.assertRaises(ValueError, archive_codec, 't.dump.bz2')
+
+    def test_find_archive(self):
+        template_path = os.path.join(self.dir, 'template')
+        os.mkdir(template_path)
+        self.assertEqual(None, find_archive(template_path))
+
+        gzip_path = os.path.join(template_path, 'template.dump.gz')
+        gzip.GzipFile(gzip_path, 'wb').close()
+        self.assertEqual(gzip_path, find_archive(template_path + '/'))
+
+        # zstd archives are preferred
+        zstd_path = os.path.join(template_path, 'template.dump.zst')
+        open(zstd_path, 'wb').close()
+        self.assertEqual(zstd_path, find_archive(template_path))
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CopyTestCase))
+    suite.addTest(unittest.makeSuite(PipeWriterTestCase))
+    suite.addTest(unittest.makeSuite(ArchiveFilesTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,101 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+# the template modules import the #define plugins at module level
+from benchmarks import standins
+standins.install()
+
+from trac.resource import ResourceNotFound
+from trac.test import EnvironmentStub
+
+from createtemplate.importer import ImportTemplate
+from createtemplate.packed import pack_template
+
+class ArchiveChainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.env = EnvironmentStub(enable=['createtemplate.*'])
+        self.env.config.set('project_templates', 'template_dir', self.dir)
+        self.importer = ImportTemplate(self.env)
+
+        # base <- mid <- top is a chain of incremental archives, and same
+        # had no new revisions since top
+        self._template('base', {'file': 'base.dump.gz'})
+        self._template('mid', {'file': 'mid.dump.gz', 'base': 'base'})
+        self._template('top', {'file': 'top.dump.gz', 'base': 'mid'})
+        self._template('same', {'file': None, 'base': 'top'})
+
+    def tearDown(self):
+        self.env.reset_db()
+        shutil.rmtree(self.dir)
+
+    def _template(self, name, archive, packed=False):
+        """Creates a template directory, or a packed template, whose info.json
+        records archive. The archive file itself is left empty."""
+
+        template_path = os.path.join(self.dir, name)
+        os.mkdir(template_path)
+        info = {'name': name}
+        if archive is not None:
+            info['archive'] = archive
+        with open(os.path.join(template_path, 'info.json'), 'w') as fileobj:
+            json.dump(info, fileobj)
+        if archive and archive.get('file'):
+            open(os.path.join(template_path, archive['file']), 'wb').close()
+        if packed:
+            packed_path = template_path + '.tar'
+            pack_template(template_path, packed_path, info, [])
+            shutil.rmtree(template_path)
+            return packed_path
+        return template_path
+
+    def _chain(self, template_path):
+        return [(os.path.basename(template.path), relpath) for template, relpath
+                in self.importer.archive_chain(template_path)]
+
+    def test_full_dump(self):
+        self.assertEqual([('base', 'base.dump.gz')],
+                         self._chain(os.path.join(self.dir, 'base')))
+
+    def test_loads_base_first(self):
+        self.assertEqual([('base', 'base.dump.gz'), ('mid', 'mid.dump.gz'),
+                          ('top', 'top.dump.gz')],
+                         self._chain(os.path.join(self.dir, 'top')))
+
+    def test_without_new_revisions(self):
+        self.assertEqual([('base', 'base.dump.gz'), ('mid', 'mid.dump.gz'),
+                          ('top', 'top.dump.gz')],
+                         self._chain(os.path.join(self.dir, 'same')))
+
+    def test_packed(self):
+        packed_path = self._template('packed', {'file': 'packed.dump.gz', 'base': 'mid'},
+                                     packed=True)
+        self.assertEqual([('base', 'base.dump.gz'), ('mid', 'mid.dump.gz'),
+                          ('packed.tar', 'packed.dump.gz')],
+                         self._chain(packed_path))
+
+    def test_legacy_template(self):
+        # templates from before archives were recorded in info.json
+        template_path = self._template('legacy', None)
+        self.assertEqual([], self._chain(template_path))
+        open(os.path.join(template_path, 'legacy.dump.gz'), 'wb').close()
+        self.assertEqual([('legacy', 'legacy.dump.gz')], self._chain(template_path))
+
+    def test_missing_base(self):
+        shutil.rmtree(os.path.join(self.dir, 'base'))
+        self.assertRaises(ResourceNotFound, self.importer.archive_chain,
+                          os.path.join(self.dir, 'top'))
+
+    def test_cycle(self):
+        template_path = self._template('loop', {'file': 'loop.dump.gz', 'base': 'loop'})
+        self.assertEqual([('loop', 'loop.dump.gz')], self._chain(template_path))
+
+def suite():
+    return unittest.makeSuite(ArchiveChainTestCase)
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,111 @@
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+# the template modules import the #define plugins at module level
+from benchmarks import standins
+standins.install()
+
+from createtemplate.blobstore import BLOB_LOCK, BlobStore, file_digest, \
+                                     read_manifest, referenced_digests, \
+                                     update_manifest
+
+class BlobStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.template_path = os.path.join(self.dir, 'template')
+        os.mkdir(self.template_path)
+        self.store = BlobStore.for_template(self.template_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as fileobj:
+            fileobj.write(data)
+        return path
+
+    def _read(self, path):
+        with open(path, 'rb') as fileobj:
+            return fileobj.read()
+
+    def test_add_deduplicates(self):
+        first = self.store.add(self._write('a.txt', 'same'))
+        second = self.store.add(self._write('b.txt', 'same'))
+        other = self.store.add(self._write('c.txt', 'other'))
+        self.assertEqual(first, second)
+        self.assertEqual(file_digest(os.path.join(self.dir, 'a.txt')), first)
+        self.assertEqual(sorted([first, other]), sorted(self.store.digests()))
+        self.assertEqual('same', self._read(self.store.blob_path(first)))
+
+    def test_add_never_hard_links(self):
+        source = self._write('a.txt', 'data')
+        digest = self.store.add(source, 'hardlink')
+        self.assertEqual(1, os.stat(source).st_nlink)
+        self.assertEqual(1, os.stat(self.store.blob_path(digest)).st_nlink)
+
+    def test_place_never_hard_links(self):
+        digest = self.store.add(self._write('a.txt', 'data'))
+        first = os.path.join(self.dir, 'first.txt')
+        second = os.path.join(self.dir, 'second.txt')
+        self.store.place(digest, first, 'hardlink')
+        self.store.place(digest, second, 'hardlink')
+        self.assertEqual(1, os.stat(self.store.blob_path(digest)).st_nlink)
+        self.assertNotEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+
+        # changing a placed copy leaves the blob alone
+        with open(first, 'wb') as fileobj:
+            fileobj.write('changed')
+        self.assertEqual('data', self._read(self.store.blob_path(digest)))
+        self.assertEqual('data', self._read(second))
+
+    def test_manifest(self):
+        self.assertEqual({}, read_manifest(self.template_path))
+        digest = self.store.add(self._write('a.txt', 'data'))
+        update_manifest(self.template_path, 'workflows', {'task.xml': digest})
+        update_manifest(self.template_path, 'attachments/wiki', {})
+        self.assertEqual({'workflows': {'task.xml': digest}, 'attachments/wiki': {}},
+                         read_manifest(self.template_path))
+        self.assertEqual(set([digest]), referenced_digests([self.template_path]))
+
+    def test_collect_garbage(self):
+        kept = self.store.add(self._write('a.txt', 'kept'))
+        unreferenced = self.store.add(self._write('b.txt', 'unreferenced'))
+
+        # recently added blobs might belong to an export still running
+        self.assertEqual([], self.store.collect_garbage(set([kept])))
+        self.assertEqual([unreferenced], self.store.collect_garbage(set([kept]), min_age=0))
+        self.assertEqual([kept], list(self.store.digests()))
+        self.assertFalse(os.path.exists(self.store.blob_path(unreferenced)))
+
+    def test_collect_garbage_waits_for_lock(self):
+        digest = self.store.add(self._write('a.txt', 'data'))
+        removed = []
+        collector = threading.Thread(target=lambda: removed.extend(
+                                        self.store.collect_garbage(set(), min_age=0)))
+
+        # hold the lock as add() does while it reuses a blob - flock locks
+        # belong to the open file, so this blocks our own thread too
+        with open(os.path.join(self.store.path, BLOB_LOCK), 'a') as lockfile:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+            try:
+                collector.start()
+                time.sleep(0.2)
+                self.assertTrue(collector.is_alive())
+                self.assertTrue(os.path.exists(self.store.blob_path(digest)))
+            finally:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+        collector.join(10)
+        self.assertEqual([digest], removed)
+
+def suite():
+    return unittest.makeSuite(BlobStoreTestCase)
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,234 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+# the template modules import the #define plugins at module level
+from benchmarks import standins
+standins.install()
+
+from trac.attachment import Attachment
+from trac.core import Component, implements
+from trac.perm import PermissionSystem
+from trac.test import EnvironmentStub
+from trac.wiki.api import IWikiChangeListener, WikiSystem
+from trac.wiki.model import WikiPage
+
+from createtemplate.admin import GenerateTemplate
+from createtemplate.importer import ImportTemplate
+from createtemplate.templateio import ComponentRecord, MilestoneRecord, \
+                                      TemplateWriter, VersionRecord, WikiPageRecord
+
+class WikiListener(Component):
+    """Records the wiki changes it is notified about, with the number of
+    pages in the wiki table at the time."""
+
+    implements(IWikiChangeListener)
+
+    def __init__(self):
+        self.changes = list()
+
+    def _record(self, change, page):
+        cursor = self.env.get_read_db().cursor()
+        cursor.execute("SELECT COUNT(*) FROM wiki")
+        self.changes.append((change, page.name, page.version, page.text, page.readonly,
+                             WikiSystem(self.env).has_page(page.name),
+                             cursor.fetchone()[0]))
+
+    def wiki_page_added(self, page):
+        self._record('added', page)
+
+    def wiki_page_changed(self, page, version, t, comment, author, ipnr):
+        self._record('changed', page)
+
+    def wiki_page_deleted(self, page):
+        pass
+
+    def wiki_page_version_deleted(self, page):
+        pass
+
+    def wiki_page_renamed(self, page, old_name):
+        pass
+
+class ImporterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.env = EnvironmentStub(default_data=True, enable=['trac.*', 'createtemplate.*'],
+                                   path=os.path.join(self.dir, 'env'))
+        self.env.config.set('project_templates', 'template_dir', self.dir)
+        self.importer = ImportTemplate(self.env)
+        self.template_path = os.path.join(self.dir, 'template')
+        os.mkdir(self.template_path)
+        with open(os.path.join(self.template_path, 'info.json'), 'w') as fileobj:
+            json.dump({'name': 'template'}, fileobj)
+        self.writer = TemplateWriter(self.template_path)
+
+    def tearDown(self):
+        self.env.reset_db()
+        shutil.rmtree(self.dir)
+
+    def _write(self, table, records):
+        with self.writer.open(table) as writer:
+            for record in records:
+                writer.write(record)
+
+    def _rows(self, sql):
+        cursor = self.env.get_read_db().cursor()
+        cursor.execute(sql)
+        return sorted(cursor.fetchall())
+
+class PopulateTestCase(ImporterTestCase):
+
+    def test_populate(self):
+        self._write('component', [ComponentRecord('core', 'The core')])
+        self._write('milestone', [MilestoneRecord('1.0', None, None, None, None,
+                                                  'First release')])
+        self._write('version', [VersionRecord('1.0', None), VersionRecord('2.0', 'Next')])
+        self.importer.template_populate(self.template_path)
+
+        self.assertEqual([('core', 'The core')],
+                         self._rows("SELECT name, description FROM component"))
+        self.assertEqual([('1.0', 'First release')],
+                         self._rows("SELECT name, description FROM milestone"))
+        self.assertEqual([('1.0', None), ('2.0', 'Next')],
+                         self._rows("SELECT name, description FROM version"))
+
+    def test_rollback(self):
+        # the component and milestone tables are imported before the
+        # version table, which is broken
+        defaults = [self._rows("SELECT name FROM %s" % table)
+                    for table in ('component', 'milestone', 'version')]
+        self._write('component', [ComponentRecord('core', 'The core')])
+        self._write('milestone', [MilestoneRecord('1.0', None, None, None, None, None)])
+        with open(self.writer.filename('version'), 'w') as fileobj:
+            fileobj.write('<ticket_versions><version_info name="1.0"')
+
+        self.assertRaises(SyntaxError, self.importer.template_populate, self.template_path)
+        self.assertEqual(defaults, [self._rows("SELECT name FROM %s" % table)
+                                    for table in ('component', 'milestone', 'version')])
+
+    def test_rollback_unreadable_file(self):
+        defaults = self._rows("SELECT name FROM component")
+        self._write('component', [ComponentRecord('core', 'The core')])
+        os.mkdir(self.writer.filename('version'))
+
+        self.assertRaises(IOError, self.importer.template_populate, self.template_path)
+        self.assertEqual(defaults, self._rows("SELECT name FROM component"))
+
+    def test_missing_tables(self):
+        # tables without a file in the template keep their default data
+        defaults = self._rows("SELECT name FROM version")
+        self._write('component', [ComponentRecord('core', None)])
+        self.importer.template_populate(self.template_path)
+        self.assertEqual([('core',)], self._rows("SELECT name FROM component"))
+        self.assertEqual(defaults, self._rows("SELECT name FROM version"))
+
+class PermsTestCase(ImporterTestCase):
+
+    def test_import_perms(self):
+        # the same pair can be listed under more than one group
+        self.importer.import_perms([('developer', 'WIKI_VIEW'), ('developer', 'WIKI_VIEW'),
+                                    ('manager', 'TRAC_ADMIN'), (' ', 'WIKI_VIEW')])
+        self.assertEqual([('developer', 'WIKI_VIEW'), ('manager', 'TRAC_ADMIN')],
+                         self._rows("SELECT username, action FROM permission"))
+
+    def test_permission_cache(self):
+        perms = PermissionSystem(self.env)
+        self.assertTrue(('anonymous', 'WIKI_VIEW') in perms.get_all_permissions())
+        self.importer.import_perms([('reader', 'WIKI_VIEW')])
+        self.assertEqual([('reader', 'WIKI_VIEW')], perms.get_all_permissions())
+
+class WikiImportTestCase(ImporterTestCase):
+
+    def setUp(self):
+        super(WikiImportTestCase, self).setUp()
+        self.env.config.set('project_templates', 'wiki_import_batch_size', 2)
+        page = WikiPage(self.env, 'WikiStart')
+        page.text = 'Default start page'
+        page.save('admin', None, None)
+        self.assertFalse(WikiSystem(self.env).has_page('Guide'))
+        self.env.enable_component(WikiListener)
+        self._write('wiki', [WikiPageRecord('WikiStart', 1, None, 'Template start page'),
+                             WikiPageRecord('Empty', 0, None, None),
+                             WikiPageRecord('Guide', 0, None, 'A guide'),
+                             WikiPageRecord('Help', 0, None, 'Some help')])
+        # the pages are only loaded back through the cache of page names
+        self.fetch = WikiPage._fetch
+        WikiPage._fetch = lambda *args, **kwargs: self.fail("Wiki page loaded")
+
+    def tearDown(self):
+        WikiPage._fetch = self.fetch
+        super(WikiImportTestCase, self).tearDown()
+
+    def test_bulk_import(self):
+        self.importer.import_wiki_pages(self.template_path)
+        self.assertEqual([('Guide', 1, 'A guide', 0), ('Help', 1, 'Some help', 0),
+                          ('WikiStart', 1, 'Default start page', 0),
+                          ('WikiStart', 2, 'Template start page', 1)],
+                         self._rows("SELECT name, version, text, readonly FROM wiki"))
+        self.assertEqual(['Guide', 'Help', 'WikiStart'], 
+                         sorted(WikiSystem(self.env).get_pages()))
+
+    def test_deferred_listeners(self):
+        # listeners are told about each batch of two pages once it has been
+        # committed
+        self.importer.import_wiki_pages(self.template_path)
+        self.assertEqual([('changed', 'WikiStart', 2, 'Template start page', 1, True, 3),
+                          ('added', 'Guide', 1, 'A guide', 0, True, 3),
+                          ('added', 'Help', 1, 'Some help', 0, True, 4)],
+                         WikiListener(self.env).changes)
+
+    def test_suppressed_listeners(self):
+        self.env.config.set('project_templates', 'wiki_import_listeners', 'suppressed')
+        self.importer.import_wiki_pages(self.template_path)
+        self.assertEqual([], WikiListener(self.env).changes)
+        self.assertEqual(4, len(self._rows("SELECT name FROM wiki")))
+
+class AttachmentsTestCase(ImporterTestCase):
+
+    def setUp(self):
+        super(AttachmentsTestCase, self).setUp()
+        page = WikiPage(self.env, 'Start Page')
+        page.text = 'Attachments'
+        page.save('admin', None, None)
+        for filename, data in (('logo.png', 'png' * 100), (u'r\xe9sum\xe9.txt', 'text')):
+            attachment = Attachment(self.env, 'wiki', 'Start Page')
+            attachment.description = 'A file'
+            attachment.insert(filename, StringIO(data), len(data))
+
+    def test_export_and_import(self):
+        # the template has Trac 0.12 attachment directories, whichever
+        # version of Trac the project uses
+        exported = GenerateTemplate(self.env).export_wiki_attachments(None, 'template')
+        self.assertEqual(['logo.png', u'r\xe9sum\xe9.txt'], exported)
+        self.assertEqual(['logo.png', 'r%C3%A9sum%C3%A9.txt'],
+                         sorted(os.listdir(os.path.join(self.template_path, 'attachments',
+                                                        'wiki', 'Start%20Page'))))
+
+        for attachment in Attachment.select(self.env, 'wiki', 'Start Page'):
+            attachment.delete()
+        self.importer.import_wiki_attachments(self.template_path)
+        attachments = list(Attachment.select(self.env, 'wiki', 'Start Page'))
+        self.assertEqual(['logo.png', u'r\xe9sum\xe9.txt'],
+                         [attachment.filename for attachment in attachments])
+        self.assertEqual(['png' * 100, 'text'],
+                         [attachment.open().read() for attachment in attachments])
+
+    def test_export_without_files(self):
+        os.remove(Attachment(self.env, 'wiki', 'Start Page', 'logo.png').path)
+        self.assertEqual([u'r\xe9sum\xe9.txt'],
+                         GenerateTemplate(self.env).export_wiki_attachments(None, 'template'))
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(PopulateTestCase))
+    suite.addTest(unittest.makeSuite(PermsTestCase))
+    suite.addTest(unittest.makeSuite(WikiImportTestCase))
+    suite.addTest(unittest.makeSuite(AttachmentsTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,178 @@
+import errno
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+# the template modules import the #define plugins at module level
+from benchmarks import standins
+standins.install()
+
+from createtemplate.blobstore import BlobStore, update_manifest
+from createtemplate.packed import MANIFEST_NAME, INDEX_NAME, MemberFile, \
+                                  PackedTemplate, open_template, pack_template, \
+                                  read_packed_manifest, template_name
+
+# sizes either side of the tar block size, so the data offsets of later
+# members depend on the padding of earlier ones
+FILES = {
+    'info.json': '{"name": "packed"}',
+    'wiki.xml': '<wiki>%s</wiki>' % ('x' * 1000),
+    'empty.xml': '',
+    'workflows/task.xml': '<workflow/>' * 47,
+    'attachments/wiki/WikiStart/logo.png': ''.join(chr(i % 256) for i in range(513)),
+    'attachments/wiki/WikiStart/notes.txt': 'notes\n' * 200,
+}
+
+class PackedTemplateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.template_path = os.path.join(self.dir, 'packed')
+        for relpath, data in FILES.iteritems():
+            self._write(os.path.join(self.template_path, relpath), data)
+        self.packed_path = self.template_path + '.tar'
+        self.count = pack_template(self.template_path, self.packed_path,
+                                   {'name': 'packed'}, ['wiki', 'workflows'])
+        self.template = open_template(self.packed_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, path, data):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fileobj:
+            fileobj.write(data)
+
+    def test_open_template(self):
+        self.assertTrue(isinstance(self.template, PackedTemplate))
+        self.assertEqual('packed', template_name(self.packed_path))
+        self.assertEqual('packed', template_name(self.template_path + '/'))
+        self.assertFalse(isinstance(open_template(self.template_path), PackedTemplate))
+
+    def test_manifest(self):
+        manifest = read_packed_manifest(self.packed_path)
+        self.assertEqual({'name': 'packed'}, manifest['info'])
+        self.assertEqual(['wiki', 'workflows'], manifest['components'])
+        self.assertEqual(len(FILES), self.count)
+
+    def test_index_offsets(self):
+        self.assertEqual(sorted(FILES), sorted(self.template.index))
+        with open(self.packed_path, 'rb') as fileobj:
+            for relpath, (offset, size) in self.template.index.iteritems():
+                fileobj.seek(offset)
+                self.assertEqual(FILES[relpath], fileobj.read(size))
+
+    def test_valid_tar(self):
+        tar = tarfile.open(self.packed_path)
+        try:
+            names = tar.getnames()
+            self.assertEqual(MANIFEST_NAME, names[0])
+            self.assertEqual(INDEX_NAME, names[-1])
+            for relpath, data in FILES.iteritems():
+                self.assertEqual(data, tar.extractfile(relpath).read())
+        finally:
+            tar.close()
+
+    def test_member_file_read(self):
+        for relpath, data in FILES.iteritems():
+            with self.template.open(relpath) as fileobj:
+                self.assertEqual(data, fileobj.read())
+                self.assertEqual('', fileobj.read())
+                self.assertEqual(len(data), fileobj.tell())
+
+    def test_member_file_chunks(self):
+        data = FILES['attachments/wiki/WikiStart/notes.txt']
+        with self.template.open('attachments/wiki/WikiStart/notes.txt') as fileobj:
+            chunks = list(iter(lambda: fileobj.read(100), ''))
+        self.assertEqual(data, ''.join(chunks))
+        self.assertEqual(100, len(chunks[0]))
+        self.assertEqual(len(data) % 100 or 100, len(chunks[-1]))
+
+    def test_member_file_seek(self):
+        data = FILES['wiki.xml']
+        fileobj = self.template.open('wiki.xml')
+        try:
+            fileobj.seek(6)
+            self.assertEqual(data[6:10], fileobj.read(4))
+            fileobj.seek(-7, os.SEEK_END)
+            self.assertEqual(data[-7:], fileobj.read())
+            fileobj.seek(-10, os.SEEK_CUR)
+            self.assertEqual(len(data) - 10, fileobj.tell())
+            # seeking never leaves the member
+            fileobj.seek(-5)
+            self.assertEqual(0, fileobj.tell())
+            fileobj.seek(len(data) + 100)
+            self.assertEqual('', fileobj.read(10))
+            fileobj.seek(0)
+            self.assertEqual(data[:5], fileobj.read(5))
+        finally:
+            fileobj.close()
+        self.assertTrue(fileobj.closed)
+
+    def test_member_file_bounds(self):
+        # a member file never reads the data of the member after it
+        offset, size = self.template.index['empty.xml']
+        fileobj = MemberFile(open(self.packed_path, 'rb'), offset, size)
+        try:
+            self.assertEqual('', fileobj.read())
+            self.assertEqual('', fileobj.read(10))
+        finally:
+            fileobj.close()
+
+    def test_missing_member(self):
+        try:
+            self.template.open('missing.xml')
+        except IOError as exception:
+            self.assertEqual(errno.ENOENT, exception.errno)
+        else:
+            self.fail("IOError not raised")
+        self.assertRaises(OSError, self.template.listdir, 'missing')
+
+    def test_directories(self):
+        self.assertTrue(self.template.isdir('attachments/wiki'))
+        self.assertFalse(self.template.isdir('wiki.xml'))
+        self.assertTrue(self.template.exists('workflows'))
+        self.assertEqual(['attachments', 'empty.xml', 'info.json', 'wiki.xml',
+                          'workflows'], self.template.listdir())
+        self.assertEqual(['WikiStart'], self.template.listdir('attachments/wiki'))
+        self.assertEqual([('WikiStart/logo.png', 513),
+                          ('WikiStart/notes.txt', 1200)],
+                         list(self.template.files('attachments/wiki')))
+        self.assertEqual(513, self.template.size('attachments/wiki/WikiStart/logo.png'))
+
+    def test_place_and_copytree(self):
+        destination = os.path.join(self.dir, 'logo.png')
+        self._write(destination, 'replaced')
+        strategy = self.template.place('attachments/wiki/WikiStart/logo.png',
+                                       destination, 'hardlink')
+        self.assertEqual('copy', strategy)
+        with open(destination, 'rb') as fileobj:
+            self.assertEqual(FILES['attachments/wiki/WikiStart/logo.png'], fileobj.read())
+
+        workflows = os.path.join(self.dir, 'workflows')
+        self.template.copytree('workflows', workflows)
+        self.assertEqual(['task.xml'], os.listdir(workflows))
+
+    def test_pack_blobs(self):
+        # files kept in the blob store are packed under their own names
+        store = BlobStore.for_template(self.template_path)
+        blob_source = os.path.join(self.dir, 'source.xml')
+        self._write(blob_source, '<workflow name="bug"/>')
+        update_manifest(self.template_path, 'workflows',
+                        {'bug.xml': store.add(blob_source)})
+        packed_path = os.path.join(self.dir, 'blobs.tar')
+        pack_template(self.template_path, packed_path, {}, [])
+
+        template = PackedTemplate(packed_path)
+        self.assertFalse(template.exists('blobs.json'))
+        with template.open('workflows/bug.xml') as fileobj:
+            self.assertEqual('<workflow name="bug"/>', fileobj.read())
+
+def suite():
+    return unittest.makeSuite(PackedTemplateTestCase)
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,108 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+# the template modules import the #define plugins at module level
+from benchmarks import standins
+standins.install()
+
+from trac.env import Environment
+
+from createtemplate.importer import DATABASE_PARTS
+from createtemplate.provision import TemplateProvisioning
+from createtemplate.templateio import ComponentRecord, ParsedTemplate, TemplateWriter, \
+                                      WikiPageRecord
+
+class ProvisionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.template_path = os.path.join(self.dir, 'templates', 'template')
+        os.makedirs(self.template_path)
+        with open(os.path.join(self.template_path, 'info.json'), 'w') as fileobj:
+            json.dump({'name': 'template'}, fileobj)
+        writer = TemplateWriter(self.template_path, 'jsonl')
+        with writer.open('component') as table:
+            table.write(ComponentRecord(u'core', u'The core'))
+        with writer.open('wiki') as table:
+            table.write(WikiPageRecord(u'Guide', 0, None, u'A guide'))
+
+        self.env_paths = [self._environment('env%s' % i) for i in range(3)]
+        self.env = Environment(self.env_paths[0])
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.dir)
+
+    def _environment(self, name):
+        path = os.path.join(self.dir, name)
+        env = Environment(path, create=True, options=[
+                    ('trac', 'database', 'sqlite:db/trac.db'),
+                    ('components', 'createtemplate.*', 'enabled'),
+                    ('project_templates', 'template_dir', os.path.dirname(self.template_path))])
+        env.shutdown()
+        return path
+
+    def _rows(self, env_path, sql):
+        env = Environment(env_path)
+        try:
+            cursor = env.get_read_db().cursor()
+            cursor.execute(sql)
+            return sorted(cursor.fetchall())
+        finally:
+            env.shutdown()
+
+    def test_provision(self):
+        reported = list()
+        results = TemplateProvisioning(self.env).provision(self.template_path, self.env_paths,
+                                                           processes=2,
+                                                           progress=reported.append)
+        self.assertEqual(self.env_paths, [result['env'] for result in results])
+        self.assertEqual(sorted(results), sorted(reported))
+        for result in results:
+            self.assertEqual('ok', result['status'])
+            self.assertEqual({}, result['errors'])
+            self.assertEqual(sorted(DATABASE_PARTS), sorted(result['database']))
+            self.assertEqual(None, result['archive'])
+        for env_path in self.env_paths:
+            self.assertEqual([('core', 'The core')],
+                             self._rows(env_path, "SELECT name, description FROM component"))
+            self.assertEqual([('Guide', 'A guide')],
+                             self._rows(env_path, "SELECT name, text FROM wiki "
+                                                  "WHERE name='Guide'"))
+
+    def test_failed_environment(self):
+        self.env_paths[1] = os.path.join(self.dir, 'missing')
+        results = TemplateProvisioning(self.env).provision(self.template_path, self.env_paths)
+        self.assertEqual(['ok', 'error', 'ok'], [result['status'] for result in results])
+        self.assertEqual(['environment'], results[1]['errors'].keys())
+
+    def test_failed_step(self):
+        # the wiki step fails, so the steps after it never run
+        env = Environment(self.env_paths[1])
+        try:
+            @env.with_transaction()
+            def drop_wiki(db):
+                db.cursor().execute("DROP TABLE wiki")
+        finally:
+            env.shutdown()
+
+        results = TemplateProvisioning(self.env).provision(self.template_path, self.env_paths)
+        self.assertEqual(['ok', 'error', 'ok'], [result['status'] for result in results])
+        self.assertEqual(['database'], results[1]['errors'].keys())
+        self.assertEqual(None, results[1]['database'])
+
+    def test_parsed_template(self):
+        parsed = ParsedTemplate(self.template_path)
+        self.assertEqual([ComponentRecord(u'core', u'The core')], list(parsed.components()))
+        os.remove(os.path.join(self.template_path, 'component.jsonl.gz'))
+        self.assertEqual([ComponentRecord(u'core', u'The core')], list(parsed.components()))
+        self.assertRaises(IOError, list, parsed.versions())
+
+def suite():
+    return unittest.makeSuite(ProvisionTestCase)
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import errno
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+# the template modules import the #define plugins at module level
+from benchmarks import standins
+standins.install()
+
+from createtemplate.templateio import AttachmentRecord, ComponentRecord, GroupRecord, \
+                                      MailinglistRecord, MilestoneRecord, PriorityRecord, \
+                                      JSONL_FORMAT, TABLES, TemplateReader, TemplateWriter, \
+                                      TicketTypeRecord, VersionRecord, WikiPageRecord, \
+                                      table_filename, table_name
+
+# a few records of every table, with the values as TemplateReader yields them
+RECORDS = {
+    'wiki': [WikiPageRecord(u'WikiStart', 1, u'admin', u'= Café =\n<b>&amp;</b> ]]>'),
+             WikiPageRecord(u'Guide', 0, None, u'A guide')],
+    'attachment': [AttachmentRecord(u'logo.png', u'WikiStart', 513, u'1', u'The logo'),
+                   AttachmentRecord(u'notes.txt', u'Guide', 0, None, None)],
+    'ticket': [TicketTypeRecord(u'task', u'{"fields": [1, 2], "name": "task"}')],
+    'priority': [PriorityRecord(u'major', u'1'), PriorityRecord(u'minor', u'2')],
+    'version': [VersionRecord(u'1.0', u'First'), VersionRecord(u'2.0', None)],
+    'component': [ComponentRecord(u'core', u'The core'), ComponentRecord(u'ui', None)],
+    'milestone': [MilestoneRecord(u'1.0', u'2014-01-01', u'2014-06-01', None, None,
+                                  u'First release'),
+                  MilestoneRecord(u'1.0.1', None, None, None, u'1.0', None)],
+    'group': [GroupRecord(u'Developers', u'developers', u'Devs', u'People who code',
+                          [(u'developers', u'WIKI_VIEW'), (u'developers', u'TICKET_VIEW')]),
+              GroupRecord(u'Empty', None, None, None, [])],
+    'mailinglist': [MailinglistRecord(u'dev', u'dev@example.org', u'0', u'members', u'1',
+                                      u'The developers')],
+}
+
+class XMLRoundTripTestCase(unittest.TestCase):
+
+    template_format = 'xml'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.writer = TemplateWriter(self.dir, self.template_format, project='test')
+        for table, records in RECORDS.iteritems():
+            with self.writer.open(table) as writer:
+                for record in records:
+                    writer.write(record)
+        self.reader = TemplateReader(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        for table in TABLES:
+            self.assertEqual(self._normalize(RECORDS[table]),
+                             self._normalize(self.reader.records(table)))
+
+    def _normalize(self, records):
+        return list(records)
+
+    def test_filenames(self):
+        for table in TABLES:
+            filename = table_filename(table, self.template_format)
+            self.assertEqual(filename, self.reader.filename(table))
+            self.assertEqual(table, table_name(filename))
+            self.assertTrue(os.path.exists(os.path.join(self.dir, filename)))
+        self.assertEqual(None, table_name('info.json'))
+
+    def test_missing_table(self):
+        os.remove(self.writer.filename('wiki'))
+        try:
+            list(self.reader.wiki_pages())
+        except IOError as exception:
+            self.assertEqual(errno.ENOENT, exception.errno)
+        else:
+            self.fail("IOError not raised")
+
+    def test_empty_table(self):
+        self.writer.open('version').close()
+        self.assertEqual([], list(self.reader.versions()))
+
+class JSONLinesRoundTripTestCase(XMLRoundTripTestCase):
+
+    template_format = 'jsonl'
+
+    def _normalize(self, records):
+        # ticket types are stored as JSON, so only their content survives
+        return [record._replace(data=json.loads(record.data))
+                if isinstance(record, TicketTypeRecord) else record
+                for record in records]
+
+    def _write_lines(self, table, lines):
+        fileobj = gzip.GzipFile(self.writer.filename(table), 'wb')
+        for line in lines:
+            fileobj.write(json.dumps(line) + '\n')
+        fileobj.close()
+
+    def test_header(self):
+        fileobj = gzip.GzipFile(self.writer.filename('priority'), 'rb')
+        header = json.loads(fileobj.readline())
+        fileobj.close()
+        self.assertEqual({'format': JSONL_FORMAT, 'version': 1, 'table': 'priority',
+                          'project': 'test',
+                          'fields': [['name', 'text'], ['value', 'text']]}, header)
+
+    def test_fields_by_name(self):
+        # fields are matched up by name, and fields the reader doesn't know
+        # about are ignored
+        self._write_lines('milestone', [
+            {'format': JSONL_FORMAT, 'version': 1, 'table': 'milestone',
+             'fields': [['description', 'text'], ['owner', 'text'], ['name', 'text']]},
+            ['First release', 'admin', '1.0']])
+        self.assertEqual([MilestoneRecord(u'1.0', None, None, None, None, u'First release')],
+                         list(self.reader.milestones()))
+
+    def test_unsupported_version(self):
+        self._write_lines('version', [
+            {'format': JSONL_FORMAT, 'version': 2, 'table': 'version', 'fields': []}])
+        self.assertRaises(ValueError, list, self.reader.versions())
+
+    def test_prefers_json_lines(self):
+        xml_writer = TemplateWriter(self.dir, 'xml')
+        with xml_writer.open('component') as writer:
+            writer.write(ComponentRecord(u'xml', None))
+        self.assertEqual(RECORDS['component'], list(self.reader.components()))
+        os.remove(self.writer.filename('component'))
+        self.assertEqual([ComponentRecord(u'xml', None)], list(self.reader.components()))
+
+    def test_ticket_data_not_json(self):
+        with self.writer.open('ticket') as writer:
+            writer.write(TicketTypeRecord(u'task', u'not JSON'))
+        self.assertEqual([TicketTypeRecord(u'task', u'not JSON')],
+                         list(self.reader.ticket_types()))
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(XMLRoundTripTestCase))
+    suite.addTest(unittest.makeSuite(JSONLinesRoundTripTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')